@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+import re
+import json
+import time
+import asyncio
+import calendar
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+from wsgiref.handlers import format_date_time
+
+import msgpack
+import redis.asyncio
+from sqlalchemy import create_engine
+
+import config as cfg
+from config import SQL
+import ohlc
+import marketdata
+from respcache import ResponseCache, file_version, etag_matches
+from stream import AsyncFanout, SeqStream, unpack_snapshot, KEEPALIVE
+
+"""
+Asyncio API server for the read endpoints
+
+An ASGI app serving the market data, balance and wealth endpoints of
+app.py, at the same paths and with the same responses (see marketdata).
+One process holds many concurrent requests and streams:
+
+    redis       redis.asyncio, streams share one AsyncFanout per pattern
+    db          a pool of DB_POOL connections, queries run on as many
+                threads so they never block the loop
+    cache files stats and reads run on FILE_WORKERS threads
+
+Run it with an ASGI server, see asgi-start.sh.
+"""
+
+DB_POOL = 10      # Connections and query threads per process
+FILE_WORKERS = 8  # Threads for cache file reads per process
+
+conn = redis.asyncio.from_url(cfg.RQ_CONN)
+
+DB = None
+DB_EXECUTOR = ThreadPoolExecutor(DB_POOL)
+FILE_EXECUTOR = ThreadPoolExecutor(FILE_WORKERS)
+
+RESPONSE_CACHE = ResponseCache()
+FANOUTS = {}
+MARKETS_CACHE = {}
+
+class Request():
+    def __init__(self, scope):
+        self.path = scope['path']
+        self.args = {k: v[0] for k, v in
+            parse_qs(scope['query_string'].decode()).items()}
+        self.headers = {k.decode('latin-1'): v.decode('latin-1')
+            for k, v in scope['headers']}
+
+class Response():
+    def __init__(self, body=b'', status=200, headers=None, stream=None,
+        mimetype='application/json'):
+        self.body = body
+        self.status = status
+        self.headers = dict(headers or {})
+        self.headers['Content-Type'] = mimetype
+        self.stream = stream  # Async iterator of str chunks
+
+# As Flask's jsonify writes it
+def json_default(o):
+    if isinstance(o, datetime):
+        return format_date_time(calendar.timegm(o.utctimetuple()))
+    return str(o)
+
+def dumps(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':'),
+        default=json_default).encode() + b'\n'
+
+def jsonify(data, status=200):
+    return Response(dumps(data), status)
+
+def error(message):
+    return jsonify({'message': message}, 400)
+
+async def run_in(executor, fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, fn, *args)
+
+# The JSON body of fn(*args), built on a file thread
+async def read_json(fn, *args):
+    return await run_in(FILE_EXECUTOR, lambda: dumps(fn(*args)))
+
+# The JSON body of fn(*args), built on the loop
+async def build_json(fn, *args):
+    return dumps(fn(*args))
+
+async def query(sql, params=None):
+    def run():
+        global DB
+        if DB is None:
+            DB = create_engine(cfg.DB_CONN, pool_size=DB_POOL,
+                max_overflow=0)
+        return [dict(row) for row in DB.execute(sql, params or {})]
+    return await run_in(DB_EXECUTOR, run)
+
+# Cached response bodies as in app.py, build() is awaited for the body
+async def cached_json(req, key, version, build):
+    body, etag = RESPONSE_CACHE.lookup(key, version) \
+        or RESPONSE_CACHE.put(key, version, await build())
+    if etag_matches(req.headers.get('if-none-match'), etag):
+        return Response(status=304, headers={'ETag': etag})
+    return Response(body, headers={'ETag': etag})
+
+async def get_market(code):
+    if not MARKETS_CACHE:
+        for row in await query('SELECT id, code, name FROM market'):
+            MARKETS_CACHE[row['code']] = SimpleNamespace(**row)
+    return MARKETS_CACHE.get(code)
+
+async def get_ohlc(req, market, interval):
+    m = await get_market(market)
+    if not m:
+        return error('Invalid market')
+
+    if interval not in ohlc.INTERVALS:
+        return error('Invalid interval')
+
+    version = await run_in(FILE_EXECUTOR, ohlc.cache_version,
+        m.code, interval)
+    return await cached_json(req, ('ohlc', m.code, interval), version,
+        lambda: read_json(ohlc.OHLC(None).get_cached, m, interval))
+
+async def get_book(req, market):
+    m = await get_market(market)
+    if not m:
+        return error('Invalid market')
+
+    depth = marketdata.parse_depth(req.args.get('depth'))
+    if not depth:
+        return error('Invalid depth')
+
+    snapshot = None
+    if req.args.get('source') != 'sql':
+        snapshot = await conn.get(cfg.BOOK_KEY % m.code)
+
+    if snapshot is not None:
+        return await cached_json(req, ('book', m.code, depth), snapshot,
+            lambda: build_json(marketdata.snapshot_book, snapshot, depth))
+
+    async def build():
+        rows = await query(SQL['book'], {'market_id': m.id})
+        return dumps(marketdata.sql_book(rows, depth))
+
+    return await cached_json(req, ('book-sql', m.code, depth),
+        int(time.time() / marketdata.BOOK_TTL), build)
+
+async def get_last24(req, market):
+    m = None
+    if market != 'all':
+        m = await get_market(market)
+
+    if not m and market != 'all':
+        return error('Invalid market')
+
+    def version():
+        if m:
+            return file_version(cfg.CACHE_DIR / m.code / 'last24.json')
+        paths = sorted(cfg.CACHE_DIR.glob('*/last24.json'))
+        return (tuple(map(str, paths)), file_version(*paths))
+
+    return await cached_json(req, ('last24', market, None),
+        await run_in(FILE_EXECUTOR, version),
+        lambda: read_json(ohlc.OHLC(None).get_last24_cached, m))
+
+async def get_last_trades(req, market):
+    m = await get_market(market)
+    if not m:
+        return error('Invalid market')
+
+    last = await conn.get(cfg.LAST_TRADES_KEY % m.code)
+    if not last:
+        return jsonify([])
+    return await cached_json(req, ('last_trades', m.code, None), last,
+        lambda: build_json(marketdata.last_trades, last))
+
+async def get_balance(req):
+    account_id = req.args.get('account_id')
+    if not account_id:
+        return error('account_id parameter required')
+
+    return jsonify(await query(SQL['balance'], {'account_id': account_id}))
+
+async def get_wealth(req):
+    return jsonify(marketdata.wealth(await query(SQL['wealth'])))
+
+async def fanout(channel):
+    pattern = channel % '*'
+    if pattern not in FANOUTS:
+        fan = FANOUTS[pattern] = AsyncFanout(conn, pattern)
+        await fan.start()
+    return FANOUTS[pattern]
+
+# As app.stream_events
+async def stream_events(m, channel, key, event, empty, render):
+    fan = await fanout(channel)
+    channel = channel % m.code
+    q = fan.subscribe(channel)
+    state = SeqStream(event, render)
+
+    async def snapshot():
+        data = await conn.get(key % m.code)
+        return state.snapshot(unpack_snapshot(data, empty))
+
+    async def events():
+        try:
+            yield await snapshot()
+            while True:
+                try:
+                    data = await asyncio.wait_for(q.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                if data is None:
+                    return
+
+                out = state.update(msgpack.unpackb(data))
+                if out is False:
+                    out = await snapshot()
+                if out:
+                    yield out
+        finally:
+            fan.unsubscribe(channel, q)
+
+    return Response(stream=events(), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+async def stream_book(req, market):
+    m = await get_market(market)
+    if not m:
+        return error('Invalid market')
+
+    return await stream_events(m, cfg.DEPTH_CHANNEL, cfg.BOOK_KEY, 'update',
+        {'bids': [], 'asks': []}, lambda msg: msg)
+
+async def stream_trades(req, market):
+    m = await get_market(market)
+    if not m:
+        return error('Invalid market')
+
+    return await stream_events(m, cfg.TAPE_CHANNEL, cfg.LAST_TRADES_KEY,
+        'trades', {'trades': []}, marketdata.trades_event)
+
+ROUTES = [(re.compile(pattern), handler) for pattern, handler in (
+    (r'/api/(?P<market>[^/]+)/ohlc/(?P<interval>[^/]+)', get_ohlc),
+    (r'/api/(?P<market>[^/]+)/book', get_book),
+    (r'/api/(?P<market>[^/]+)/book/stream', stream_book),
+    (r'/api/(?P<market>[^/]+)/trades/stream', stream_trades),
+    (r'/api/(?P<market>[^/]+)/last24', get_last24),
+    (r'/api/(?P<market>[^/]+)/last_trades', get_last_trades),
+    (r'/api/balance', get_balance),
+    (r'/api/wealth', get_wealth),
+)]
+
+async def handle(req):
+    for pattern, handler in ROUTES:
+        match = pattern.fullmatch(req.path)
+        if match:
+            return await handler(req, **match.groupdict())
+    return jsonify({'message': 'Not found'}, 404)
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+# Stream chunks until the iterator ends or the client goes away
+async def send_stream(send, receive, stream):
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        while True:
+            chunk = asyncio.ensure_future(stream.__anext__())
+            await asyncio.wait((chunk, disconnected),
+                return_when=asyncio.FIRST_COMPLETED)
+            if not chunk.done():
+                # Gone, unwind the generator where it waits
+                chunk.cancel()
+                try:
+                    await chunk
+                except asyncio.CancelledError:
+                    pass
+                return
+            try:
+                data = chunk.result()
+            except StopAsyncIteration:
+                break
+            await send({'type': 'http.response.body',
+                'body': data.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        await stream.aclose()
+
+async def lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif msg['type'] == 'lifespan.shutdown':
+            for fan in FANOUTS.values():
+                await fan.close()
+            await conn.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    req = Request(scope)
+    if scope['method'] not in ('GET', 'HEAD'):
+        resp = jsonify({'message': 'Method not allowed'}, 405)
+    else:
+        resp = await handle(req)
+
+    await send({
+        'type': 'http.response.start',
+        'status': resp.status,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+            for k, v in resp.headers.items()],
+    })
+    if resp.stream is not None:
+        await send_stream(send, receive, resp.stream)
+    else:
+        await send({'type': 'http.response.body', 'body': resp.body})
@@ -0,0 +1,54 @@
+"""materialized balances
+
+Revision ID: 5c1f3a9e2b7d
+Revises: 290730c63670
+Create Date: 2026-10-17 21:40:12.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f3a9e2b7d'
+down_revision = '290730c63670'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('account_asset', sa.Column('opening', sa.DateTime(), nullable=True))
+    op.add_column('account_asset', sa.Column('ending', sa.DateTime(), nullable=True))
+    op.create_unique_constraint(None, 'account_asset', ['account_id', 'asset_id'])
+    op.create_table('market_price',
+        sa.Column('market_id', sa.Integer(), nullable=False),
+        sa.Column('price', sa.Numeric(precision=20, scale=10), nullable=True),
+        sa.Column('modified', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['market_id'], ['market.id'], ),
+        sa.PrimaryKeyConstraint('market_id')
+    )
+
+    # Backfill from the ledger and the last trade of each market
+    op.execute("""
+        INSERT INTO account_asset (account_id, asset_id, balance, opening, ending)
+        SELECT account_id, asset_id, SUM(amount), MIN(created), MAX(created)
+        FROM ledger
+        GROUP BY account_id, asset_id
+        ON CONFLICT (account_id, asset_id) DO UPDATE SET
+            balance = EXCLUDED.balance,
+            opening = EXCLUDED.opening,
+            ending = EXCLUDED.ending
+    """)
+    op.execute("""
+        INSERT INTO market_price (market_id, price, modified)
+        SELECT DISTINCT ON (market_id) market_id, price, created
+        FROM trade
+        ORDER BY market_id, id DESC
+    """)
+
+
+def downgrade():
+    op.drop_table('market_price')
+    op.drop_constraint('account_asset_account_id_asset_id_key', 'account_asset', type_='unique')
+    op.drop_column('account_asset', 'ending')
+    op.drop_column('account_asset', 'opening')
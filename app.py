@@ -1,28 +1,34 @@
 #!/usr/bin/env python
 
 import re
+import glob
 import json
 import time
+import queue
+import threading
 import shortuuid
 
 from sqlalchemy import create_engine, and_, or_, dialects, func, update
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session, joinedload, aliased
 
-from flask import Flask, Blueprint, request, jsonify
+from flask import Flask, Blueprint, Response, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 
 from marshmallow import Schema, fields, ValidationError, pre_load, validate
-from marshmallow import post_dump
+from marshmallow import post_dump, validates_schema, EXCLUDE
 
 import redis
+import msgpack
 from redis_queue import SimpleQueue
 
 import config as cfg
 from config import SQL, DT_FORMAT
 import model
-from lib import TradeFile
 import ohlc
+from respcache import ResponseCache, file_version, etag_matches
+from stream import Fanout, SeqStream, unpack_snapshot, KEEPALIVE
+import marketdata
 
 app = Flask(__name__, static_folder='build', static_url_path='/')
 
@@ -115,6 +121,41 @@ class ValidateEventBody():
 
         return body
 
+# Engine event payloads, as OrderBook.applyEvent reads them. Values are
+# strict ints so they pass lob.model's type checks, other keys are dropped.
+class OrderEventSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    account_id = fields.Int(required=True, strict=True)
+
+class AddOrderSchema(OrderEventSchema):
+    type = fields.Str(required=True,
+        validate=validate.OneOf(('limit','market')))
+    side = fields.Str(required=True, validate=validate.OneOf(('bid','ask')))
+    price = fields.Int(strict=True, validate=validate.Range(min=1))
+    qty = fields.Int(required=True, strict=True,
+        validate=validate.Range(min=1))
+
+    @validates_schema
+    def limit_price(self, data, **kwargs):
+        if data.get('type') == 'limit' and 'price' not in data:
+            raise ValidationError('Missing data for required field.', 'price')
+
+class CancelOrderSchema(OrderEventSchema):
+    order_id = fields.Int(required=True, strict=True)
+    side = fields.Str(validate=validate.OneOf(('bid','ask')))
+
+class AmendOrderSchema(CancelOrderSchema):
+    price = fields.Int(strict=True, validate=validate.Range(min=1))
+    qty = fields.Int(strict=True, validate=validate.Range(min=0))
+
+ORDER_EVENT_SCHEMAS = {
+    'add-order': AddOrderSchema(),
+    'cancel-order': CancelOrderSchema(),
+    'amend-order': AmendOrderSchema(),
+}
+
 class OrderSchema(Schema):
     id = fields.Int(dump_only=True)
 
@@ -189,6 +230,17 @@ ENTITY_SCHEMA = {
 }
 
 
+# Market data responses, rebuilt when their cache files change
+RESPONSE_CACHE = ResponseCache()
+
+def cached_json(key, version, build):
+    body, etag = RESPONSE_CACHE.get(key, version,
+        lambda: jsonify(build()).get_data())
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers={'ETag': etag})
+    return Response(body, mimetype='application/json',
+        headers={'ETag': etag})
+
 # No need to go to the db for this everytime.
 MARKETS_CACHE = {}
 def get_market(code):
@@ -209,23 +261,107 @@ def get_ohlc(market, interval):
     if interval not in ohlc.INTERVALS:
         return {"message": "Invalid interval"}, 400
 
-    result = ohlc.OHLC(db.session).get_cached(m, interval)
-    return jsonify(result)
+    return cached_json(('ohlc', m.code, interval),
+        ohlc.cache_version(m.code, interval),
+        lambda: ohlc.OHLC(db.session).get_cached(m, interval))
 
+# Top depth levels of each side (default and max BOOK_DEPTH). Served from
+# the snapshot the matching engine writes after each flush. source=sql,
+# or a market whose engine hasn't flushed yet, aggregates the order table.
 @app.route('/api/<string:market>/book', methods=["GET"])
 def get_book(market):
     m = get_market(market)
     if not m:
         return {"message": "Invalid market"}, 400
 
-    sql = SQL['book']
-    rs = db.engine.execute(sql, {'market_id': m.id,})
+    depth = marketdata.parse_depth(request.args.get('depth'))
+    if not depth:
+        return {"message": "Invalid depth"}, 400
+
+    snapshot = None
+    if request.args.get('source') != 'sql':
+        snapshot = conn.get(cfg.BOOK_KEY % m.code)
+
+    if snapshot is not None:
+        return cached_json(('book', m.code, depth), snapshot,
+            lambda: marketdata.snapshot_book(snapshot, depth))
+
+    def build():
+        sql = SQL['book']
+        rs = db.engine.execute(sql, {'market_id': m.id,})
+        return marketdata.sql_book(rs, depth)
+
+    return cached_json(('book-sql', m.code, depth),
+        int(time.time() / marketdata.BOOK_TTL), build)
+
+# Streams over redis pub/sub, one fan-out per process and channel pattern
+FANOUTS = {}
+FANOUTS_LOCK = threading.Lock()  # Request threads race to create them
+
+def fanout(channel):
+    pattern = channel % '*'
+    with FANOUTS_LOCK:
+        if pattern not in FANOUTS:
+            FANOUTS[pattern] = Fanout(conn, pattern)
+        return FANOUTS[pattern]
+
+# Server-sent events for a market's channel: the snapshot under key, then
+# the messages published on channel (see stream.SeqStream). The stream
+# ends when the client falls too far behind, reconnecting resyncs.
+def stream_events(m, channel, key, event, empty, render):
+    fan = fanout(channel)
+    channel = channel % m.code
+    q = fan.subscribe(channel)
+    state = SeqStream(event, render)
+
+    def snapshot():
+        return state.snapshot(unpack_snapshot(conn.get(key % m.code), empty))
+
+    def events():
+        try:
+            yield snapshot()
+            while True:
+                try:
+                    data = q.get(timeout=KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if data is None:
+                    return
+
+                out = state.update(msgpack.unpackb(data))
+                if out is False:
+                    out = snapshot()
+                if out:
+                    yield out
+        finally:
+            fan.unsubscribe(channel, q)
+
+    return Response(events(), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Book depth as server-sent events. The snapshot is
+# {'seq', 'bids': [[price, volume]..], 'asks'}, each update holds the levels
+# an engine flush changed (volume 0 when removed).
+@app.route('/api/<string:market>/book/stream', methods=["GET"])
+def stream_book(market):
+    m = get_market(market)
+    if not m:
+        return {"message": "Invalid market"}, 400
 
-    result = []
-    for row in rs:
-        result.append(dict(row))
+    return stream_events(m, cfg.DEPTH_CHANNEL, cfg.BOOK_KEY, 'update',
+        {'bids': [], 'asks': []}, lambda msg: msg)
 
-    return jsonify(result)
+# Trades as server-sent events, the last LAST_TRADES first then each batch
+# the engine flushes, as {'seq', 'trades': [..]}.
+@app.route('/api/<string:market>/trades/stream', methods=["GET"])
+def stream_trades(market):
+    m = get_market(market)
+    if not m:
+        return {"message": "Invalid market"}, 400
+
+    return stream_events(m, cfg.TAPE_CHANNEL, cfg.LAST_TRADES_KEY, 'trades',
+        {'trades': []}, marketdata.trades_event)
 
 @app.route('/api/<string:market>/last24', methods=["GET"])
 def get_last24(market):
@@ -236,8 +372,14 @@ def get_last24(market):
     if not m and market != 'all':
         return {"message": "Invalid market"}, 400
 
-    result = ohlc.OHLC(db.session).get_last24_cached(m)
-    return jsonify(result)
+    if m:
+        version = file_version(cfg.CACHE_DIR / m.code / 'last24.json')
+    else:
+        paths = sorted(glob.glob(str(cfg.CACHE_DIR / '*/last24.json')))
+        version = (tuple(paths), file_version(*paths))
+
+    return cached_json(('last24', market, None), version,
+        lambda: ohlc.OHLC(db.session).get_last24_cached(m))
 
 @app.route('/api/<string:market>/last_trades', methods=["GET"])
 def get_last_trades(market):
@@ -245,8 +387,12 @@ def get_last_trades(market):
     if not m:
         return {"message": "Invalid market"}, 400
 
-    result = TradeFile().get(m)
-    return jsonify(result)
+    # The engine's ring buffer of its last trades
+    last = conn.get(cfg.LAST_TRADES_KEY % m.code)
+    if not last:
+        return jsonify([])
+    return cached_json(('last_trades', m.code, None), last,
+        lambda: marketdata.last_trades(last))
 
 # Get account balance
 @app.route('/api/balance', methods=["GET"])
@@ -265,35 +411,12 @@ def get_balance():
 
     return jsonify(result)
 
-def get_gini(data):
-    N = len(data)
-
-    prod = 0
-    total = 0
-
-    for i, amt in enumerate(data):
-        prod = prod + ((i+1)*amt)
-        total = total + amt
-
-    u = total/N
-    return (N+1.0)/(N-1.0) - (prod/(N*(N-1.0)*u))*2.0
-
 # Wealth distribution
 @app.route('/api/wealth', methods=["GET"])
 def get_wealth():
     sql = SQL['wealth']
     rs = db.engine.execute(sql)
-
-    result = []
-    for row in rs:
-        result.append(dict(row))
-
-    gini = get_gini([i['amount'] for i in result])
-
-    return jsonify({
-        'gini': gini,
-        'results': result
-    })
+    return jsonify(marketdata.wealth(rs))
 
 
 # Get one
@@ -388,9 +511,11 @@ All: account_id
 /api/add-order
     market,type,side,price,qty
 /api/cancel-order
-    market,uuid
+    market,order_id
 /api/amend-order
-    market,uuid,price,qty
+    market,order_id,price,qty
+
+Order events are validated with ORDER_EVENT_SCHEMAS.
 /api/withdraw
     asset,amount
 /api/deposit
@@ -398,7 +523,7 @@ All: account_id
 """
 @app.route("/api/priv/<string:method>", methods=["POST"])
 def create_event(method):
-    methods = ('add-order','cancel-order','withdraw','deposit')
+    methods = ('add-order','cancel-order','amend-order','withdraw','deposit')
     if method not in methods:
         return {"message": "Invalid method"}, 400
     
@@ -422,11 +547,18 @@ def create_event(method):
     except ValidationError as err:
         return err.messages, 422
     """
-    data = json_data
-    m = get_market(data['market'])
+    m = get_market(json_data.get('market'))
     if not m:
         return {"message": "Invalid market"}, 400
 
+    data = json_data
+    if method in ORDER_EVENT_SCHEMAS:
+        try:
+            data = ORDER_EVENT_SCHEMAS[method].load(json_data)
+        except ValidationError as err:
+            return err.messages, 422
+        data['market'] = m.code
+
     #return {"market.code": m.code}
 
     # Account balance validation (withdraw, 
@@ -454,6 +586,70 @@ def create_event(method):
     return {"message": "Event queued.", "event": data}
 
 
+"""
+/api/priv/batch
+    market,events[{method,..}..]
+
+Order events for one market in a single request. Ids are allocated in
+one sequence call and the events are queued as one message, in order.
+"""
+BATCH_METHODS = ('add-order','cancel-order','amend-order')
+BATCH_MAX = 1000
+
+@app.route("/api/priv/batch", methods=["POST"])
+def create_batch():
+    json_data = request.get_json()
+    if not json_data:
+        return {"message": "No input data provided"}, 400
+
+    m = get_market(json_data.get('market'))
+    if not m:
+        return {"message": "Invalid market"}, 400
+
+    events = json_data.get('events')
+    if not events or type(events) != list:
+        return {"message": "No events provided"}, 400
+    if len(events) > BATCH_MAX:
+        return {"message": "Too many events. Max is %d." % BATCH_MAX}, 400
+    for e in events:
+        if type(e) != dict or e.get('method') not in BATCH_METHODS:
+            return {"message": "Invalid method"}, 400
+
+    # Checked as the single event endpoint does, errors by event index
+    loaded = []
+    errors = {}
+    for i, e in enumerate(events):
+        try:
+            loaded.append(ORDER_EVENT_SCHEMAS[e['method']].load(e))
+        except ValidationError as err:
+            errors[i] = err.messages
+    if errors:
+        return {"events": errors}, 422
+
+    with db.engine.connect() as con:
+        rs = con.execute(
+            "SELECT nextval('order_id_seq') FROM generate_series(1, %(n)s)",
+            {'n': len(events)}
+        )
+        ids = [row[0] for row in rs]
+
+    tasks = []
+    for e, data, id_num in zip(events, loaded, ids):
+        method = e['method']
+        data['market'] = m.code
+        data['uuid'] = shortuuid.uuid()
+        data['id'] = id_num
+        tasks.append((method, data))
+
+    q = SimpleQueue(conn, m.code)
+    job = q.enqueue_batch(tasks)
+
+    return {
+        "message": "Batch queued.",
+        "events": [dict(data, method=method) for method, data in tasks]
+    }
+
+
 # Create
 #@app.route("/api/<string:entity>", methods=["POST"])
 def create_entity(entity):
@@ -0,0 +1,23 @@
+#!/bin/bash
+
+NAME="mockex-async"
+#DIR=/home/eric/apps/forklift # project dir
+DIR=/home/eric/Work/mock-exchange/mock-exchange
+USER=eric # run as
+GROUP=eric # run as webapps
+NUM_WORKERS=2 # Each holds many clients, see aioapp.py
+
+echo "Starting $NAME as `whoami`"
+
+# Activate the virtual environment
+cd $DIR
+source venv/bin/activate
+
+# The read endpoints of app.py on asyncio workers, next to gunicorn-start.sh
+exec gunicorn aioapp:app \
+  --name $NAME \
+  --workers $NUM_WORKERS \
+  --worker-class uvicorn.workers.UvicornWorker \
+  --user=$USER \
+  --bind 127.0.7.20:5001
+# --log-level=debug \
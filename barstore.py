@@ -0,0 +1,113 @@
+import os
+import struct
+
+import numpy as np
+
+"""
+Columnar OHLC bar store
+
+One append-only file per market and interval, cache/<market>/bars/<interval>.
+A 16 byte header is followed by fixed width records in time order:
+
+    header  magic(4) version(u16) record size(u16) reserved(8)
+    record  time(int64) open high low close volume(float64), little endian
+
+Empty bars have open 0. Reads memory map the file and find a time range
+with a binary search on the time column. A torn record at the end of the
+file (crash mid-append) is ignored by reads and truncated by the next
+append.
+"""
+
+MAGIC = b'MXBR'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHH8x')
+
+BAR_KEYS = ('time', 'open', 'high', 'low', 'close', 'volume')
+BAR_DTYPE = np.dtype([('time', '<i8')] + [(k, '<f8') for k in BAR_KEYS[1:]])
+
+DT_SUFFIX = 'Z' # numpy datetime64 strings are DT_FORMAT without the Z
+
+def number(x):
+    return int(x) if x.is_integer() else x
+
+class BarStore():
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def read(self):
+        """Memory map the whole store as a BAR_DTYPE array."""
+        if not self.exists():
+            return np.zeros(0, dtype=BAR_DTYPE)
+        with open(self.path, 'rb') as f:
+            magic, version, size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or size != BAR_DTYPE.itemsize:
+            raise Exception('Unsupported bar store %s' % self.path)
+
+        count = (os.path.getsize(self.path) - HEADER.size) // size
+        if not count:
+            return np.zeros(0, dtype=BAR_DTYPE)
+        return np.memmap(self.path, dtype=BAR_DTYPE, mode='r',
+            offset=HEADER.size, shape=(count,))
+
+    def range(self, start, end):
+        """Bars with start <= time <= end, times in epoch seconds."""
+        bars = self.read()
+        times = bars['time']
+        lo = np.searchsorted(times, start, 'left')
+        hi = np.searchsorted(times, end, 'right')
+        return bars[lo:hi]
+
+    def last_time(self):
+        bars = self.read()
+        return int(bars['time'][-1]) if len(bars) else None
+
+    def append(self, bars):
+        """Append a BAR_DTYPE array, skipping bars not after the last."""
+        bars = np.asarray(bars, dtype=BAR_DTYPE)
+        last = self.last_time()
+        if last is not None:
+            bars = bars[bars['time'] > last]
+
+        if not self.exists():
+            to_dir = os.path.dirname(self.path)
+            if not os.path.exists(to_dir):
+                os.makedirs(to_dir)
+            with open(self.path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, BAR_DTYPE.itemsize))
+
+        with open(self.path, 'r+b') as f:
+            # Drop a torn record
+            count = (os.path.getsize(self.path) - HEADER.size) \
+                // BAR_DTYPE.itemsize
+            f.truncate(HEADER.size + count * BAR_DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(bars.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return len(bars)
+
+def bars_from_rows(rows):
+    """BAR_DTYPE array from ohlc row dicts."""
+    bars = np.zeros(len(rows), dtype=BAR_DTYPE)
+    for k in BAR_KEYS:
+        bars[k] = [r.get(k, 0) for r in rows]
+    return bars
+
+def rows_from_bars(bars):
+    """ohlc row dicts, as the JSONL pages hold them."""
+    dts = bars['time'].astype('datetime64[s]').astype(str)
+    rows = []
+    for dt, (time, o, h, l, c, v) in zip(dts.tolist(), bars.tolist()):
+        row = {'dt': dt + DT_SUFFIX, 'time': time}
+        if o:
+            row['open'] = number(o)
+            row['high'] = number(h)
+            row['low'] = number(l)
+            row['close'] = number(c)
+            row['volume'] = row['value'] = number(v)
+        rows.append(row)
+    return rows
@@ -21,6 +21,36 @@ RQ_CONN = 'redis://'
 
 LOB_LMDB_NAME = 'orderbook'
 LOB_LMDB_SIZE = (1024**2) * 400 # 400MB
+LOB_LMDB_DBS  = 4 # bids, asks, ids, meta
+
+# Orders of a book side held in memory, see lob.orderlist.ORDERS_SIZE. The
+# window adapts to how deep orders walk the book, between LOB_WINDOW_MIN
+# orders and what fits in LOB_WINDOW_BYTES.
+LOB_WINDOW_MIN = 1000
+LOB_WINDOW_BYTES = 64 * 1024**2 # 64MB per side
+
+# Published by the engine when a trade tape file is written
+TRADES_CHANNEL = '%s:trades'
+
+# Top of book snapshot written by the engine after each flush, msgpack
+# {'seq': n, 'bids': [[price, volume]..], 'asks': [..]} holding BOOK_DEPTH
+# levels. The levels that changed are published on DEPTH_CHANNEL with the
+# same seq, volume 0 for a level that left the book.
+BOOK_KEY = '%s:book'
+BOOK_DEPTH = 100
+DEPTH_CHANNEL = '%s:depth'
+
+# The engine's last LAST_TRADES trades, msgpack {'seq': n, 'trades':
+# [[time, price, qty, taker_side]..]} oldest first. Each flushed batch is
+# published on TAPE_CHANNEL as {'seq': n, 'trades': [..]}.
+LAST_TRADES_KEY = '%s:last_trades'
+LAST_TRADES = 30
+TAPE_CHANNEL = '%s:tape'
+
+# Ids of the orders and amends the engine's balance checks rejected, and
+# of cancels and amends of another account's order, msgpack [id..]
+# published after each flush
+REJECTS_CHANNEL = '%s:rejects'
 
 # Init dirs
 for d in ALL_DIRS:
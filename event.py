@@ -0,0 +1,391 @@
+import os
+import multiprocessing
+from collections import deque
+from time import time, sleep
+
+import redis
+import lmdb
+import msgpack
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+import config as cfg
+from lob.orderbook import OrderBook
+from lob.orderlist import ORDER_BYTES
+from lob.journal import Journal
+from lob.risk import Balances, MarketRisk
+from model import Market, FeeSchedule
+from redis_queue import SimpleQueue
+from stats import Stats, StatsExporter
+
+DEQUEUE_MAX = 500 # Messages per redis round trip
+WAIT_POLL = 0.01  # Seconds between queue length checks, see MarketSupervisor
+
+# Levels of a depth snapshot that differ from the previous one
+def depth_changes(old, new):
+    changes = {}
+    for side in ('bids', 'asks'):
+        before = dict(old[side]) if old else {}
+        after = dict(new[side])
+        changes[side] = [[p, q] for p, q in new[side] if before.get(p) != q] \
+            + [[p, 0] for p in before if p not in after]
+    return changes
+
+class EventRunner():
+    """
+    Drain a market queue into its order book.
+
+    Messages are dequeued up to DEQUEUE_MAX at a time. With reliable=True
+    they stay in the queue's processing list until they are durable, and
+    messages left there by a crash are requeued on start.
+
+    With journal=True every message is written to the journal before it
+    is applied, and durable means fsynced to the journal. Otherwise it
+    means flushed to lmdb. On start the journal is replayed on top of
+    lmdb.
+
+    With risk=True orders are checked against account balances before
+    they match (see lob.risk). balances is the Balances to check against,
+    markets sharing a process share one.
+    """
+    def __init__(self, session, market, book='order', dequeue=DEQUEUE_MAX,
+        reliable=False, journal=False, conn=None, risk=False, balances=None):
+
+        if type(market) == str:
+            market = session.query(Market).filter_by(code=market).one()
+
+        self.session = session
+        self.market = market
+        self.dequeue = dequeue
+        self.reliable = reliable
+
+        self.journal = None
+        if journal:
+            self.journal = Journal(cfg.CACHE_DIR / market.code / 'journal')
+
+        market_dir = cfg.CACHE_DIR / market.code
+        if not os.path.exists(market_dir):
+            os.makedirs(market_dir)
+
+        trades_dir = market_dir / 'trades'
+        db_path = str(market_dir / cfg.LOB_LMDB_NAME)
+        self.env = lmdb.open(db_path, max_dbs=cfg.LOB_LMDB_DBS,
+            map_size=cfg.LOB_LMDB_SIZE)
+        market_risk = None
+        if risk:
+            market_risk = self.market_risk(balances or Balances())
+        self.lob = OrderBook(self.env, trades_dir, book=book,
+            journal=self.journal, depth=cfg.BOOK_DEPTH, risk=market_risk,
+            stats=Stats(labels={'market': market.code}, dump=False),
+            window=(cfg.LOB_WINDOW_MIN, cfg.LOB_WINDOW_BYTES // ORDER_BYTES))
+
+        # Requeued messages that made it into the journal are skipped
+        self.replayed = self.lob.recover()
+        if self.replayed:
+            print('Replayed %d journaled messages.' % len(self.replayed))
+
+        self.order_cnt = 0
+        self.trade_cnt = 0
+        self.ttime = 0
+
+        self.r = conn or redis.from_url(cfg.RQ_CONN)
+
+        # Last published book snapshot, its seq carries on across restarts
+        self.depth = None
+        self.depth_seq = 0
+        snapshot = self.r.get(cfg.BOOK_KEY % market.code)
+        if snapshot:
+            self.depth = msgpack.unpackb(snapshot)
+            self.depth_seq = self.depth.pop('seq', 0)
+
+        # Ring buffer of the last trades, also carried on across restarts
+        self.last_trades = deque(maxlen=cfg.LAST_TRADES)
+        self.trades_seq = 0
+        last = self.r.get(cfg.LAST_TRADES_KEY % market.code)
+        if last:
+            last = msgpack.unpackb(last)
+            self.last_trades.extend(last['trades'])
+            self.trades_seq = last['seq']
+        self.queue = SimpleQueue(self.r, market.code)
+        if self.reliable:
+            cnt = self.queue.recover()
+            if cnt:
+                print('Requeued %d unacknowledged messages.' % cnt)
+
+    # Balances of the market's assets, loaded once per Balances, and the
+    # fees trades2db charges at zero volume.
+    def market_risk(self, balances):
+        m = self.market
+        assets = [a for a in (m.asset1, m.asset2) if a not in balances.loaded]
+        if assets:
+            balances.load(self.session.execute(
+                'SELECT account_id, asset_id, balance FROM account_asset '
+                'WHERE asset_id = ANY(:assets)', {'assets': assets}))
+            balances.loaded.update(assets)
+
+        fee = self.session.query(FeeSchedule).filter_by(type='trade') \
+            .order_by(FeeSchedule.volume.asc()).first()
+        return MarketRisk(balances, m.asset1, m.asset2,
+            fee.maker if fee else 0, fee.taker if fee else 0)
+
+    def run(self):
+        while self.run_once():
+            pass
+        self.check_flush()
+        self.report()
+
+    # Process one chunk of messages, dequeueing it unless given. Returns
+    # False once the queue is empty.
+    def run_once(self, tasks=None):
+        if tasks is None:
+            tasks = self.queue.dequeue_many(self.dequeue,
+                processing=self.reliable)
+        if not tasks:
+            self.replayed = set()
+            return False
+
+        lob = self.lob
+        start = time()
+
+        for idnum, method, payload in tasks:
+            if idnum in self.replayed:
+                continue
+            orders, trades = lob.processEvent(method, payload, idnum)
+            self.order_cnt += orders
+            self.trade_cnt += len(trades)
+
+        self.check_flush()
+
+        self.ttime += time() - start
+        return True
+
+    # Block up to timeout seconds for messages, then process them.
+    def wait(self, timeout):
+        tasks = self.queue.dequeue_many(self.dequeue, timeout,
+            processing=self.reliable)
+        if not tasks:
+            return False
+        return self.run_once(tasks)
+
+    # Time based flushes need checking while idle too
+    def check_flush(self):
+        tape = self.lob.tape
+        flushed = self.lob.check_flush()
+        if flushed:
+            self.publish_depth()
+            self.publish_rejects()
+        if flushed and tape:
+            self.notify(tape)
+        if self.reliable:
+            self.ack(flushed)
+        elif self.journal:
+            self.journal.sync()
+
+    def report(self):
+        if not self.ttime:
+            return
+        self.lob.dump_history()
+        print('%s orders: %-8d trades: %-8d time: %.2f ms   orders/sec:%-8d' % (
+            self.market.code, self.order_cnt, self.trade_cnt,
+            self.ttime * 1000, self.order_cnt / self.ttime))
+        self.order_cnt = 0
+        self.trade_cnt = 0
+        self.ttime = 0
+
+    # Only ack once everything dequeued so far is durable.
+    def ack(self, flushed):
+        if self.journal:
+            self.journal.sync()
+        elif not flushed:
+            return
+        self.queue.ack()
+
+    def flush(self):
+        tape = self.lob.tape
+        self.lob.flush()
+        self.publish_depth()
+        self.publish_rejects()
+        if tape:
+            self.notify(tape)
+        if self.journal:
+            self.journal.close()
+        if self.reliable:
+            self.queue.ack()
+
+    # Book snapshot and the levels that changed since the last one, for the
+    # api. Nothing is written when the book didn't change.
+    def publish_depth(self):
+        depth = self.lob.depth
+        changes = depth_changes(self.depth, depth)
+        if self.depth and not changes['bids'] and not changes['asks']:
+            return
+
+        self.depth_seq += 1
+        changes['seq'] = self.depth_seq
+        pipe = self.r.pipeline()
+        pipe.set(cfg.BOOK_KEY % self.market.code,
+            msgpack.packb(dict(depth, seq=self.depth_seq)))
+        pipe.publish(cfg.DEPTH_CHANNEL % self.market.code,
+            msgpack.packb(changes))
+        pipe.execute()
+        self.depth = depth
+
+    def publish_rejects(self):
+        rejected = self.lob.rejected
+        if not rejected:
+            return
+        self.r.publish(cfg.REJECTS_CHANNEL % self.market.code,
+            msgpack.packb(rejected))
+        self.lob.rejected = []
+
+    # A flushed tape: wake trades2db, the file is ready, and hand the
+    # trades to the api's last trades and trade stream.
+    def notify(self, tape):
+        code = self.market.code
+        trades = [[t['time'], t['price'], t['qty'], t['taker_side']]
+            for t in tape]
+        self.last_trades.extend(trades)
+        self.trades_seq += 1
+
+        pipe = self.r.pipeline()
+        pipe.publish(cfg.TRADES_CHANNEL % code, len(trades))
+        pipe.set(cfg.LAST_TRADES_KEY % code, msgpack.packb({
+            'seq': self.trades_seq, 'trades': list(self.last_trades)}))
+        pipe.publish(cfg.TAPE_CHANNEL % code, msgpack.packb({
+            'seq': self.trades_seq, 'trades': trades}))
+        pipe.execute()
+
+
+class MarketSupervisor():
+    """
+    Host the order books of many markets in one process.
+
+    Each market keeps its own EventRunner and lmdb environment. Queues
+    with messages are found with one pipelined LLEN per round and drained
+    a chunk at a time in turn, so a busy market can't starve the rest.
+    When every queue is empty, wait() blocks on all of them with one
+    BRPOP. With risk=True the markets check orders against one Balances.
+
+    Reliable messages may only leave a queue for its processing list, and
+    BRPOPLPUSH takes one queue. So a single reliable market blocks on its
+    own queue, and several are polled every WAIT_POLL seconds.
+    """
+    def __init__(self, session, markets, **kwargs):
+        self.r = redis.from_url(cfg.RQ_CONN)
+        self.reliable = kwargs.get('reliable', False)
+        if kwargs.get('risk'):
+            kwargs['balances'] = Balances()
+        self.runners = {}  # queue name -> EventRunner
+        for m in markets:
+            runner = EventRunner(session, m, conn=self.r, **kwargs)
+            self.runners[runner.queue.name] = runner
+
+    def run(self):
+        active = set()
+        while True:
+            pipe = self.r.pipeline(transaction=False)
+            for name in self.runners:
+                pipe.llen(name)
+            ready = [
+                runner for runner, cnt in
+                zip(self.runners.values(), pipe.execute()) if cnt
+            ]
+            for runner in ready:
+                runner.run_once()
+                active.add(runner)
+            # Idle markets flush on time while the busy ones drain
+            for runner in self.runners.values():
+                if runner not in ready:
+                    runner.check_flush()
+            if not ready:
+                break
+
+        for runner in active:
+            runner.report()
+
+    # Block up to timeout seconds (0 is forever) for a message on any
+    # market. Polled reliable queues are left for run() to drain.
+    def wait(self, timeout):
+        if self.reliable and len(self.runners) == 1:
+            runner, = self.runners.values()
+            return runner.wait(timeout)
+        if self.reliable:
+            return self.poll(timeout)
+
+        r = self.r.brpop(list(self.runners), timeout)
+        if not r:
+            return False
+
+        name, msg = r
+        self.runners[name.decode()].run_once([msgpack.unpackb(msg)])
+        return True
+
+    def poll(self, timeout):
+        deadline = time() + timeout if timeout else None
+        while True:
+            pipe = self.r.pipeline(transaction=False)
+            for name in self.runners:
+                pipe.llen(name)
+            if any(pipe.execute()):
+                return True
+            if deadline is not None and time() >= deadline:
+                return False
+            sleep(WAIT_POLL)
+
+    def flush(self):
+        for runner in self.runners.values():
+            runner.flush()
+
+
+# With stats_port and/or stats_file the books' stats are exported in the
+# Prometheus text format, see stats.StatsExporter.
+def run_markets(session, markets, daemon=None, stats_port=None,
+    stats_file=None, **kwargs):
+    supervisor = MarketSupervisor(session, markets, **kwargs)
+    exporter = None
+    if stats_port is not None or stats_file is not None:
+        exporter = StatsExporter(lambda: [
+            runner.lob.stats for runner in supervisor.runners.values()
+        ], stats_port, stats_file)
+    try:
+        while True:
+            supervisor.run()
+            if not daemon:
+                supervisor.flush()
+                break
+            supervisor.wait(daemon)
+    finally:
+        if exporter:
+            exporter.close()
+
+# Process pool entry point. Each worker gets its own db session, redis
+# connection and lmdb environments, and is pinned to one core. Stats are
+# exported on stats_port + worker and to stats_file-<worker>.
+def run_shard(worker, codes, daemon=None, stats_port=None, stats_file=None,
+    **kwargs):
+    # One of the cores the pool was allowed
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[worker % len(cpus)]})
+
+    if stats_port is not None:
+        stats_port += worker
+    if stats_file is not None:
+        root, ext = os.path.splitext(stats_file)
+        stats_file = '%s-%d%s' % (root, worker, ext)
+
+    session = Session(create_engine(cfg.DB_CONN))
+    run_markets(session, codes, daemon, stats_port, stats_file, **kwargs)
+
+def run_pool(codes, workers, daemon=None, **kwargs):
+    codes = sorted(codes)
+    ctx = multiprocessing.get_context('fork')
+    procs = []
+    for i in range(min(workers, len(codes))):
+        p = ctx.Process(target=run_shard,
+            args=(i, codes[i::workers], daemon), kwargs=kwargs)
+        p.start()
+        procs.append(p)
+
+    for p in procs:
+        p.join()
@@ -6,6 +6,7 @@ DIR=/home/eric/Work/mock-exchange/mock-exchange
 USER=eric # run as
 GROUP=eric # run as webapps
 NUM_WORKERS=5
+NUM_THREADS=500 # Each streaming client holds a thread
 
 echo "Starting $NAME as `whoami`"
 
@@ -17,6 +18,8 @@ source venv/bin/activate
 exec gunicorn app:app \
   --name $NAME \
   --workers $NUM_WORKERS \
+  --worker-class gthread \
+  --threads $NUM_THREADS \
   --user=$USER \
   --bind 127.0.7.20:5000
 # --log-level=debug \
@@ -0,0 +1,453 @@
+import os
+import sys
+import random
+import shutil
+import tempfile
+import tracemalloc
+from array import array
+from pathlib import Path
+from time import perf_counter_ns
+
+import lmdb
+import numpy as np
+
+from .model import Quote, Order, Trade
+from .orderbook import OrderBook
+
+"""
+Matching engine microbenchmarks
+
+Synthetic order flows are applied to an OrderBook on a scratch lmdb env,
+the way EventRunner applies dequeued messages: applyEvent() per message
+and a flush check after every CHUNK of them. No redis, no db.
+
+Flows are deterministic for a seed. Each is a setup (messages applied
+before measuring, e.g. a resting book) and the measured messages:
+
+    poisson         zero intelligence flow, limit, market and cancel
+                    arrivals from competing Poisson processes
+    mean_reverting  limit orders around an Ornstein-Uhlenbeck mid, so
+                    the book is crossed from both sides as it moves
+    deep            small orders and cancels on top of a deep passive book
+    sweep           large orders eating through many levels, between
+                    passive orders that refill them
+    market_maker    quotes cancelled and replaced or amended, most
+                    messages never trade
+
+run() reports throughput, per message latency percentiles, flush times,
+bytes written to lmdb and to tapes, net allocated memory blocks and the
+book's stats counters (refills, rows decoded, evictions..).
+With allocs=True the flow is run again under tracemalloc for peak and
+retained bytes; it's a separate pass as tracing skews the timings.
+
+cold_start() times a restart instead: opening an OrderBook on a count
+order book that build_book() writes straight into lmdb, and its first
+market order.
+
+construction() is the cost of one lob.model object, through the checked
+constructor and the generated make().
+"""
+
+CHUNK = 500           # Messages per flush check, as event.DEQUEUE_MAX
+MAP_SIZE = 1024 ** 3  # Scratch lmdb map size
+COLD_MAP_SIZE = 16 * 1024 ** 3  # For cold start books, sparse
+MID = 10000           # Starting mid price
+PERCENTILES = (50, 90, 99, 99.9)
+
+class Flow():
+    """Message builder with order ids and the ids that may still rest."""
+    def __init__(self, seed=1):
+        self.rnd = random.Random(seed)
+        self.next_id = 1
+        self.live = []
+        self.accounts = {}  # order id -> account_id
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def limit(self, side, price, qty, account_id=1):
+        order_id = self.new_id()
+        self.live.append(order_id)
+        self.accounts[order_id] = account_id
+        return ('add-order', {'id': order_id, 'type': 'limit',
+            'side': side, 'price': max(price, 1), 'qty': qty,
+            'account_id': account_id})
+
+    def market(self, side, qty, account_id=1):
+        return ('add-order', {'id': self.new_id(), 'type': 'market',
+            'side': side, 'qty': qty, 'account_id': account_id})
+
+    # Of a random live id, which may have traded away since
+    def pick(self):
+        live = self.live
+        i = self.rnd.randrange(len(live))
+        live[i], live[-1] = live[-1], live[i]
+        return live.pop()
+
+    def cancel(self, order_id=None):
+        if order_id is None:
+            order_id = self.pick()
+        return ('cancel-order', {'id': self.new_id(), 'order_id': order_id,
+            'account_id': self.accounts[order_id]})
+
+    def amend(self, order_id, **update):
+        amend_id = self.new_id()
+        self.live.append(amend_id)
+        account_id = self.accounts[amend_id] = self.accounts[order_id]
+        return ('amend-order', dict(update, id=amend_id, order_id=order_id,
+            account_id=account_id))
+
+# levels price levels of per orders each side, best at MID -/+ 1
+def passive_book(f, levels, per):
+    msgs = []
+    for i in range(levels):
+        for j in range(per):
+            qty = f.rnd.randint(1, 20)
+            msgs.append(f.limit('bid', MID - 1 - i, qty, 1))
+            msgs.append(f.limit('ask', MID + 1 + i, qty, 2))
+    return msgs
+
+def poisson_flow(f, count, limit_rate=0.5, market_rate=0.1, cancel_rate=0.4,
+    band=50):
+    rnd = f.rnd
+    total = limit_rate + market_rate + cancel_rate
+    msgs = []
+    for i in range(count):
+        side = rnd.choice(('bid', 'ask'))
+        r = rnd.random() * total
+        if r < cancel_rate and f.live:
+            msgs.append(f.cancel())
+        elif r < cancel_rate + market_rate:
+            msgs.append(f.market(side, rnd.randint(1, 20),
+                rnd.randint(1, 100)))
+        else:
+            # Uniform over the band on its side, the inner tenth crosses
+            offset = rnd.randint(-band // 10, band)
+            price = MID - offset if side == 'bid' else MID + offset
+            msgs.append(f.limit(side, price, rnd.randint(1, 20),
+                rnd.randint(1, 100)))
+    return [], msgs
+
+def mean_reverting_flow(f, count, theta=0.05, sigma=3.0, spread=10,
+    cancels=0.2):
+    rnd = f.rnd
+    x = MID
+    msgs = []
+    for i in range(count):
+        x += theta * (MID - x) + rnd.gauss(0, sigma)
+        if f.live and rnd.random() < cancels:
+            msgs.append(f.cancel())
+            continue
+        side = rnd.choice(('bid', 'ask'))
+        offset = rnd.randint(-spread // 2, spread)
+        price = round(x) - offset if side == 'bid' else round(x) + offset
+        msgs.append(f.limit(side, price, rnd.randint(1, 20),
+            rnd.randint(1, 100)))
+    return [], msgs
+
+def deep_flow(f, count, levels=1000, cancels=0.3, markets=0.05):
+    rnd = f.rnd
+    setup = passive_book(f, levels, max(count // levels // 2, 1))
+    msgs = []
+    for i in range(count):
+        side = rnd.choice(('bid', 'ask'))
+        r = rnd.random()
+        if r < cancels:
+            msgs.append(f.cancel())
+        elif r < cancels + markets:
+            msgs.append(f.market(side, rnd.randint(1, 10), 3))
+        else:
+            offset = rnd.randint(1, 5)
+            price = MID - offset if side == 'bid' else MID + offset
+            msgs.append(f.limit(side, price, rnd.randint(1, 10), 3))
+    return setup, msgs
+
+def sweep_flow(f, count, levels=50, per=10, every=20):
+    rnd = f.rnd
+    setup = passive_book(f, levels, per)
+    msgs = []
+    for i in range(count):
+        side = rnd.choice(('bid', 'ask'))
+        if i % every == 0:
+            # Through 5 to 20 levels of average 10.5 qty orders
+            qty = rnd.randint(5, 20) * per * 10
+            if rnd.random() < 0.5:
+                msgs.append(f.market(side, qty, 3))
+            else:
+                depth = rnd.randint(5, 20)
+                price = MID + depth if side == 'bid' else MID - depth
+                msgs.append(f.limit(side, price, qty, 3))
+        else:
+            offset = rnd.randint(1, levels)
+            price = MID - offset if side == 'bid' else MID + offset
+            msgs.append(f.limit(side, price, rnd.randint(1, 20),
+                1 if side == 'bid' else 2))
+    return setup, msgs
+
+def market_maker_flow(f, count, makers=10, amends=0.3, takers=0.05):
+    rnd = f.rnd
+    quotes = {}  # account_id -> [bid id, ask id]
+    mid = MID
+    msgs = []
+    while len(msgs) < count:
+        if rnd.random() < takers:
+            side = rnd.choice(('bid', 'ask'))
+            msgs.append(f.market(side, rnd.randint(1, 10), 100))
+            continue
+
+        mid += rnd.choice((-1, 0, 1))
+        account_id = rnd.randint(1, makers)
+        edge = rnd.randint(1, 5)
+        prices = (mid - edge, mid + edge)
+        old = quotes.get(account_id)
+        if old and rnd.random() < amends:
+            new = [f.amend(order_id, price=price)
+                for order_id, price in zip(old, prices)]
+        else:
+            if old:
+                msgs.extend(f.cancel(order_id) for order_id in old)
+            new = [f.limit(side, price, rnd.randint(1, 10), account_id)
+                for side, price in zip(('bid', 'ask'), prices)]
+        msgs.extend(new)
+        quotes[account_id] = [m[1]['id'] for m in new]
+    return [], msgs[:count]
+
+FLOWS = {
+    'poisson': poisson_flow,
+    'mean_reverting': mean_reverting_flow,
+    'deep': deep_flow,
+    'sweep': sweep_flow,
+    'market_maker': market_maker_flow,
+}
+
+# Bytes written by this process, None where /proc isn't there
+def written():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+def dir_bytes(path):
+    if not os.path.exists(path):
+        return 0
+    return sum(p.stat().st_size for p in Path(path).iterdir())
+
+# Resident bytes of this process, None where /proc isn't there
+def resident():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+def percentiles(ns, scale):
+    if not len(ns):
+        return {}
+    a = np.frombuffer(ns, dtype=np.int64) / scale
+    out = {'p%g' % p: float(v)
+        for p, v in zip(PERCENTILES, np.percentile(a, PERCENTILES))}
+    out['max'] = float(a.max())
+    return out
+
+def apply_all(lob, messages, chunk, latency=None, flushes=None):
+    apply = lob.applyEvent
+    trades = 0
+    for i in range(0, len(messages), chunk):
+        for method, payload in messages[i:i + chunk]:
+            t0 = perf_counter_ns()
+            trades += len(apply(method, payload)[1])
+            if latency is not None:
+                latency.append(perf_counter_ns() - t0)
+        t0 = perf_counter_ns()
+        if lob.check_flush() and flushes is not None:
+            flushes.append(perf_counter_ns() - t0)
+
+    t0 = perf_counter_ns()
+    lob.flush()
+    if flushes is not None:
+        flushes.append(perf_counter_ns() - t0)
+    return trades
+
+def run(flow, count=50000, book='order', seed=1, chunk=CHUNK, allocs=False):
+    """Run a flow on a fresh book and return its results as a dict."""
+    setup, messages = FLOWS[flow](Flow(seed), count)
+    tmp = Path(tempfile.mkdtemp())
+    env = lmdb.open(str(tmp / 'lob'), max_dbs=4, map_size=MAP_SIZE)
+    try:
+        lob = OrderBook(env, tmp / 'trades', book=book)
+        apply_all(lob, setup, chunk)
+
+        latency = array('q')
+        flushes = array('q')
+        tape0 = dir_bytes(lob.trades_dir)
+        wchar0 = written()
+        blocks0 = sys.getallocatedblocks()
+        start = perf_counter_ns()
+        trades = apply_all(lob, messages, chunk, latency, flushes)
+        elapsed = (perf_counter_ns() - start) / 1e9
+        blocks = sys.getallocatedblocks() - blocks0
+        wchar = written()
+        tape = dir_bytes(lob.trades_dir) - tape0
+
+        info, stat = env.info(), env.stat()
+        result = {
+            'flow': flow,
+            'book': book,
+            'setup': len(setup),
+            'messages': len(messages),
+            'trades': trades,
+            'seconds': elapsed,
+            'msgs_per_sec': len(messages) / elapsed,
+            'latency_us': percentiles(latency, 1e3),
+            'flushes': len(flushes),
+            'flush_ms': percentiles(flushes, 1e6),
+            'lmdb_bytes': None if wchar is None else wchar - wchar0 - tape,
+            'tape_bytes': tape,
+            'map_bytes': (info['last_pgno'] + 1) * stat['psize'],
+            'blocks': blocks,
+            'counters': dict(lob.stats.counters),
+        }
+    finally:
+        env.close()
+        shutil.rmtree(tmp)
+
+    if allocs:
+        result.update(run_traced(flow, count, book, seed, chunk))
+    return result
+
+# Peak and retained traced bytes of the measured messages
+def run_traced(flow, count, book, seed, chunk):
+    setup, messages = FLOWS[flow](Flow(seed), count)
+    tmp = Path(tempfile.mkdtemp())
+    env = lmdb.open(str(tmp / 'lob'), max_dbs=4, map_size=MAP_SIZE)
+    try:
+        lob = OrderBook(env, tmp / 'trades', book=book)
+        apply_all(lob, setup, chunk)
+        del setup
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        apply_all(lob, messages, chunk)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        env.close()
+        shutil.rmtree(tmp)
+    return {
+        'alloc_peak_bytes': peak - before,
+        'alloc_retained_bytes': current - before,
+    }
+
+# Metrics compared between runs, and whether higher is better
+COMPARE = (
+    ('msgs_per_sec', None, True),
+    ('latency_us', 'p50', False),
+    ('latency_us', 'p99', False),
+    ('lmdb_bytes', None, False),
+)
+
+def compare(old, new):
+    """Rows of (flow, metric, old, new, change %, regression %) for the
+    flows in both result sets, as run() dicts keyed by flow. Regression
+    is the change in the worse direction, negative for improvements."""
+    rows = []
+    for flow in new:
+        if flow not in old:
+            continue
+        for key, sub, higher in COMPARE:
+            a, b = old[flow].get(key), new[flow].get(key)
+            if sub:
+                a, b = (a or {}).get(sub), (b or {}).get(sub)
+                key = '%s %s' % (key, sub)
+            if not a or b is None:
+                continue
+            change = (b - a) / a * 100
+            rows.append((flow, key, a, b, change,
+                -change if higher else change))
+    return rows
+
+def build_book(path, count, levels=1000, seed=1):
+    """Write a book of count resting orders, half each side over levels
+    prices from MID out, into a new lmdb env at path. Rows are written in
+    key order as OrderList.flush() would leave them."""
+    rnd = np.random.default_rng(seed)
+    env = lmdb.open(str(path), max_dbs=4, map_size=COLD_MAP_SIZE)
+    idb = env.open_db(b'ids')
+    next_id = 1
+    try:
+        for side, name in (('bid', b'bids'), ('ask', b'asks')):
+            db = env.open_db(name)
+            n = count // 2
+            offset = 1 + np.arange(n) * levels // n
+            ids = np.arange(next_id, next_id + n)
+            next_id += n
+
+            keys = np.empty((n, 2), '>i8')
+            keys[:, 0] = -(MID - offset) if side == 'bid' else MID + offset
+            keys[:, 1] = ids
+            values = np.empty((n, 2), '>i8')
+            values[:, 0] = rnd.integers(1, 20, n)
+            values[:, 1] = rnd.integers(1, 1000, n)
+            k, v = keys.tobytes(), values.tobytes()
+            i = ids.astype('>i8').tobytes()
+
+            with env.begin(write=True) as txn:
+                txn.cursor(db).putmulti(((k[j:j + 16], v[j:j + 16])
+                    for j in range(0, len(k), 16)), append=True)
+                txn.cursor(idb).putmulti(((i[j:j + 8], k[j * 2:j * 2 + 16])
+                    for j in range(0, len(i), 8)), append=True)
+    finally:
+        env.close()
+
+def cold_start(path, book='order'):
+    """Open an OrderBook on the env build_book() left at path and send
+    one market order through its top levels."""
+    env = lmdb.open(str(path), max_dbs=4, map_size=COLD_MAP_SIZE)
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        rss0 = resident()
+        start = perf_counter_ns()
+        lob = OrderBook(env, tmp / 'trades', book=book)
+        opened = perf_counter_ns()
+        trades, _ = lob.processOrder(Quote(id=2 ** 62, type='market',
+            side='bid', qty=1000, account_id=1))
+        first = perf_counter_ns()
+        rss = resident()
+        return {
+            'book': book,
+            'open_seconds': (opened - start) / 1e9,
+            'first_order_ms': (first - opened) / 1e6,
+            'trades': len(trades),
+            'rss_bytes': None if rss is None else rss - rss0,
+        }
+    finally:
+        env.close()
+        shutil.rmtree(tmp)
+
+def construction(count=100000):
+    """ns per object of each way the engine builds lob.model objects."""
+    quote = {'id': 1, 'type': 'limit', 'side': 'bid', 'price': MID,
+        'qty': 10, 'account_id': 1}
+    q = Quote(quote)
+    cases = (
+        ('Quote(payload)', lambda: Quote(quote)),
+        ('Quote.make', lambda: Quote.make(1, 'limit', 'bid', MID, 10, 1)),
+        ('Order(to_dict)', lambda: Order(q.to_dict())),
+        ('Order(kwargs)', lambda: Order(id=1, price=MID, qty=10,
+            account_id=1, in_db=True)),
+        ('Order.make', lambda: Order.make(q.id, q.price, q.qty,
+            q.account_id)),
+        ('Trade(kwargs)', lambda: Trade(time=1, price=MID, qty=10)),
+        ('Trade.make', lambda: Trade.make(1, MID, 10)),
+    )
+    out = {}
+    for name, build in cases:
+        loop = range(count)
+        start = perf_counter_ns()
+        for i in loop:
+            build()
+        out[name] = (perf_counter_ns() - start) / count
+    return out
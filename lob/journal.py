@@ -0,0 +1,111 @@
+import os
+from time import time
+
+import msgpack
+
+SYNC_MS = 5  # Group commit interval
+
+"""
+Write-ahead journal
+
+Every event the engine receives is appended here before it is applied to
+the book, as a msgpack record [seq, idnum, method, payload]. Appends are
+buffered and fsynced at most every SYNC_MS (group commit), or on sync().
+
+The book stores the seq of the last applied event in lmdb with every
+flush. On startup, events after that seq are replayed on top of the lmdb
+snapshot. Segments entirely covered by a flush are deleted.
+
+Segments are named by the seq of their first record. A torn record at
+the end of the last segment (crash mid-write) is truncated on open.
+"""
+
+class Journal:
+    def __init__(self, path, sync_ms=SYNC_MS):
+        self.path = path
+        self.sync_ms = sync_ms
+        self.seq = 0
+        self.f = None
+        self.synced = time()
+        self.dirty = False
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        segments = self.segments()
+        if segments:
+            start, fname = segments[-1]
+            self.seq = start - 1
+            with open(fname, 'r+b') as f:
+                unpacker = msgpack.Unpacker(f, raw=False)
+                end = 0
+                for record in unpacker:
+                    self.seq = record[0]
+                    end = unpacker.tell()
+                f.truncate(end)
+
+    def resume(self, seq):
+        """Number new records after seq, the last seq the book flushed,
+        if that is ahead. A clean flush leaves no segments to count from."""
+        if seq > self.seq:
+            self.seq = seq
+
+    def segments(self):
+        out = []
+        for name in os.listdir(self.path):
+            if name.endswith('.jnl'):
+                out.append((int(name[:-4]), os.path.join(self.path, name)))
+        return sorted(out)
+
+    def replay(self, after_seq=0):
+        """Yield (seq, idnum, method, payload) for records after after_seq."""
+        for start, fname in self.segments():
+            with open(fname, 'rb') as f:
+                for record in msgpack.Unpacker(f, raw=False):
+                    if record[0] > after_seq:
+                        yield tuple(record)
+
+    def append(self, idnum, method, payload):
+        self.seq += 1
+        if not self.f:
+            fname = os.path.join(self.path, '%020d.jnl' % self.seq)
+            self.f = open(fname, 'ab')
+
+        self.f.write(msgpack.packb([self.seq, idnum, method, payload]))
+        self.dirty = True
+
+        if (time() - self.synced) * 1000 >= self.sync_ms:
+            self.sync()
+        return self.seq
+
+    def sync(self):
+        if self.dirty:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.dirty = False
+        self.synced = time()
+
+    def truncate(self, flushed_seq):
+        """Drop segments whose records are all at or before flushed_seq."""
+        segments = self.segments()
+        if flushed_seq >= self.seq and self.f:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+        for i, (start, fname) in enumerate(segments):
+            if i + 1 < len(segments):
+                last = segments[i + 1][0] - 1
+            else:
+                last = self.seq
+            if last > flushed_seq:
+                break
+            if self.f and self.f.name == fname:
+                break
+            os.remove(fname)
+
+    def close(self):
+        if self.f:
+            self.sync()
+            self.f.close()
+            self.f = None
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+
+import numpy as np
+from sortedcontainers import SortedList
+
+from lob.model import Order, encode, decode
+from lob.orderlist import OrderList
+
+class PriceLevel:
+    __slots__ = ['price', 'orders', 'volume', 'lazy']
+
+    def __init__(self, price):
+        self.price = price
+        self.orders = OrderedDict()  # order.id -> Order, in time priority
+        self.volume = 0
+        self.lazy = None  # (ids, qtys, account_ids) not built yet, see load
+
+    def __len__(self):
+        if self.lazy is not None:
+            return len(self.orders) + len(self.lazy[0])
+        return len(self.orders)
+
+class LevelList(OrderList):
+    """
+    Price level book
+
+    Same interface, pending ops and lmdb layout as OrderList, but the whole
+    side is held in memory grouped by price. Each level is a FIFO queue of
+    orders with a running volume, and the levels are indexed by sort price
+    (negated for bids, see OrderList.sort_price) so index 0 is always the
+    top of book.
+
+    Levels are OrderedDicts keyed by order id, so removing a filled order
+    at the front or a cancelled one anywhere in the level is O(1) instead
+    of a SortedList.remove() per order.
+
+    Hydration reads the side from lmdb as arrays (OrderList.db_arrays) and
+    only sums each level's volume. A level's Order objects are built when
+    it is first walked or one of its orders is looked up by id.
+    """
+
+    def __init__(self, env, side, stats=None, window=None):
+        self.levels = {}            # sort price -> PriceLevel
+        self.prices = SortedList()  # [sort price..]
+        self.loaded = False
+        self.lazy_orders = 0        # Orders in levels not built yet
+
+        super().__init__(env, side, stats, window)
+
+    def __iter__(self):
+        if len(self.iter_deletes):
+            raise Exception('Deletes must be applied before iterating again.')
+
+        return self.iter_orders()
+
+    def iter_orders(self):
+        # Only qty updates happen during iteration, deletes are deferred
+        # to apply_deletes(), so the levels are stable here.
+        for sort_price in self.prices:
+            level = self.levels[sort_price]
+            if level.lazy is not None:
+                self.load(level)
+            yield from level.orders.values()
+
+    def __len__(self):
+        return len(self.order_idx) + self.lazy_orders
+
+    def get_level(self, price):
+        return self.levels.get(self.sort_price(price))
+
+    def add_level(self, price):
+        sort_price = self.sort_price(price)
+        level = self.levels[sort_price] = PriceLevel(price)
+        self.prices.add(sort_price)
+        return level
+
+    def remove_level(self, level):
+        sort_price = self.sort_price(level.price)
+        del self.levels[sort_price]
+        self.prices.remove(sort_price)
+
+    def append_order(self, order):
+        level = self.get_level(order.price) or self.add_level(order.price)
+        level.orders[order.id] = order
+        level.volume += order.qty
+
+    def update_qty(self, order, qty):
+        self.get_level(order.price).volume += qty - order.qty
+        super().update_qty(order, qty)
+
+    def insert(self, quote):
+        order = Order.make(quote.id, quote.price, quote.qty, quote.account_id)
+        self.order_idx[order.id] = order
+        self.append_order(order)
+        self.add_pending(order, 'insert')
+
+    def apply_deletes(self):
+        for o in self.iter_deletes:
+            level = self.get_level(o.price)
+            del level.orders[o.id]
+            level.volume -= o.qty
+            if not len(level):
+                self.remove_level(level)
+
+            del self.order_idx[o.id]
+            self.deleted_order_idx[o.id] = o
+
+        self.iter_deletes = []
+
+    # The full side is loaded once. Afterwards memory is the source of
+    # truth and lmdb only receives flushes.
+    def refill_window(self, size):
+        if self.loaded:
+            return
+
+        sort_prices, ids, qtys, account_ids = self.db_arrays()
+        self.loaded = True
+        if not len(ids):
+            return
+
+        starts = np.flatnonzero(np.diff(sort_prices)) + 1
+        ends = np.append(starts, len(ids)).tolist()
+        starts = np.insert(starts, 0, 0)
+        volumes = np.add.reduceat(qtys, starts).tolist()
+        starts = starts.tolist()
+        for start, end, volume in zip(starts, ends, volumes):
+            sort_price = int(sort_prices[start])
+            level = self.levels[sort_price] = PriceLevel(abs(sort_price))
+            level.volume = volume
+            level.lazy = (ids[start:end], qtys[start:end],
+                account_ids[start:end])
+        self.prices = SortedList(self.levels)
+        self.lazy_orders = len(ids)
+
+    # Build the orders of a level hydrated as arrays. They rested before
+    # anything inserted since, so they go first.
+    def load(self, level):
+        ids, qtys, account_ids = level.lazy
+        level.lazy = None
+        self.lazy_orders -= len(ids)
+
+        price = level.price
+        order_idx = self.order_idx
+        make = Order.make
+        orders = OrderedDict()
+        for order_id, qty, account_id in zip(ids.tolist(), qtys.tolist(),
+            account_ids.tolist()):
+            orders[order_id] = order_idx[order_id] = make(order_id, price,
+                qty, account_id, True)
+        orders.update(level.orders)
+        level.orders = orders
+
+    # The whole book stays in memory
+    def trim(self):
+        pass
+
+    # Everything is in memory, though maybe not built yet. The id index
+    # finds the level of an order that isn't.
+    def find_order(self, order_id):
+        o = self.order_idx.get(order_id)
+        if o is not None or not self.lazy_orders:
+            return o
+
+        with self.env.begin() as txn:
+            seq_key = txn.get(encode(order_id), db=self.idb)
+        level = seq_key and self.levels.get(decode(seq_key[:8]))
+        if not level or level.lazy is None:
+            return None
+        self.load(level)
+        return self.order_idx.get(order_id)
+
+    def best_price(self):
+        if not self.prices:
+            return None
+        return self.levels[self.prices[0]].price
+
+    def get_volume(self, price):
+        level = self.get_level(price)
+        return level.volume if level else 0
+
+    def depth(self, txn, levels):
+        return [[self.levels[p].price, self.levels[p].volume]
+            for p in self.prices[:levels]]
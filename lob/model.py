@@ -37,6 +37,29 @@ class Base(object):
         if post_validate:
             post_validate()
 
+    # Each subclass gets a generated make(id, price, ..) classmethod, the
+    # columns as arguments in order. It sets them without the checks of
+    # __init__, for values the engine has already validated or read back
+    # from its own db. Trailing optional columns default as in __init__.
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        args = []
+        scope = {'new': object.__new__}
+        optional = True
+        for c in reversed(cls.cols):
+            optional = optional and (c.default is not None or not c.required)
+            if optional:
+                scope['default_' + c.name] = c.default
+                args.append('%s=default_%s' % (c.name, c.name))
+            else:
+                args.append(c.name)
+        lines = ['def make(cls, %s):' % ', '.join(reversed(args)),
+            '    self = new(cls)']
+        lines += ['    self.%s = %s' % (c.name, c.name) for c in cls.cols]
+        lines.append('    return self')
+        exec('\n'.join(lines), scope)
+        cls.make = classmethod(scope['make'])
+
     def to_dict(self):
         return {c.name: getattr(self, c.name) for c in self.cols}
 
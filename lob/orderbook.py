@@ -1,21 +1,27 @@
 import os
 import sys
-import math
 from collections import deque
-from io import StringIO
-import lmdb
-from time import time
-from stats import get_size, sizefmt
+from time import time, perf_counter_ns
+from stats import Stats
 
 from .orderlist import OrderList
-from .model import Quote, Trade, decode
+from .levellist import LevelList
+from .model import Quote, encode, decode
+from .tape import write_tape
 
 
 FLUSH_TIME  = 1      # Number of seconds until flush()
 FLUSH_COUNT = 20000  # Number of orders until flush()
 
+# Book side implementations. Both share the same lmdb layout.
+BOOK_TYPES = {
+    'order': OrderList,  # Sequence keys with a window of orders in memory
+    'level': LevelList,  # Price levels, whole book in memory
+}
+
 class OrderBook(object):
-    def __init__(self, env, trades_dir):
+    def __init__(self, env, trades_dir, book='order', journal=None, depth=0,
+        risk=None, stats=None, window=None):
         self.tape = deque(maxlen=None) # Index [0] is most recent trade
         self.trades_dir = trades_dir
 
@@ -24,8 +30,50 @@ class OrderBook(object):
         # LMDB
         self.env = env
 
-        self.bids = OrderList(self.env, 'bid')
-        self.asks = OrderList(self.env, 'ask')
+        if book not in BOOK_TYPES:
+            raise Exception('Invalid book type: ' + str(book))
+        self.book = book
+
+        # Always on timings and counters, see stats.py. Histograms:
+        # process_order, refill, list_flush and flush_trades.
+        if stats is None:
+            stats = Stats(dump=False)
+        self.stats = stats
+        self.order_ns = stats.hist('process_order')
+        self.flush_trades_ns = stats.hist('flush_trades')
+
+        # window is the (min, max) orders a side keeps in memory, see
+        # lob.orderlist.ORDERS_SIZE
+        List = BOOK_TYPES[book]
+        self.bids = List(self.env, 'bid', stats, window)
+        self.asks = List(self.env, 'ask', stats, window)
+
+        # Books written before the order id index existed
+        with self.env.begin(write=True) as txn:
+            if not txn.stat(self.bids.idb)['entries']:
+                self.bids.db_index(txn)
+                self.asks.db_index(txn)
+
+        # Journal seq of the last event applied to the book. Saved with
+        # every flush, events after it are replayed by recover().
+        self.journal = journal
+        self.meta = env.open_db(b'meta')
+        with self.env.begin(db=self.meta) as txn:
+            seq = txn.get(b'seq')
+        self.seq = decode(seq) if seq else 0
+        if journal is not None:
+            journal.resume(self.seq)
+
+        # Top depth levels of each side as of the last flush, see getDepth()
+        self.depth_levels = depth
+        self.depth = None
+
+        # Pre-trade balance checks, see lob.risk. Ids of the orders and
+        # amends rejected since last flush are in rejected.
+        self.risk = risk
+        self.rejected = []
+        if risk is not None:
+            risk.hydrate(self)
 
         # Since last flush
         self.flushed = time()
@@ -59,12 +107,17 @@ class OrderBook(object):
             self.flush()
             self.flushed = time()
             self.count = 0
+            return True
+        return False
 
     def flush(self):
         with self.env.begin(write=True) as txn:
             self.bids.flush(txn)
             self.asks.flush(txn)
+            txn.put(b'seq', encode(self.seq), db=self.meta)
             self.flush_trades()
+            if self.depth_levels:
+                self.depth = self.getDepth(self.depth_levels, txn)
             #print('sleep 5 seconds after flush()..')
             #time.sleep(5)
             # write out trades
@@ -75,25 +128,40 @@ class OrderBook(object):
             # write out ledgers (do this here?)
             # write out ohlcv? (can trades produce this?)
 
-    def flush_trades(self):
-        keys = (
-            'time','price','qty','taker_side',
-            'maker_order_id','maker_account_id',
-            'taker_order_id','taker_account_id'
-        )
+        if self.journal:
+            self.journal.truncate(self.seq)
+
+    # Replay journaled events the last flush didn't cover. Returns the
+    # replayed message ids so requeued duplicates can be skipped.
+    def recover(self):
+        idnums = set()
+        if not self.journal:
+            return idnums
+
+        for seq, idnum, method, payload in self.journal.replay(self.seq):
+            self.applyEvent(method, payload)
+            self.seq = seq
+            idnums.add(idnum)
 
+        if idnums:
+            self.flush()
+        return idnums
+
+    def flush_trades(self):
         if not self.tape:
             return
+        t0 = perf_counter_ns()
         if not os.path.exists(self.trades_dir):
             os.mkdir(self.trades_dir)
         tmpfile = self.trades_dir / '.tmp'
         permfile = self.trades_dir / str(self.time_ns())
-        with open(tmpfile, 'w') as f:
-            for t in self.tape:
-                f.write(",".join([str(t[x]) for x in keys]) + "\n")
+        with open(tmpfile, 'wb') as f:
+            write_tape(f, self.tape)
 
         os.rename(tmpfile, permfile)
+        self.stats.incr('trades', len(self.tape))
         self.tape = deque(maxlen=None)
+        self.flush_trades_ns.record(perf_counter_ns() - t0)
 
     def dump_history(self):
         for i in range(len(self.history)):
@@ -103,8 +171,15 @@ class OrderBook(object):
 
 
     def processOrder(self, quote):
+        t0 = perf_counter_ns()
         orderInBook = None
         self.count += 1
+        if self.risk is not None and not self.risk.reserve(quote):
+            self.rejected.append(quote.id)
+            self.stats.incr('rejected')
+            self.order_ns.record(perf_counter_ns() - t0)
+            return [], orderInBook
+
         if quote.type == 'market':
             trades = self.processMarketOrder(quote)
         elif quote.type == 'limit':
@@ -114,8 +189,72 @@ class OrderBook(object):
 
         #self.check_flush()
 
+        self.order_ns.record(perf_counter_ns() - t0)
         return trades, orderInBook
 
+    # Queue message entry point. The event is journaled before it is
+    # applied. Returns (orders, trades).
+    def processEvent(self, method, payload, idnum=None):
+        if self.journal:
+            self.seq = self.journal.append(idnum, method, payload)
+        return self.applyEvent(method, payload)
+
+    def applyEvent(self, method, payload):
+        if method == 'add-order':
+            trades, orderInBook = self.processOrder(Quote(payload))
+            return 1, trades
+        elif method == 'batch':
+            return self.applyBatch(payload)
+        elif method == 'cancel-order':
+            self.cancelOrder(payload.get('side'), payload['order_id'],
+                payload['account_id'], payload['id'])
+            return 0, []
+        elif method == 'amend-order':
+            trades, orderInBook = self.modifyOrder(
+                payload['order_id'], payload, payload['account_id'])
+            return 0, trades
+        else:
+            raise Exception('Invalid method: ' + str(method))
+
+    # A batch is [[method, payload]..] in submission order. Runs of orders
+    # go through processBatch, cancels and amends are applied in between.
+    # A journaled event must be flushed whole, so no flush checks here.
+    def applyBatch(self, events):
+        order_cnt = 0
+        trades = []
+        quotes = []
+        for method, payload in events:
+            if method == 'add-order':
+                quotes.append(Quote(payload))
+                continue
+            if quotes:
+                trades += self.processBatch(quotes, flush=False)[0]
+                order_cnt += len(quotes)
+                quotes = []
+            trades += self.applyEvent(method, payload)[1]
+
+        if quotes:
+            trades += self.processBatch(quotes, flush=False)[0]
+            order_cnt += len(quotes)
+
+        return order_cnt, trades
+
+    # Match a list of quotes in one pass with a single flush check.
+    def processBatch(self, quotes, flush=True):
+        trades = []
+        ordersInBook = []
+        processOrder = self.processOrder
+        for quote in quotes:
+            newTrades, orderInBook = processOrder(quote)
+            if newTrades:
+                trades += newTrades
+            if orderInBook:
+                ordersInBook.append(orderInBook)
+
+        if flush:
+            self.check_flush()
+        return trades, ordersInBook
+
     def processMarketOrder(self, quote):
         trades = []
         qtyToTrade = quote.qty
@@ -125,6 +264,10 @@ class OrderBook(object):
             olist = self.bids
         qtyToTrade, newTrades = self.processList(olist, quote, qtyToTrade)
         trades += newTrades
+
+        # What a market ask didn't sell is no longer reserved
+        if self.risk is not None and quote.side == 'ask' and qtyToTrade:
+            self.risk.release(quote.account_id, 'ask', 0, qtyToTrade)
         return trades
 
     def processLimitOrder(self, quote):
@@ -162,9 +305,11 @@ class OrderBook(object):
         #print('processList', '-'*50)
         cnt = 0
         is_limit = quote.type == 'limit'
+        risk = self.risk
+        # A market bid buys what the account can pay for
+        capped = risk is not None and not is_limit and quote.side == 'bid'
 
-        for i, seq_key in enumerate(olist):
-            o = olist.get_order(seq_key)
+        for o in olist:
             if qtyToTrade <= 0:
                 break
             if is_limit and olist.side == 'ask' and o.price > quote.price:
@@ -176,6 +321,12 @@ class OrderBook(object):
             #foo = ','.join((str(o.price),str(o.id)))
             #foo = "%d,%d" % (o.price,o.id)
 
+            if capped:
+                affordable = risk.affordable(quote.account_id, o.price)
+                if affordable <= 0:
+                    break
+                uncapped, qtyToTrade = qtyToTrade, min(qtyToTrade, affordable)
+
             cnt += 1
             #print(cnt, o)
             tradedPrice = o.price
@@ -222,50 +373,123 @@ class OrderBook(object):
 
             self.tape.append(tx)
             trades.append(tx)
+            if risk is not None:
+                risk.trade(tx, quote, o)
+                if capped:
+                    qtyToTrade = uncapped - tradedQty
 
         olist.apply_deletes()
         return qtyToTrade, trades
 
 
-    # need: side, price, id
-    def cancelOrder(self, side, idNum):
+    # Side is optional, the order id index knows where the order rests.
+    def getOrderList(self, idNum, side=None):
         if side == 'bid':
-            if self.bids.orderExists(idNum):
-                self.bids.removeOrder(idNum)
+            return self.bids
         elif side == 'ask':
-            if self.asks.orderExists(idNum):
-                self.asks.removeOrder(idNum)
-        else:
-            sys.exit('cancelOrder() given neither bid nor ask')
+            return self.asks
+        elif side:
+            sys.exit('getOrderList() given neither bid nor ask')
+
+        for olist in (self.bids, self.asks):
+            if olist.find_order(idNum):
+                return olist
+        return None
+
+    # With account_id, only an order of that account is cancelled. Another
+    # account's cancel, cancelId, is rejected.
+    def cancelOrder(self, side, idNum, account_id=None, cancelId=None):
+        self.count += 1
+        olist = self.getOrderList(idNum, side)
+        if olist is None:
+            return None
+        if account_id is not None:
+            o = olist.find_order(idNum)
+            if o is not None and o.account_id != account_id:
+                self.rejected.append(cancelId)
+                self.stats.incr('rejected')
+                return None
+        o = olist.cancel(idNum)
+        if o is not None and self.risk is not None:
+            self.risk.release(o.account_id, olist.side, o.price, o.qty)
+        return o
+
+    # Amend a resting order. orderUpdate has the new price and/or qty and
+    # the id of the amend itself.
+    #
+    # Reducing qty at the same price keeps time priority. A price change or
+    # qty increase loses it: the order is cancelled and the remainder is
+    # processed as a new limit order under the amend id, so it may trade.
+    #
+    # With account_id, only an order of that account is amended.
+    def modifyOrder(self, idNum, orderUpdate, account_id=None):
+        olist = self.getOrderList(idNum, orderUpdate.get('side'))
+        o = olist.find_order(idNum) if olist is not None else None
+        if not o:
+            return [], None
+
+        if account_id is not None and o.account_id != account_id:
+            self.count += 1
+            self.rejected.append(orderUpdate['id'])
+            self.stats.incr('rejected')
+            return [], None
+
+        price = orderUpdate.get('price') or o.price
+        qty = orderUpdate.get('qty', o.qty)
+
+        if qty <= 0:
+            self.cancelOrder(olist.side, idNum)
+            return [], None
+
+        if price == o.price and qty <= o.qty:
+            self.count += 1
+            if self.risk is not None:
+                self.risk.release(o.account_id, olist.side, price, o.qty - qty)
+            return [], olist.amend_qty(idNum, qty)
+
+        quote = Quote(
+            id         = orderUpdate['id'],
+            type       = 'limit',
+            side       = olist.side,
+            price      = price,
+            qty        = qty,
+            account_id = o.account_id
+        )
+        # The order stays as it is if the replacement can't be paid for
+        if self.risk is not None and not self.risk.affords(quote, freed=o):
+            self.count += 1
+            self.rejected.append(quote.id)
+            return [], None
 
-    def modifyOrder(self, idNum, orderUpdate):
-        side = orderUpdate['side']
-        orderUpdate['idNum'] = idNum
-        orderUpdate['timestamp'] = self.time
-        if side == 'bid':
-            if self.bids.orderExists(orderUpdate['idNum']):
-                self.bids.updateOrder(orderUpdate)
-        elif side == 'ask':
-            if self.asks.orderExists(orderUpdate['idNum']):
-                self.asks.updateOrder(orderUpdate)
-        else:
-            sys.exit('modifyOrder() given neither bid nor ask')
+        self.cancelOrder(olist.side, idNum)
+        return self.processOrder(quote)
 
     def getVolumeAtPrice(self, side, price):
-        price = self.clipPrice(price)
         if side =='bid':
-            vol = 0
-            if self.bids.priceExists(price):
-                vol = self.bids.getPrice(price).volume
-            return vol
+            return self.bids.get_volume(price)
         elif side == 'ask':
-            vol = 0
-            if self.asks.priceExists(price):
-                vol = self.asks.getPrice(price).volume
-            return vol
+            return self.asks.get_volume(price)
         else:
             sys.exit('getVolumeAtPrice() given neither bid nor ask')
 
+    # Top price levels, best first, as
+    # {'bids': [[price, volume]..], 'asks': [..]}.
+    # The order book reads them from lmdb, so call it after a flush.
+    def getDepth(self, levels, txn=None):
+        if txn is None:
+            with self.env.begin() as txn:
+                return self.getDepth(levels, txn)
+        return {
+            'bids': self.bids.depth(txn, levels),
+            'asks': self.asks.depth(txn, levels),
+        }
+
+    def getBestBid(self):
+        return self.bids.best_price()
+
+    def getBestAsk(self):
+        return self.asks.best_price()
+
 
     def dump_book(self):
         s1 = time()
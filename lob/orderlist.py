@@ -1,16 +1,49 @@
-from sortedcontainers import SortedList, SortedSet
+from itertools import chain, islice
+from time import perf_counter_ns
+
+import numpy as np
+from sortedcontainers import SortedList
 
 from lob.model import Order, encode, decode
+from stats import Stats
 
-# This the number of orders that will be held in memory.
+# Orders held in memory per side. The window starts at ORDERS_SIZE and is
+# resized on flush to HEADROOM times the most orders one pass through the
+# book walked since the last flush. Quiet books shrink by DECAY per flush,
+# and the window stays within [ORDERS_SIZE, ORDERS_MAX] unless the
+# OrderList is given other bounds. Orders past it are evicted on flush.
 ORDERS_SIZE = 5000
+ORDERS_MAX = 200000
+HEADROOM = 2
+DECAY = 0.9
+ORDER_BYTES = 256  # Memory per windowed order, for budgets in bytes
+
+# A db row, key and value: sort price, id | qty, account_id
+ROW_DTYPE = np.dtype(('>i8', 4))
 
 class OrderList:
-    def __init__(self, env, side):
+    def __init__(self, env, side, stats=None, window=None):
         self.env = env
         self.side = side
 
-        #self.idb = env.open_db(b'ids')
+        # (min, max) orders in memory, see ORDERS_SIZE
+        self.window_min, self.window_max = window or (ORDERS_SIZE, ORDERS_MAX)
+        self.window = self.window_min
+        self.walked = 0  # Deepest pass since the last flush
+
+        # The window reaches the end of the db, so every order of the side
+        # is in memory and there's nothing to refill
+        self.complete = False
+
+        # Shared with the book and the other side, see OrderBook.stats
+        if stats is None:
+            stats = Stats(dump=False)
+        self.stats = stats
+        self.refill_ns = stats.hist('refill')
+        self.flush_ns = stats.hist('list_flush')
+
+        # Order id index, shared by both sides. order.id -> sequence key
+        self.idb = env.open_db(b'ids')
 
         if side == 'bid':
             self.db = env.open_db(b'bids')
@@ -66,76 +99,54 @@ class OrderList:
         if len(self.iter_deletes):
             raise Exception('Deletes must be applied before iterating again.')
 
+        if self.iter_idx > self.walked:
+            self.walked = self.iter_idx
         self.iter_idx = 0
         return self
 
     def __next__(self):
         idx = self.iter_idx
 
-        # The current position is beyond orders. Attempt to refill
+        # The current position is beyond orders. Attempt to refill, with at
+        # least as many orders as this pass has walked so a deep sweep
+        # doubles its reach with every refill.
         if idx > len(self.orders) - 1:
-            self.refill()
+            self.refill(max(self.window, idx))
 
         if len(self.orders) == 0 or idx > len(self.orders) - 1:
             raise StopIteration
 
         self.iter_idx += 1
-        return self.orders[idx]
+        return self.get_order(self.orders[idx])
 
     def __len__(self):
         return len(self.orders)
 
-    def seq_key(self, order):
-        price = order.price
+    # Bids are stored with a negated price so both sides sort ascending.
+    def sort_price(self, price):
         if self.side == 'bid':
-            price = order.price * -1
-        return encode(price) + encode(order.id)
+            return price * -1
+        return price
+
+    def seq_key(self, order):
+        return encode(self.sort_price(order.price)) + encode(order.id)
 
     def update_qty(self, order, qty):
         self.order_idx[order.id].qty = qty
         self.add_pending(order, 'qty')
 
     def insert(self, quote):
-        order = Order(quote.to_dict())
+        order = Order.make(quote.id, quote.price, quote.qty, quote.account_id)
         seq_key = self.seq_key(order)
 
-        # Special rule - The thing that separates memory list vs db is the
-        # last order (self.orders[-1]. This last order is used to extend the
-        # memory list. If this value isn't in the db, we have no way to know
-        # which records we need. This condition only occurs when the book
-        # is empty. Once this first insert is pushed to both memorylist
-        # and db, all subsequent inserts can properly segregate.
-        if len(self.orders) == 0:
+        # The last order in memory (self.orders[-1]) separates the memory
+        # list from the db. Orders past it are only pending until flush,
+        # refill() picks them up from pending along with the db rows.
+        self.order_idx[order.id] = order
+        self.add_pending(order, 'insert')
+        if self.complete or (len(self.orders) > 0 and
+            seq_key < self.orders[-1]):
             self.orders.add(seq_key)
-            self.order_idx[order.id] = order
-
-            with self.env.begin(write=True) as txn:
-                self.db_insert(txn, order)
-                order.in_db = True
-            print('SPECIAL INSERT',order)
-        else:
-            self.order_idx[order.id] = order
-            self.add_pending(order, 'insert')
-            # Orders within memory list range are added
-            if (len(self.orders) > 0 and seq_key < self.orders[-1]):
-                self.orders.add(seq_key)
-
-            #print('insert() added:',order.id,'to orders:',added, ' total:',len(self.orders))
-
-    def update(self, orderUpdate):
-        order = self.orderMap[orderUpdate['idNum']]
-        originalVolume = order.qty
-        if orderUpdate['price'] != order.price:
-            # Price changed
-            orderList = self.priceMap[order.price]
-            orderList.removeOrder(order)
-            if len(orderList) == 0:
-                self.removePrice(order.price)
-            self.insertOrder(orderUpdate)
-        else:
-            # Quantity changed
-            order.updateQty(orderUpdate['qty'], orderUpdate['timestamp'])
-        self.volume += order.qty-originalVolume
 
     def delete(self, order):
         self.iter_deletes.append(order)
@@ -149,41 +160,169 @@ class OrderList:
             seq_key = self.seq_key(o)
             del self.order_idx[o.id]
             self.deleted_order_idx[o.id] = o
-            self.orders.remove(seq_key)
+            # Cancelled orders may be outside the memory window
+            self.orders.discard(seq_key)
+        # Refill a window emptied by deletes now rather than on the next
+        # iteration
+        if len(self.orders) == 0 and not self.complete:
+            self.refill()
+
+    def refill(self, size=None):
+        if self.complete:
+            return
+        t0 = perf_counter_ns()
+        self.refill_window(min(size or self.window, self.window_max))
+        self.refill_ns.record(perf_counter_ns() - t0)
 
-    def refill(self):
+    # Load up to size orders past the window from the db
+    def refill_window(self, size):
         end_order = None
-        order_id = None
+        start_key = None
         if len(self.orders) > 0:
-            seq_key = self.orders[-1]
-            order_id = decode(seq_key[8:])
+            start_key = self.orders[-1]
+            order_id = decode(start_key[8:])
             end_order = self.order_idx[order_id]
 
-        #print('refill() side:',self.side,' end_order:',order_id,'idx:',self.iter_idx)
-        orders, order_idx = self.db_get_list(order=end_order)
-        self.orders += orders
-        self.order_idx.update(order_idx)
+        removed = set(order_id for order_id, ops in self.pending.items()
+                      if ops[-1] == 'remove')
+
+        # A batch holding only orders pending removal adds nothing, so keep
+        # reading until a live order turns up or the db runs out.
+        orders = []
+        order_idx = {}
+        while True:
+            batch, batch_idx = self.db_get_list(order=end_order, size=size)
+            self.stats.incr('refills')
+            self.stats.incr('refill_rows', len(batch))
+            orders.extend(batch)
+            order_idx.update(batch_idx)
+            if len(batch) <= size:
+                self.complete = True
+                break
+            if any(decode(seq_key[8:]) not in removed for seq_key in batch):
+                break
+            end_order = batch_idx[decode(batch[-1][8:])]
+
+        # The db is missing everything since the last flush. Drop orders
+        # pending removal and add pending inserts within the new range.
+        end_key = None
+        if not self.complete:
+            end_key = orders[-1]
+        for order_id, ops in self.pending.items():
+            if order_id in removed:
+                continue
+            o = self.order_idx[order_id]
+            if o.in_db:
+                continue
+            seq_key = self.seq_key(o)
+            if start_key and seq_key <= start_key:
+                continue
+            if end_key and seq_key > end_key:
+                continue
+            self.orders.add(seq_key)
+
+        for seq_key in orders:
+            order_id = decode(seq_key[8:])
+            if order_id in removed:
+                continue
+            self.orders.add(seq_key)
+            # Orders amended from the db are already in memory and newer
+            if order_id not in self.order_idx:
+                self.order_idx[order_id] = order_idx[order_id]
         #print('refill() added',len(orders),'orders. total:',len(self.orders))
 
     def get_order(self, seq_key):
         order_id = decode(seq_key[8:])
         return self.order_idx[order_id]
 
+    # Find a resting order by id. Memory holds the window and anything
+    # unflushed, otherwise fall back to the id index in the db.
+    def find_order(self, order_id):
+        o = self.order_idx.get(order_id)
+        if o:
+            return o
+        if order_id in self.deleted_order_idx:
+            return None
+
+        with self.env.begin() as txn:
+            seq_key = txn.get(encode(order_id), db=self.idb)
+            if not seq_key:
+                return None
+            value = txn.get(seq_key, db=self.db)
+            if not value:
+                return None
+            return self.db_decode(seq_key, value)
+
+    def cancel(self, order_id):
+        o = self.find_order(order_id)
+        if not o:
+            return None
+
+        self.order_idx[o.id] = o
+        self.delete(o)
+        self.apply_deletes()
+        return o
+
+    # Amending qty down keeps time priority. Anything else is a
+    # cancel/replace done by the OrderBook.
+    def amend_qty(self, order_id, qty):
+        o = self.find_order(order_id)
+        if not o or qty > o.qty:
+            return None
+
+        self.order_idx[o.id] = o
+        self.update_qty(o, qty)
+        return o
+
+    def best_price(self):
+        if len(self.orders) == 0:
+            self.refill()
+        if len(self.orders) == 0:
+            return None
+        return self.get_order(self.orders[0]).price
+
+    # Resting volume at price. The level may extend past the memory window,
+    # so read it from the db and overlay unflushed changes.
+    def get_volume(self, price):
+        prefix = encode(self.sort_price(price))
+        volume = 0
+        seen = set()
+        with self.env.begin(db=self.db) as txn:
+            cur = txn.cursor()
+            if cur.set_range(prefix):
+                for k, v in cur:
+                    if k[:8] != prefix:
+                        break
+                    order_id = decode(k[8:])
+                    seen.add(order_id)
+                    ops = self.pending.get(order_id)
+                    if ops and ops[-1] == 'remove':
+                        continue
+                    o = self.order_idx.get(order_id)
+                    volume += o.qty if o else decode(v[:8])
+
+        for order_id, ops in self.pending.items():
+            if order_id in seen or ops[-1] == 'remove':
+                continue
+            o = self.order_idx[order_id]
+            if o.price == price:
+                volume += o.qty
+
+        return volume
+
 
     def db_insert(self, txn, o):
         seq_key = self.seq_key(o)
         value = encode(o.qty) + encode(o.account_id)
         r1 = txn.put(seq_key, value, db=self.db)
-        #r1 = txn.put(encode(o.id), encode(o.qty), db=self.idb)
-        #r2 = txn.put(seq_key[:8], seq_key[8:], db=self.db)
+        txn.put(encode(o.id), seq_key, db=self.idb)
         if not r1:
             raise Exception('Should we die on duplicate insert?')
 
     def db_delete(self, txn, o):
         seq_key = self.seq_key(o)
         r1 = txn.delete(seq_key, db=self.db)
-        #r1 = txn.delete(seq_key[:8], seq_key[8:], db=self.db)
-        #r2 = txn.delete(encode(o.id), db=self.idb)
+        txn.delete(encode(o.id), db=self.idb)
         if not r1:
             self.dump_pending()
             print('r1:',r1)
@@ -194,9 +333,23 @@ class OrderList:
         seq_key = self.seq_key(o)
         value = encode(o.qty) + encode(o.account_id)
         r = txn.put(seq_key, value, db=self.db)
-        #r = txn.put(encode(o.id), encode(o.qty), db=self.idb)
-
-    def db_get_list(self, order=None, size=ORDERS_SIZE):
+        if not o.in_db:
+            txn.put(encode(o.id), seq_key, db=self.idb)
+
+    # Index every order on this side. Used for books created before the
+    # id index existed.
+    def db_index(self, txn):
+        cur = txn.cursor(db=self.db)
+        for seq_key in cur.iternext(keys=True, values=False):
+            txn.put(seq_key[8:], seq_key, db=self.idb)
+
+    def db_decode(self, seq_key, value):
+        return Order.make(decode(seq_key[8:]), abs(decode(seq_key[:8])),
+            decode(value[:8]), decode(value[8:]), True)
+
+    def db_get_list(self, order=None, size=None):
+        if size is None:
+            size = ORDERS_SIZE
         orders = []
         order_idx = {}
         with self.env.begin(db=self.db) as txn:
@@ -207,39 +360,59 @@ class OrderList:
             if order:
                 seq_key = self.seq_key(order)
 
+            # The start order may be unflushed, so seek to the first key
+            # at or after it.
             if seq_key:
-                if not cur.set_key(seq_key):
-                    print('id:',decode(seq_key[8:]))
-                    print('price:',abs(decode(seq_key[:8])))
-                    raise Exception('Failed to set_key')
-                if not cur.next():
+                if not cur.set_range(seq_key):
+                    return orders, order_idx
+                if cur.key() == seq_key and not cur.next():
                     return orders, order_idx
             elif not cur.first():
                 return orders, order_idx
 
-            # Fetch list from db
-            pairs = []
-            for cnt, (k, v) in enumerate(cur.iternext(True, True)):
-                # Break on size limit
-                if size != -1 and cnt > size:
-                    break
-                pairs.append((k,v))
-
-            for kv in pairs:
-                seq_key, value = kv
-                data = {
-                    'id'        : decode(seq_key[8:]),
-                    'price'     : abs(decode(seq_key[:8])),
-                    'qty'       : decode(value[:8]),
-                    'account_id': decode(value[8:]),
-                    'in_db'     : True
-                }
-                o = Order(**data)
-                orders.append(seq_key)
-                order_idx[data['id']] = o
+            # Fetch list from db, up to size + 1 rows
+            pairs = list(islice(cur, None if size == -1 else size + 1))
+
+        # Decoded together, rows are sort price, id, qty, account_id
+        rows = np.frombuffer(b''.join(chain.from_iterable(pairs)), ROW_DTYPE)
+        make = Order.make
+        for (seq_key, _), (sort_price, order_id, qty, account_id) in zip(
+            pairs, rows.tolist()):
+            orders.append(seq_key)
+            order_idx[order_id] = make(order_id, abs(sort_price), qty,
+                account_id, True)
 
         return orders, order_idx
 
+    # The whole side as int64 arrays (sort price, id, qty, account_id) in
+    # book order. The rows are joined into one block while iterating the
+    # cursor and decoded together, no objects per order.
+    def db_arrays(self):
+        with self.env.begin(db=self.db) as txn:
+            rows = b''.join(chain.from_iterable(txn.cursor()))
+        a = np.frombuffer(rows, ROW_DTYPE).astype(np.int64)
+        return a[:, 0], a[:, 1], a[:, 2], a[:, 3]
+
+    # Top levels as [[price, volume]..], best first. Read through txn, so
+    # pending ops must have been flushed to it.
+    def depth(self, txn, levels):
+        out = []
+        for k, v in txn.cursor(db=self.db):
+            price = abs(decode(k[:8]))
+            if out and out[-1][0] == price:
+                out[-1][1] += decode(v[:8])
+                continue
+            if len(out) == levels:
+                break
+            out.append([price, decode(v[:8])])
+        return out
+
+    # (price, qty, account_id) of every order in the db
+    def resting(self):
+        with self.env.begin(db=self.db) as txn:
+            for k, v in txn.cursor():
+                yield abs(decode(k[:8])), decode(v[:8]), decode(v[8:])
+
     def dump_book(self):
         with self.env.begin(db=self.db) as txn:
             cur = txn.cursor()
@@ -261,6 +434,8 @@ class OrderList:
     # Flush changes to disk
     def flush(self, txn):
         #print('flush %3s orders:%8d' % (self.side, len(self.orders)))
+        t0 = perf_counter_ns()
+        self.stats.incr('flushed_orders', len(self.pending))
         for order_id in self.pending.keys():
             ops = self.pending[order_id]
             if ops[-1] == 'remove':
@@ -277,11 +452,30 @@ class OrderList:
                 self.db_delete(txn, o)
             elif ops[-1] == 'qty':
                 self.db_update(txn, o)
-
-        # After everything is flushed, trim to ORDERS_SIZE ?
+                o.in_db = True
 
         self.pending = {}
         self.deleted_order_idx = {}
+        self.trim()
+        self.flush_ns.record(perf_counter_ns() - t0)
+
+    # Resize the window and evict orders past it. Everything is in the db
+    # after a flush, so the tail can be dropped along with orders loaded
+    # outside the window by cancels and amends.
+    def trim(self):
+        walked = max(self.walked, self.iter_idx)
+        window = max(HEADROOM * walked, int(self.window * DECAY))
+        self.window = min(max(window, self.window_min), self.window_max)
+        self.walked = self.iter_idx = 0
+
+        orders = self.orders
+        if len(orders) > self.window:
+            self.stats.incr('evicted', len(orders) - self.window)
+            del orders[self.window:]
+            self.complete = False
+        if len(self.order_idx) > len(orders):
+            get_order = self.get_order
+            self.order_idx = {o.id: o for o in map(get_order, orders)}
 
     def dump_pending(self):
         print("------ Pending -------")
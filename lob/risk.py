@@ -0,0 +1,152 @@
+import os
+
+from .tape import read_tape, SIDES
+
+"""
+Pre-trade balance checks
+
+Balances holds every account's balance and reserved amount per asset in
+memory, in fixed point with SCALE decimal places as settle.py computes
+ledgers. One Balances is shared by all the markets of an engine process.
+
+MarketRisk applies it to one market's order book:
+
+    limit bid    reserves price * qty of the unit of account
+    limit ask    reserves qty of the asset
+    market ask   reserves qty, the unfilled rest is released
+    market bid   reserves nothing, the sweep stops when funds run out
+
+An order is rejected if the reservation exceeds the available (balance -
+reserved) amount. Fills move the balances as their ledgers will, fees
+included, and release what the filled part reserved. Cancels and amends
+release or re-reserve the rest.
+
+Balances are hydrated from account_asset, then the engine adds resting
+orders as reservations and trades in tape files trades2db has not
+settled yet. A tape trades2db commits between those two reads is
+counted twice. Deposits and withdrawals are only seen on restart.
+"""
+
+SCALE = 10000 # Fee rates are in basis points, as settle.SCALE
+
+class Balances():
+    def __init__(self):
+        self.accounts = {}   # (account_id, asset_id) -> [balance, reserved]
+        self.loaded = set()  # asset ids
+
+    def load(self, rows):
+        """Add (account_id, asset_id, balance) rows, balances in units."""
+        for account_id, asset_id, balance in rows:
+            self.add(account_id, asset_id, int(balance * SCALE), 0)
+
+    def add(self, account_id, asset_id, balance, reserved):
+        entry = self.accounts.get((account_id, asset_id))
+        if entry is None:
+            entry = self.accounts[(account_id, asset_id)] = [0, 0]
+        entry[0] += balance
+        entry[1] += reserved
+
+    def available(self, account_id, asset_id):
+        entry = self.accounts.get((account_id, asset_id))
+        return entry[0] - entry[1] if entry else 0
+
+    def get(self, account_id, asset_id):
+        """(balance, reserved) in fixed point."""
+        return tuple(self.accounts.get((account_id, asset_id), (0, 0)))
+
+class MarketRisk():
+    def __init__(self, balances, asset_id, uoa_id, maker_bps=0, taker_bps=0):
+        self.balances = balances
+        self.asset_id = asset_id
+        self.uoa_id = uoa_id
+        self.maker_bps = maker_bps
+        self.taker_bps = taker_bps
+
+    # Asset and fixed point amount a resting order reserves
+    def cost(self, side, price, qty):
+        if side == 'bid':
+            return self.uoa_id, price * qty * SCALE
+        return self.asset_id, qty * SCALE
+
+    def affords(self, quote, freed=None):
+        """Whether the account can pay for quote. freed is an order being
+        replaced, its reservation counts as available."""
+        if quote.type == 'market' and quote.side == 'bid':
+            return self.balances.available(
+                quote.account_id, self.uoa_id) > 0
+
+        asset_id, amount = self.cost(quote.side, quote.price, quote.qty)
+        available = self.balances.available(quote.account_id, asset_id)
+        if freed is not None:
+            available += self.cost(quote.side, freed.price, freed.qty)[1]
+        return available >= amount
+
+    # Reserve for a new order, False if funds are short
+    def reserve(self, quote):
+        if not self.affords(quote):
+            return False
+        if quote.type == 'limit' or quote.side == 'ask':
+            self.hold(quote.account_id, quote.side, quote.price, quote.qty)
+        return True
+
+    def hold(self, account_id, side, price, qty):
+        asset_id, amount = self.cost(side, price, qty)
+        self.balances.add(account_id, asset_id, 0, amount)
+
+    def release(self, account_id, side, price, qty):
+        asset_id, amount = self.cost(side, price, qty)
+        self.balances.add(account_id, asset_id, 0, -amount)
+
+    # Most a market bid can still buy at price
+    def affordable(self, account_id, price):
+        return self.balances.available(account_id, self.uoa_id) \
+            // (price * SCALE)
+
+    # Balance changes of one trade, as its ledger legs
+    def transfer(self, price, qty, taker_side, maker_account_id,
+        taker_account_id):
+        if taker_side == 'bid':
+            buyer, seller = taker_account_id, maker_account_id
+            buyer_bps, seller_bps = self.taker_bps, self.maker_bps
+        else:
+            buyer, seller = maker_account_id, taker_account_id
+            buyer_bps, seller_bps = self.maker_bps, self.taker_bps
+
+        add = self.balances.add
+        total = price * qty
+        add(seller, self.asset_id, -qty * SCALE, 0)
+        add(buyer, self.asset_id, qty * SCALE - qty * buyer_bps, 0)
+        add(buyer, self.uoa_id, -total * SCALE, 0)
+        add(seller, self.uoa_id, total * SCALE - total * seller_bps, 0)
+
+    # A fill of quote against the resting order maker
+    def trade(self, tx, quote, maker):
+        price, qty = tx['price'], tx['qty']
+        self.transfer(price, qty, quote.side, maker.account_id,
+            quote.account_id)
+
+        # The maker's reservation is at the trade price
+        maker_side = 'ask' if quote.side == 'bid' else 'bid'
+        self.release(maker.account_id, maker_side, price, qty)
+        if quote.type == 'limit':
+            self.release(quote.account_id, quote.side, quote.price, qty)
+        elif quote.side == 'ask':
+            self.release(quote.account_id, 'ask', 0, qty)
+
+    def hydrate(self, lob):
+        """Reserve for the orders resting in lob and apply its unsettled
+        tapes."""
+        for olist in (lob.bids, lob.asks):
+            for price, qty, account_id in olist.resting():
+                self.hold(account_id, olist.side, price, qty)
+
+        if not os.path.exists(lob.trades_dir):
+            return
+        for fname in sorted(os.listdir(lob.trades_dir)):
+            if fname.startswith('.'):
+                continue
+            for t in read_tape(lob.trades_dir / fname).tolist():
+                (time, price, qty, taker_side, maker_order_id,
+                    maker_account_id, taker_order_id, taker_account_id) = t
+                self.transfer(price, qty, SIDES[taker_side],
+                    maker_account_id, taker_account_id)
@@ -0,0 +1,81 @@
+import struct
+
+import numpy as np
+
+"""
+Trade tape files
+
+Written by OrderBook.flush_trades into cache/<market>/trades and read by
+trades2db. A file is a 16 byte header followed by fixed width records:
+
+    header  magic(4) version(u16) record size(u16) reserved(8)
+    record  8 x int64 little endian, in TAPE_KEYS order
+
+taker_side is stored as its index in SIDES. Version 0 is the original
+headerless csv format, one trade per line in TAPE_KEYS order.
+"""
+
+MAGIC = b'MXTP'
+VERSION = 1
+
+TAPE_KEYS = (
+    'time', 'price', 'qty', 'taker_side',
+    'maker_order_id', 'maker_account_id',
+    'taker_order_id', 'taker_account_id'
+)
+
+SIDES = ('bid', 'ask')
+SIDE_CODE = {s: i for i, s in enumerate(SIDES)}
+
+HEADER = struct.Struct('<4sHH8x')
+RECORD = struct.Struct('<8q')
+
+TAPE_DTYPE = np.dtype([(k, '<i8') for k in TAPE_KEYS])
+
+def write_tape(f, trades):
+    """Write trade dicts to an open binary file in one call."""
+    size = RECORD.size
+    buf = bytearray(HEADER.size + size * len(trades))
+    HEADER.pack_into(buf, 0, MAGIC, VERSION, size)
+
+    pack_into = RECORD.pack_into
+    offset = HEADER.size
+    for t in trades:
+        pack_into(buf, offset,
+            t['time'], t['price'], t['qty'], SIDE_CODE[t['taker_side']],
+            t['maker_order_id'], t['maker_account_id'],
+            t['taker_order_id'], t['taker_account_id'])
+        offset += size
+
+    f.write(buf)
+    return len(trades)
+
+def read_tape(path):
+    """Read a tape file into a TAPE_DTYPE array."""
+    with open(path, 'rb') as f:
+        head = f.read(HEADER.size)
+        if head[:len(MAGIC)] != MAGIC:
+            return read_tape_csv(path)
+
+        magic, version, size = HEADER.unpack(head)
+        if version != VERSION or size != TAPE_DTYPE.itemsize:
+            raise Exception('Unsupported tape version %d in %s' % (
+                version, path))
+
+        return np.fromfile(f, dtype=TAPE_DTYPE)
+
+def read_tape_csv(path):
+    rows = []
+    with open(path) as f:
+        for line in f.read().splitlines():
+            row = line.split(',')
+            row[3] = SIDE_CODE[row[3]]
+            rows.append(tuple(int(x) for x in row))
+    return np.array(rows, dtype=TAPE_DTYPE)
+
+def tape_csv(path):
+    """Yield a tape file as csv lines in the version 0 format."""
+    for row in read_tape(path).tolist():
+        row = list(row)
+        row[3] = SIDES[row[3]]
+        yield ','.join(str(x) for x in row)
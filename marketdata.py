@@ -0,0 +1,99 @@
+from datetime import datetime
+from decimal import Decimal
+
+import msgpack
+
+import config as cfg
+from config import DT_FORMAT
+
+"""
+Market data responses
+
+Builders for the read endpoints that don't depend on the web framework,
+shared by the Flask app (app.py) and the asyncio app (aioapp.py). They
+turn engine snapshots and query rows into what an endpoint returns; the
+apps only differ in how they wait on redis, the db and the cache files.
+"""
+
+BOOK_TTL = 1 # Seconds a book query result is served for
+MONEY_PLACES = Decimal('1e-10') # model.MoneyColumn is Numeric(20, 10)
+
+def parse_depth(value):
+    """Book depth from a query string value, None when invalid."""
+    if value is None:
+        return cfg.BOOK_DEPTH
+    try:
+        depth = int(value)
+    except ValueError:
+        return None
+    return depth if 0 < depth <= cfg.BOOK_DEPTH else None
+
+# A price as postgres renders a MoneyColumn as text, from the engine's
+# ints or book.sql's text alike
+def money_text(value):
+    return str(Decimal(str(value)).quantize(MONEY_PLACES))
+
+# Book rows as book.sql returns them. Levels are best first, totals
+# accumulate away from the spread and both sides are listed price asc.
+def book_rows(bids, asks):
+    rows = []
+    for side, levels in (('buy', bids), ('sell', asks)):
+        total = 0
+        out = []
+        for price, amount in levels:
+            total += amount
+            out.append({'side': side, 'price': money_text(price),
+                'amount': str(amount), 'total': str(total)})
+        rows.extend(reversed(out) if side == 'buy' else out)
+    return rows
+
+# From the engine's msgpack depth snapshot
+def snapshot_book(snapshot, depth):
+    book = msgpack.unpackb(snapshot)
+    return book_rows(book['bids'][:depth], book['asks'][:depth])
+
+# From book.sql rows
+def sql_book(rows, depth):
+    bids, asks = [], []
+    for row in rows:
+        level = (row['price'], int(row['amount']))
+        (bids if row['side'] == 'buy' else asks).append(level)
+    bids.sort(key=lambda x: -float(x[0]))
+    asks.sort(key=lambda x: float(x[0]))
+    return book_rows(bids[:depth], asks[:depth])
+
+# Trades as last_trades returns them, newest first
+def trade_rows(trades):
+    return [{
+        'created': datetime.utcfromtimestamp(t // 1000000).strftime(
+            DT_FORMAT),
+        'price': str(price),
+        'amount': str(qty),
+    } for t, price, qty, side in reversed(trades)]
+
+def last_trades(data):
+    return trade_rows(msgpack.unpackb(data)['trades'])
+
+def trades_event(msg):
+    return {'seq': msg['seq'], 'trades': trade_rows(msg['trades'])}
+
+def get_gini(data):
+    N = len(data)
+
+    prod = 0
+    total = 0
+
+    for i, amt in enumerate(data):
+        prod = prod + ((i+1)*amt)
+        total = total + amt
+
+    u = total/N
+    return (N+1.0)/(N-1.0) - (prod/(N*(N-1.0)*u))*2.0
+
+# From wealth.sql rows
+def wealth(rows):
+    result = [dict(row) for row in rows]
+    return {
+        'gini': get_gini([i['amount'] for i in result]),
+        'results': result
+    }
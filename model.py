@@ -103,8 +103,11 @@ class Account(Base):
     created = Column(DateTime, default=utcnow)
     modified = Column(DateTime, onupdate=utcnow)
 
+# Ledger sums, kept up to date by trades2db as it inserts ledgers. Checked
+# against the ledger with 'util reconcile'.
 class AccountAsset(Base):
     __tablename__ = 'account_asset'
+    __table_args__ = (UniqueConstraint('account_id', 'asset_id'),)
 
     id = Column(Integer, primary_key=True)
     account_id = Column(Integer, index=True)
@@ -112,6 +115,18 @@ class AccountAsset(Base):
     balance = MoneyColumn.copy()
     vol30d = Column(Integer, default=0)
 
+    # Created time of the first and last ledger
+    opening = Column(DateTime)
+    ending = Column(DateTime)
+
+# Last trade price, set by trades2db
+class MarketPrice(Base):
+    __tablename__ = 'market_price'
+
+    market_id = Column(Integer, ForeignKey('market.id'), primary_key=True)
+    price = MoneyColumn.copy()
+    modified = Column(DateTime, default=utcnow)
+
 class FeeSchedule(Base):
     __tablename__ = 'fee_schedule'
 
@@ -1,4 +1,6 @@
 import os
+import calendar
+import multiprocessing
 from pathlib import Path
 import json
 import humanize
@@ -10,16 +12,20 @@ import shutil
 import types
 import time
 from datetime_truncate import truncate
-from itertools import groupby
 import glob
 import dateutil.parser
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from decimal import Decimal
 
+import numpy as np
+
+from barstore import BarStore, BAR_DTYPE, bars_from_rows, rows_from_bars
+from respcache import file_version
+
 from sqlalchemy import create_engine, and_, or_, func
 from sqlalchemy.orm import Session, joinedload
 
-from config import SQL, CACHE_DIR, DT_FORMAT
+from config import SQL, CACHE_DIR, DT_FORMAT, DB_CONN
 from model import (Account, Market, Asset, Event, Order, Trade, Ledger)
 
 
@@ -42,8 +48,31 @@ for i in INTERVALS:
         attr
     ]
 
+UNIT_SECS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+INTERVAL_SECS = {
+    i: num * UNIT_SECS[attr] for i, (num, attr) in INTERVAL_PARTS.items()
+}
+
+# Each interval is merged from the bars of a finer one that divides it.
+# Only 1m bars are computed from trades.
+ROLLUP_FROM = {
+    '5m'  : '1m',
+    '15m' : '5m',
+    '1h'  : '15m',
+    '6h'  : '1h',
+    '1d'  : '6h',
+}
+
+WEEK_OFFSET = 4 * 86400 # 1970-01-05 was the first monday
+
 FRAME_COUNT = 500
 
+CHUNK_DAYS = 7 # Days of 1m bars per parallel init job
+
+OPEN_FILE = '.open.json' # Open bars of OHLCAggregator
+ADVANCE_LAG = 5 # Seconds of slack for trades still on their way
+
 """
  1d/YYYY/YYYY.json                    year    (365 rows)
  6h/YYYY/QQ/YYYY-QQ.json              quarter (360 rows)
@@ -96,6 +125,367 @@ PG_TRUNCATE = {
 
 JSONL_KEYS = ('dt', 'time', 'open', 'high', 'low', 'close', 'volume', 'value')
 
+def aggfmt(dt, interval):
+    (frame, fmt) = INTERVAL_AGGREGATE[interval]
+    out = ''
+    if isinstance(fmt, types.FunctionType):
+        out = fmt(dt)
+    else:
+        out = dt.strftime(fmt)
+    return out + '.jsonl'
+
+def write_file(path, text):
+    to_dir = os.path.dirname(path)
+    if not os.path.exists(to_dir):
+        os.makedirs(to_dir)
+    to_tmp = str(path) + '.tmp'
+    f = open(to_tmp, 'w')
+    f.write(text)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(to_tmp, path)
+
+def last24_summary(m, last24):
+    """Summarize the last 24 1h rows for last24.json."""
+    groups = [(i.get('open'), i.get('low'), i.get('high'), i.get('close'), i.get('volume')) for i in last24]
+    (opens, lows, highs, closes, volumes) = list(zip(*groups))
+    first = None
+    last = None
+    # Get the first existing open
+    for x in opens:
+        first = x
+        if first:
+            break
+    # Get the last existing close
+    for x in reversed(closes):
+        last = x
+        if last:
+            break
+    data = {
+        'market_id' : m.id,
+        'code'      : m.code,
+        'name'      : m.name,
+        'open'      : first,
+        'high'      : max((i for i in highs if i is not None), default=None),
+        'low'       : min((i for i in lows if i is not None), default=None),
+        'close'     : last,
+        'volume'    : sum(i for i in volumes if i is not None),
+        'change'    : 0,
+        'avg_price' : 0
+    }
+    try:
+        # This is median; need to have avg included in ohlc
+        data['avg_price'] = ((data['high'] - data['low']) / 2) + data['low']
+        data['change'] = (data['close'] - data['open']) / data['open']
+    except:
+        pass
+    return data
+
+def read_open_bars(code):
+    to_path = CACHE_DIR / code / 'ohlc' / OPEN_FILE
+    if not os.path.exists(to_path):
+        return {}
+    with open(to_path) as f:
+        return json.loads(f.read())
+
+def fold_open_bars(code):
+    """Put the aggregator's open bars back as the last row of their page,
+    the layout create_json and append_json work with."""
+    bars = read_open_bars(code)
+    for i, row in bars.items():
+        dt = datetime.utcfromtimestamp(row['time'])
+        append_lines(CACHE_DIR / code / 'ohlc' / i / aggfmt(dt, i),
+            [json.dumps(row)])
+    if bars:
+        os.remove(CACHE_DIR / code / 'ohlc' / OPEN_FILE)
+
+def bar_store(code, interval):
+    return BarStore(CACHE_DIR / code / 'bars' / interval)
+
+def jsonl_pages(code, interval):
+    return sorted(glob.glob(str(CACHE_DIR / code / 'ohlc' / interval /
+        '**/*.jsonl'), recursive=True))
+
+def take_open_bars(code):
+    """Open bars of a market. Where there is none, the last row of the
+    latest page is taken back as the open bar."""
+    bars = read_open_bars(code)
+    for i in INTERVALS:
+        if i in bars:
+            continue
+        files = jsonl_pages(code, i)
+        if not files:
+            continue
+        with open(files[-1]) as f:
+            lines = f.read().splitlines()
+        if not lines:
+            continue
+        bars[i] = json.loads(lines.pop())
+        if lines:
+            write_file(files[-1], '\n'.join(lines))
+        else:
+            os.remove(files[-1])
+    write_file(CACHE_DIR / code / 'ohlc' / OPEN_FILE, json.dumps(bars))
+    return bars
+
+def cache_version(code, interval):
+    """Changes whenever get_cached(code, interval) with the default date
+    range can return something else."""
+    version = file_version(CACHE_DIR / code / 'ohlc' / OPEN_FILE,
+        bar_store(code, interval).path)
+    if version == (None, None):
+        # Pages written by append_json, the latest changes
+        version = file_version(*jsonl_pages(code, interval)[-1:])
+    # The date range slides into a new first page
+    start = OHLC(None).get_date_range(interval)[0]
+    return version + (aggfmt(start, interval),)
+
+def migrate_jsonl(code):
+    """Move a market's JSONL pages into bar stores. Returns the number
+    of bars moved per interval."""
+    take_open_bars(code)
+    counts = {}
+    for i in INTERVALS:
+        rows = []
+        for fname in jsonl_pages(code, i):
+            with open(fname) as f:
+                rows.extend(json.loads(x) for x in f.read().splitlines())
+        counts[i] = bar_store(code, i).append(bars_from_rows(rows))
+        path = CACHE_DIR / code / 'ohlc' / i
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    return counts
+
+def append_lines(path, lines):
+    to_dir = os.path.dirname(path)
+    if not os.path.exists(to_dir):
+        os.makedirs(to_dir)
+    # Pages have no trailing newline
+    sep = '\n' if os.path.exists(path) and os.path.getsize(path) else ''
+    with open(path, 'a') as f:
+        f.write(sep + '\n'.join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+def bar_starts(times, interval):
+    """Start of the bar each of times (epoch seconds) falls in."""
+    (num, attr) = re.match(r"(\d+)([\w])", interval).groups()
+    num = int(num)
+    times = np.asarray(times)
+    if attr == 'M':
+        months = times.astype('datetime64[s]').astype('datetime64[M]') \
+            .astype(np.int64)
+        months -= months % num
+        return months.astype('datetime64[M]').astype('datetime64[s]') \
+            .astype(np.int64)
+    size = num * UNIT_SECS[attr]
+    offset = WEEK_OFFSET if attr == 'w' else 0
+    return times - (times - offset) % size
+
+def next_start(start, interval):
+    if interval.endswith('M'):
+        num = int(interval[:-1])
+        dt = datetime.utcfromtimestamp(start) + relativedelta(months=num)
+        return calendar.timegm(dt.utctimetuple())
+    return start + INTERVAL_SECS[interval]
+
+def rollup(bars, interval):
+    """Merge a BAR_DTYPE array in time order into interval's bars. Empty
+    bars (open 0) only add their period."""
+    out = np.zeros(0, dtype=BAR_DTYPE)
+    if not len(bars):
+        return out
+    starts = bar_starts(bars['time'], interval)
+    firsts = np.r_[0, np.flatnonzero(np.diff(starts)) + 1]
+
+    full = bars['open'] != 0
+    idx = np.arange(len(bars))
+    first_full = np.minimum.reduceat(np.where(full, idx, len(bars)), firsts)
+    last_full = np.maximum.reduceat(np.where(full, idx, -1), firsts)
+    empty = last_full < 0
+    first_full[empty] = 0
+    last_full[empty] = 0
+
+    out = np.zeros(len(firsts), dtype=BAR_DTYPE)
+    out['time'] = starts[firsts]
+    out['open'] = np.where(empty, 0, bars['open'][first_full])
+    out['high'] = np.where(empty, 0, np.maximum.reduceat(
+        np.where(full, bars['high'], -np.inf), firsts))
+    out['low'] = np.where(empty, 0, np.minimum.reduceat(
+        np.where(full, bars['low'], np.inf), firsts))
+    out['close'] = np.where(empty, 0, bars['close'][last_full])
+    out['volume'] = np.add.reduceat(bars['volume'], firsts)
+    return out
+
+# Parallel init workers, see OHLC.init_parallel
+worker_ohlc = None
+
+def init_worker():
+    global worker_ohlc
+    worker_ohlc = OHLC(Session(create_engine(DB_CONN)))
+
+def fetch_bars(job):
+    (code, market_id, start, end) = job
+    return code, start, worker_ohlc.get_bars(market_id, start, end)
+
+def pad_bars(bars, interval, start):
+    """Prepend empty bars from start to the first of bars."""
+    first = bars['time'][0] if len(bars) else start
+    times = []
+    while start < first:
+        times.append(start)
+        start = next_start(start, interval)
+    pad = np.zeros(len(times), dtype=BAR_DTYPE)
+    pad['time'] = times
+    return np.concatenate((pad, bars))
+
+# A bar is [start, open, high, low, close, volume], open None if empty
+def bar_row(bar):
+    start, o, h, l, c, v = bar
+    data = OrderedDict()
+    data['dt'] = datetime.utcfromtimestamp(start).strftime(DT_FORMAT)
+    data['time'] = start
+    if o:
+        for k, x in zip(('open', 'high', 'low', 'close', 'volume'),
+            (o, h, l, c, v)):
+            data[k] = int(x) if x == int(x) else float(x)
+        data['value'] = data['volume']
+    return data
+
+def row_bar(row):
+    return [row['time'], row.get('open'), row.get('high'), row.get('low'),
+        row.get('close'), row.get('volume', 0)]
+
+
+class OHLCAggregator():
+    """
+    Streaming OHLC for one market, fed by trades2db.
+
+    The open bar of each interval is kept in memory and updated per batch
+    of trades. Only completed bars are appended to their page. Open bars
+    live in ohlc/.open.json, and get_cached adds each to its page, so its
+    output is unchanged.
+
+    Pages written by create_json or append_json end with the bar that was
+    open at the time. On first load it is taken back as the open bar.
+    Intervals migrated to a bar store (util migrate) are appended there
+    instead of to pages.
+    """
+    def __init__(self, market):
+        self.market = market
+        self.path = CACHE_DIR / market.code / 'ohlc'
+        self.bars = {i: None for i in INTERVALS}
+        self.closed = {i: [] for i in INTERVALS}
+        self.hours = deque(maxlen=24) # Closed 1h rows, for last24.json
+        self.load()
+
+    def load(self):
+        code = self.market.code
+        for i, row in take_open_bars(code).items():
+            self.bars[i] = row_bar(row)
+
+        store = bar_store(code, '1h')
+        if store.exists():
+            self.hours.extend(rows_from_bars(store.read()[-24:]))
+        else:
+            for fname in jsonl_pages(code, '1h')[-2:]:
+                with open(fname) as f:
+                    self.hours.extend(
+                        json.loads(x) for x in f.read().splitlines())
+
+    def add(self, times, prices, qtys):
+        """Add trades in time order: tape columns, times in usecs."""
+        if not len(times):
+            return
+        # Each trade as a bar, rolled up to 1m and on from there
+        trades = np.zeros(len(times), dtype=BAR_DTYPE)
+        trades['time'] = np.maximum.accumulate(np.asarray(times) // 1000000)
+        for k in ('open', 'high', 'low', 'close'):
+            trades[k] = prices
+        trades['volume'] = qtys
+
+        bars = {}
+        for i in INTERVALS:
+            bars[i] = rollup(bars[ROLLUP_FROM[i]] if i in ROLLUP_FROM
+                else trades, i)
+            for start, o, h, l, c, v in bars[i].tolist():
+                self.update(i, start, o, h, l, c, v)
+
+    def update(self, i, start, o, h, l, c, v):
+        bar = self.bars[i]
+        if bar and start < bar[0]:
+            # Late trades go in the open bar
+            start = bar[0]
+        if bar and bar[0] == start:
+            if bar[1]:
+                bar[2] = max(bar[2], h)
+                bar[3] = min(bar[3], l)
+                bar[4] = c
+                bar[5] += v
+            else:
+                bar[1:] = [o, h, l, c, v]
+            return
+        self.roll(i, start)
+        self.bars[i] = [start, o, h, l, c, v]
+
+    def advance(self, now=None):
+        """Close the bars that ended before now, opening empty ones."""
+        if now is None:
+            now = time.time() - ADVANCE_LAG
+        now = int(now)
+        for i in INTERVALS:
+            start = int(bar_starts(now, i))
+            bar = self.bars[i]
+            if not bar or bar[0] < start:
+                self.roll(i, start)
+                self.bars[i] = [start, None, None, None, None, 0]
+
+    # Close the open bar and fill the gap to start with empty bars
+    def roll(self, i, start):
+        bar = self.bars[i]
+        if not bar:
+            return
+        self.close(i, bar)
+        s = next_start(bar[0], i)
+        while s < start:
+            self.close(i, [s, None, None, None, None, 0])
+            s = next_start(s, i)
+
+    def close(self, i, bar):
+        self.closed[i].append(bar)
+        if i == '1h':
+            self.hours.append(bar_row(bar))
+
+    def flush(self):
+        for i in INTERVALS:
+            store = bar_store(self.market.code, i)
+            if store.exists():
+                store.append(bars_from_rows(
+                    [bar_row(bar) for bar in self.closed[i]]))
+                self.closed[i] = []
+                continue
+            pages = OrderedDict()
+            for bar in self.closed[i]:
+                rel_path = aggfmt(datetime.utcfromtimestamp(bar[0]), i)
+                pages.setdefault(rel_path, []).append(json.dumps(bar_row(bar)))
+            for rel_path, lines in pages.items():
+                append_lines(self.path / i / rel_path, lines)
+            self.closed[i] = []
+        self.write_open()
+
+        last24 = list(self.hours)
+        if self.bars['1h']:
+            last24.append(bar_row(self.bars['1h']))
+        if last24:
+            data = last24_summary(self.market, last24[-24:])
+            write_file(CACHE_DIR / self.market.code / 'last24.json',
+                json.dumps(data))
+
+    def write_open(self):
+        bars = {i: bar_row(bar) for i, bar in self.bars.items() if bar}
+        write_file(self.path / OPEN_FILE, json.dumps(bars))
+
 class OHLC:
     def __init__(self, session, args={}):
         self.db = session
@@ -109,13 +499,7 @@ class OHLC:
             print(*args)
 
     def _aggfmt(self, dt, interval):
-        (frame, fmt) = INTERVAL_AGGREGATE[interval]
-        out = ''
-        if isinstance(fmt, types.FunctionType):
-            out = fmt(dt)
-        else:
-            out = dt.strftime(fmt)
-        return out + '.jsonl'
+        return aggfmt(dt, interval)
 
     def get_range(self, interval, start, end):
         (num, attr) = INTERVAL_PARTS[interval]
@@ -171,22 +555,54 @@ class OHLC:
 
         return q.all()
 
-    def init_cache(self, markets, overwrite=False):
-        for m in self._get_markets(markets):
+    def init_cache(self, markets, overwrite=False, workers=1):
+        markets = self._get_markets(markets)
+        migrated = []
+        for m in markets:
+            if os.path.exists(CACHE_DIR / m.code / 'bars'):
+                migrated.append(m.code)
             if overwrite:
-                shutil.rmtree(CACHE_DIR / m.code / 'ohlc')
-            self.create_json(m)
+                for d in ('ohlc', 'bars'):
+                    if os.path.exists(CACHE_DIR / m.code / d):
+                        shutil.rmtree(CACHE_DIR / m.code / d)
+
+        if workers > 1:
+            self.init_parallel(markets, workers)
+        else:
+            for m in markets:
+                self.create_json(m)
+
+        for code in migrated:
+            migrate_jsonl(code)
 
     def update_cache(self, markets=['all']):
         for m in self._get_markets(markets):
+            if os.path.exists(CACHE_DIR / m.code / 'bars'):
+                print('Skip %s, its bar store is updated by trades2db.' % (
+                    m.name))
+                continue
             self.append_json(m)
 
+    def migrate(self, codes):
+        """Convert the JSONL pages of markets to bar stores."""
+        if 'all' in codes:
+            codes = sorted(os.listdir(CACHE_DIR))
+        for code in codes:
+            if not os.path.exists(CACHE_DIR / code / 'ohlc'):
+                continue
+            begin = time.time()
+            counts = migrate_jsonl(code)
+            print('Migrated %s:' % code, ', '.join(
+                '%s:%d' % (i, counts[i]) for i in INTERVALS),
+                'took %.2fs' % (time.time() - begin))
+
     def append_json(self, m):
         state_keys = ('open','high','low','close','volume')
         state_file = CACHE_DIR / m.code / 'ohlc' / '.state.json'
 
         summary_begin = time.time()
         self.log("Processing",m.name)
+        fold_open_bars(m.code)
 
         # 1. Get previous state
         state = {}
@@ -245,24 +661,30 @@ class OHLC:
         trades = q.all()
 
 
-        # 3. Compute ohlcv updates
+        # 3. Compute ohlcv updates, 1m from trades and rolled up from there
+        tbars = np.zeros(len(trades), dtype=BAR_DTYPE)
+        tbars['time'] = [calendar.timegm(t.created.utctimetuple())
+            for t in trades]
+        for k in ('open', 'high', 'low', 'close'):
+            tbars[k] = [t.price for t in trades]
+        tbars['volume'] = [t.amount for t in trades]
+
         updates = {}
+        bars = {}
         for i in INTERVALS:
             updates[i] = {}
-            for key, group in groupby(trades, key=lambda x: truncate(x.created, TRUNCATE[i])):
-                groups = [(i.price, i.amount, i.id) for i in list(group)]
-                (prices, amounts, ids) = list(zip(*groups))
-
-                data = {
+            bars[i] = rollup(bars[ROLLUP_FROM[i]] if i in ROLLUP_FROM
+                else tbars, i)
+            for start, o, h, l, c, v in bars[i].tolist():
+                key = datetime.utcfromtimestamp(start)
+                updates[i][key] = {
                     'dt'     : key,
-                    'open'   : prices[0],
-                    'high'   : max(prices),
-                    'low'    : min(prices),
-                    'close'  : prices[-1],
-                    'volume' : sum(amounts),
-                    'last_trade_id' : ids[-1]
+                    'open'   : o,
+                    'high'   : h,
+                    'low'    : l,
+                    'close'  : c,
+                    'volume' : v,
                 }
-                updates[i][key] = data
 
 
         # If there are no trades we need to create empty periods
@@ -400,38 +822,7 @@ class OHLC:
         last24 = list(map(lambda x: json.loads(x), reversed(last24)))
 
         if len(last24):
-            groups = [(i.get('open'), i.get('low'), i.get('high'), i.get('close'), i.get('volume')) for i in last24]
-            (opens, lows, highs, closes, volumes) = list(zip(*groups))
-            first = None
-            last = None
-            # Get the first existing open
-            for x in opens:
-                first = x
-                if first:
-                    break
-            # Get the last existing close
-            for x in reversed(closes):
-                last = x
-                if last:
-                    break
-            data = {
-                'market_id' : m.id,
-                'code'      : m.code,
-                'name'      : m.name,
-                'open'      : first,
-                'high'      : max(i for i in highs if i is not None),
-                'low'       : min(i for i in lows if i is not None),
-                'close'     : last,
-                'volume'    : sum(i for i in volumes if i is not None),
-                'change'    : 0,
-                'avg_price' : 0
-            }
-            try:
-                # This is median; need to have avg included in ohlc
-                data['avg_price'] = ((data['high'] - data['low']) / 2) + data['low']
-                data['change'] = (data['close'] - data['open']) / data['open']
-            except:
-                pass
+            data = last24_summary(m, last24)
             self.log(data)
 
             to_path = CACHE_DIR / m.code / 'last24.json'
@@ -471,48 +862,72 @@ class OHLC:
 
 
     def create_json(self, m):
+        plan = self.plan_json(m)
+        if plan:
+            (todo, fetch_start, end) = plan
+            minutes = self.get_bars(m.id, fetch_start, end)
+            self.write_json(m, todo, minutes)
+
+    # Pages to write, and the range of 1m bars they need
+    def plan_json(self, m):
 
         start = m.first_trade
         end = self.now
 
-        summary_begin = time.time()
+        fold_open_bars(m.code)
         print('Init ohlc for market',m.name,'between dates:')
         print(start.strftime(DT_FORMAT), '->', end.strftime(DT_FORMAT))
         self.log(start, type(start), start.tzinfo)
         self.log(end, type(end), end.tzinfo)
-        summary_out = {}
+
+        # Pages that are missing or still open
+        todo = OrderedDict()
         for interval in INTERVALS:
+            todo[interval] = []
             for sr in self.get_span_range(interval, start, end):
                 rel_path = self._aggfmt(sr[0], interval)
                 to_path = CACHE_DIR / m.code / 'ohlc' / interval / rel_path
-                to_tmp = str(to_path) + '.tmp'
-                to_dir = os.path.dirname(to_path)
-
                 if os.path.exists(to_path) and self.now > sr[1]:
                     continue
+                todo[interval].append((sr, rel_path, to_path))
 
-                if not os.path.exists(to_dir):
-                    os.makedirs(to_dir)
+        firsts = [spans[0][0][0] for spans in todo.values() if spans]
+        if not firsts:
+            print('Cache is up to date.')
+            return None
+
+        return (todo, max(min(firsts), truncate(start, 'day')), end)
+
+    def write_json(self, m, todo, minutes):
+        # Only 1m bars come from the db, the rest are rolled up from them
+        summary_begin = begin = time.time()
+        bars = {'1m': minutes}
+        for interval in INTERVALS[1:]:
+            bars[interval] = rollup(bars[ROLLUP_FROM[interval]], interval)
+        self.log("%d 1m bars, rollup took %5.2fs" % (
+            len(bars['1m']), time.time() - begin))
 
+        summary_out = {}
+        for interval, spans in todo.items():
+            if not spans:
+                continue
+            # Empty bars back to the first page start
+            bars[interval] = pad_bars(bars[interval], interval,
+                calendar.timegm(spans[0][0][0].utctimetuple()))
+            times = bars[interval]['time']
+
+            for sr, rel_path, to_path in spans:
                 self.log("%s %-3s %-17s" % (m.name.lower(), interval,
                     rel_path), end='')
 
                 begin = time.time()
 
-                end_get = end if sr[1] > end else sr[1]
-                r = self.get(m.id, interval, sr[0], end_get)
-                lines = []
-                for row in r:
-                    lines.append(json.dumps(row))
-
-                f = open(to_tmp, 'w')
-                out = "\n".join(lines)
-                f.write(out)
-                f.flush()
-                os.fsync(f.fileno())
-                f.close()
-
-                os.rename(to_tmp, to_path)
+                lo = np.searchsorted(times,
+                    calendar.timegm(sr[0].utctimetuple()), 'left')
+                hi = np.searchsorted(times,
+                    calendar.timegm(sr[1].utctimetuple()), 'right')
+                r = rows_from_bars(bars[interval][lo:hi])
+                write_file(to_path, "\n".join(json.dumps(row) for row in r))
 
                 rows = len(r)
                 size = os.path.getsize(to_path)
@@ -526,10 +941,65 @@ class OHLC:
                     time.time() - begin
                 ))
 
-        print('Cache updated:', ', '.join(['%s:%d' % (i,summary_out[i]) for i in INTERVALS]))
+        print('Cache updated for %s:' % m.name, ', '.join(['%s:%d' % (i,summary_out.get(i, 0)) for i in INTERVALS]))
         print('Took %f seconds' % (time.time() - summary_begin))
         print()
 
+    def get_bars(self, market_id, start, end):
+        """1m bars from the db, a day per query."""
+        pages = [np.zeros(0, dtype=BAR_DTYPE)]
+        for sr in self.get_span_range('5m', start, end):
+            end_get = end if sr[1] > end else sr[1]
+            pages.append(bars_from_rows(self.get(market_id, '1m',
+                sr[0], end_get)))
+        return np.concatenate(pages)
+
+    def init_parallel(self, markets, workers):
+        """create_json for many markets with the 1m bar queries spread
+        over a pool of workers, each with its own db connection. Work is
+        split into CHUNK_DAYS days of a market. Pages of a market are
+        written as soon as all its chunks are in."""
+        summary_begin = time.time()
+        plans = OrderedDict()
+        jobs = []
+        for m in markets:
+            plan = self.plan_json(m)
+            if not plan:
+                continue
+            (todo, start, end) = plan
+            days = self.get_span_range('5m', start, end)
+            count = 0
+            for i in range(0, len(days), CHUNK_DAYS):
+                chunk = days[i:i + CHUNK_DAYS]
+                jobs.append((m.code, m.id, chunk[0][0],
+                    min(chunk[-1][1], end)))
+                count += 1
+            plans[m.code] = (m, todo, count, {})
+        if not jobs:
+            return
+
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(workers, initializer=init_worker) as pool:
+            done = 0
+            bar_count = 0
+            for code, start, minutes in pool.imap_unordered(
+                fetch_bars, jobs):
+                (m, todo, count, chunks) = plans[code]
+                chunks[start] = minutes
+                done += 1
+                bar_count += len(minutes)
+                elapsed = time.time() - summary_begin
+                print('%d/%d chunks, %d 1m bars, %.0f bars/s' % (
+                    done, len(jobs), bar_count, bar_count / elapsed))
+
+                if len(chunks) == count:
+                    minutes = np.concatenate([chunks[k] for k in sorted(chunks)])
+                    self.write_json(m, todo, minutes)
+                    del plans[code]
+
+        print('Init took %f seconds for %d markets, %d chunks' % (
+            time.time() - summary_begin, len(markets), len(jobs)))
+
     def get_last24_cached(self, m):
         if m:
             data = {}
@@ -577,6 +1047,24 @@ class OHLC:
         if type(m) == int:
             m = self.db.query(Market).get(m)
 
+        # The open bar goes at the end of its page
+        open_row = read_open_bars(m.code).get(interval)
+
+        store = bar_store(m.code, interval)
+        if store.exists():
+            spans = self.get_span_range(interval, start, end)
+            lo = calendar.timegm(spans[0][0].utctimetuple())
+            hi = calendar.timegm(spans[-1][1].utctimetuple())
+            results = rows_from_bars(store.range(lo, hi))
+            if open_row and lo <= open_row['time'] <= hi:
+                results.append(open_row)
+            return results
+
+        open_page = None
+        if open_row:
+            open_page = aggfmt(
+                datetime.utcfromtimestamp(open_row['time']), interval)
+
         results = []
         for sr in self.get_span_range(interval, start, end):
             rel_path = self._aggfmt(sr[0], interval)
@@ -585,6 +1073,8 @@ class OHLC:
                 with open(to_path, 'r') as f:
                     page = [json.loads(x) for x in f.read().split("\n")]
                     results.extend(page)
+            if rel_path == open_page:
+                results.append(open_row)
 
         return results
 
@@ -1,10 +1,38 @@
+
 import shortuuid
 import msgpack
 
+# Move up to ARGV[1] of the oldest messages to the processing list (newest
+# first, like BRPOPLPUSH) and return them newest first.
+DEQUEUE_SCRIPT = """
+local msgs = redis.call('LRANGE', KEYS[1], -ARGV[1], -1)
+if #msgs > 0 then
+    redis.call('LTRIM', KEYS[1], 0, -#msgs - 1)
+    for i = #msgs, 1, -1 do
+        redis.call('LPUSH', KEYS[2], msgs[i])
+    end
+end
+return msgs
+"""
+
+# Put unacknowledged messages back at the head of the queue, oldest first.
+RECOVER_SCRIPT = """
+local msgs = redis.call('LRANGE', KEYS[2], 0, -1)
+for i = 1, #msgs, 1000 do
+    redis.call('RPUSH', KEYS[1], unpack(msgs, i, math.min(i + 999, #msgs)))
+end
+redis.call('DEL', KEYS[2])
+return #msgs
+"""
+
 class SimpleQueue(object):
     def __init__(self, conn, name):
         self.conn = conn
         self.name = name
+        self.processing = name + ':processing'
+
+        self._dequeue_script = conn.register_script(DEQUEUE_SCRIPT)
+        self._recover_script = conn.register_script(RECOVER_SCRIPT)
 
     def enqueue(self, method, *args):
         task = [
@@ -16,11 +44,62 @@ class SimpleQueue(object):
         self.conn.lpush(self.name, msg)
         return task[0]
 
+    # Queue many events as one message: [id, 'batch', [[method, args..]..]]
+    def enqueue_batch(self, tasks):
+        task = [
+            str(shortuuid.uuid()),
+            'batch',
+            [[method, *args] for method, *args in tasks]
+        ]
+        msg = msgpack.packb(task)
+        self.conn.lpush(self.name, msg)
+        return task[0]
+
     def dequeue(self):
         _, msg = self.conn.brpop(self.name)
         task = msgpack.unpackb(msg)
         return task
 
+    # Dequeue up to max_n tasks, oldest first, in one round trip.
+    #
+    # timeout None returns immediately when the queue is empty. Otherwise
+    # block up to timeout seconds (0 is forever) for the first message.
+    #
+    # With processing=True, dequeued messages are kept in the processing
+    # list until ack(), and recover() requeues them after a crash.
+    def dequeue_many(self, max_n, timeout=None, processing=False):
+        if processing:
+            msgs = self._dequeue_script(
+                keys=[self.name, self.processing], args=[max_n])
+        else:
+            pipe = self.conn.pipeline()
+            pipe.lrange(self.name, -max_n, -1)
+            pipe.ltrim(self.name, 0, -max_n - 1)
+            msgs, _ = pipe.execute()
+
+        if not msgs and timeout is not None:
+            if processing:
+                msg = self.conn.brpoplpush(
+                    self.name, self.processing, timeout)
+            else:
+                msg = self.conn.brpop(self.name, timeout)
+                msg = msg[1] if msg else None
+            if not msg:
+                return []
+            tasks = [msgpack.unpackb(msg)]
+            if max_n > 1:
+                tasks += self.dequeue_many(max_n - 1, None, processing)
+            return tasks
+
+        return [msgpack.unpackb(msg) for msg in reversed(msgs)]
+
+    # Everything dequeued so far is durable, forget it.
+    def ack(self):
+        self.conn.delete(self.processing)
+
+    def recover(self):
+        return self._recover_script(keys=[self.name, self.processing])
+
     def get_length(self):
         return self.conn.llen(self.name)
 
@@ -0,0 +1,75 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+"""
+Response cache for market data endpoints
+
+Encoded JSON bodies are kept in an LRU keyed by (endpoint, market,
+interval). Each entry is stored with a version, usually the mtime and
+size of the cache files it was built from (file_version), and is rebuilt
+when the version a request computes differs. Entries carry an ETag, the
+hash of the body, for If-None-Match -> 304.
+"""
+
+CACHE_SIZE = 1024 # Entries
+
+def file_version(*paths):
+    """mtime and size of each path, None when missing."""
+    out = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            out.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            out.append(None)
+    return tuple(out)
+
+def etag_matches(header, etag):
+    """True if an If-None-Match header value matches etag."""
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+class ResponseCache():
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict() # key -> (version, body, etag)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        """(body, etag) for key, calling build() for the body bytes when
+        there is no entry at this version."""
+        # Built outside the lock, concurrent misses may both build
+        return self.lookup(key, version) or self.put(key, version, build())
+
+    def lookup(self, key, version):
+        """(body, etag) of the entry at this version, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        return None
+
+    def put(self, key, version, body):
+        etag = '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+        with self.lock:
+            self.entries[key] = (version, body, etag)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return body, etag
@@ -0,0 +1,221 @@
+import io
+from datetime import datetime
+
+import numpy as np
+
+from config import SQL
+from lob.tape import SIDE_CODE
+
+"""
+Columnar trade settlement
+
+A tape (see lob/tape.py) is settled a whole array at a time: trades, two
+trade sides and six ledger legs per trade are computed with numpy and
+written with COPY instead of one ORM object per row.
+
+Fee rates are integer basis points, so every amount is exact in fixed
+point with SCALE (4) decimal places. Values are kept as int64 scaled by
+SCALE, which holds trade totals up to ~9e14.
+
+Ledger legs of each trade, in order:
+    seller  asset  -amount
+    buyer   asset   amount - amount fee
+    fees    asset   amount fee
+    buyer   uoa    -total
+    seller  uoa     total - total fee
+    fees    uoa     total fee
+
+The buyer pays the amount fee at their side's rate (taker when the taker
+bids), the seller pays the total fee at theirs.
+
+In the same transaction the legs are netted per account and asset and
+added to the materialized balances (account_asset), and the last trade
+price is saved (market_price).
+"""
+
+SCALE = 10000 # Fee rates are in basis points
+
+# shortuuid's alphabet. 22 characters of it hold 128 bits.
+UUID_ALPHABET = np.frombuffer(
+    b'23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz', dtype='S1')
+UUID_LEN = 22
+
+NULL = b'\\N'
+
+def uuids(count, rng=None):
+    """Random shortuuid style ids, as a bytes array."""
+    rng = rng or np.random.default_rng()
+    chars = UUID_ALPHABET[rng.integers(0, len(UUID_ALPHABET),
+        (count, UUID_LEN), dtype=np.uint8)]
+    return chars.view('S%d' % UUID_LEN).ravel()
+
+def decimal_cols(n):
+    """Split fixed point values into sign, whole and fraction columns for
+    the '%s%d.%04d' format."""
+    sign = np.where(n < 0, b'-', b'')
+    n = np.abs(n)
+    return [sign, n // SCALE, n % SCALE]
+
+def decimal(n):
+    """Format one fixed point value."""
+    return b'%s%d.%04d' % (b'-' if n < 0 else b'', abs(n) // SCALE,
+        abs(n) % SCALE)
+
+def copy_text(fmt, cols):
+    """Render rows for COPY FROM STDIN (text format). fmt holds one row
+    as bytes, cols are equal length columns for its fields, in order."""
+    count = len(cols[0])
+    if not count:
+        return b''
+    rows = np.empty((count, len(cols)), dtype=object)
+    for i, col in enumerate(cols):
+        rows[:, i] = col
+    return (fmt * count) % tuple(rows.ravel().tolist())
+
+def copy_rows(cursor, table, columns, fmt, cols):
+    buf = io.BytesIO(copy_text(fmt, cols))
+    cursor.copy_expert('COPY %s (%s) FROM STDIN' % (
+        table, ', '.join(columns)), buf)
+
+
+class Settlement():
+    """
+    Trades, trade sides and ledger legs for one tape array.
+
+    trade_side_ids are the ids for the 2 * len(tape) trade sides (maker,
+    taker per trade), allocated up front from the trade_side sequence so
+    ledger rows can reference them. Without them the reference is null.
+    """
+    def __init__(self, tape, market, fee_account_id, maker_bps, taker_bps,
+        trade_side_ids=None, created=None, rng=None):
+
+        count = len(tape)
+        self.count = count
+        self.market = market
+        self.created_dt = created or datetime.utcnow()
+        self.created = self.created_dt.isoformat().encode()
+
+        price = tape['price']
+        amount = tape['qty']
+        total = price * amount
+        taker_bid = tape['taker_side'] == SIDE_CODE['bid']
+
+        # Trades
+        self.trade_uuid = uuids(count, rng)
+        self.trade_created = (tape['time'] // 1000000).astype(
+            'datetime64[s]').astype('S19')
+        self.price = price
+        self.amount = amount
+
+        # Trade sides, maker then taker for each trade
+        self.side_uuid = uuids(count * 2, rng)
+        self.side_type = np.tile([b'maker', b'taker'], count)
+        self.side_trade_uuid = np.repeat(self.trade_uuid, 2)
+        self.side_account_id = np.column_stack((
+            tape['maker_account_id'], tape['taker_account_id'])).ravel()
+        self.side_fee_rate = np.tile(
+            [decimal(maker_bps), decimal(taker_bps)], count)
+        if trade_side_ids is None:
+            self.side_id = None
+            maker_side = taker_side = np.full(count, NULL)
+        else:
+            self.side_id = np.asarray(trade_side_ids)
+            side_ref = self.side_id.astype('S20')
+            maker_side = side_ref[0::2]
+            taker_side = side_ref[1::2]
+
+        # Who bought and sold, and their trade side and rate
+        buyer = np.where(taker_bid,
+            tape['taker_account_id'], tape['maker_account_id'])
+        seller = np.where(taker_bid,
+            tape['maker_account_id'], tape['taker_account_id'])
+        bside = np.where(taker_bid, taker_side, maker_side)
+        sside = np.where(taker_bid, maker_side, taker_side)
+        buyer_bps = np.where(taker_bid, taker_bps, maker_bps)
+        seller_bps = np.where(taker_bid, maker_bps, taker_bps)
+
+        amount_fee = amount * buyer_bps
+        total_fee = total * seller_bps
+        fees = np.full(count, fee_account_id)
+        no_side = np.full(count, NULL)
+        asset = np.full(count, market.asset.id)
+        uoa = np.full(count, market.uoa.id)
+
+        # Ledger legs, six per trade in trade order
+        legs = (
+            (sside,   seller, asset, -amount * SCALE),
+            (bside,   buyer,  asset,  amount * SCALE - amount_fee),
+            (no_side, fees,   asset,  amount_fee),
+            (bside,   buyer,  uoa,   -total * SCALE),
+            (sside,   seller, uoa,    total * SCALE - total_fee),
+            (no_side, fees,   uoa,    total_fee),
+        )
+        def interleave(i):
+            return np.column_stack([leg[i] for leg in legs]).ravel()
+
+        self.ledger_uuid = uuids(count * len(legs), rng)
+        self.ledger_trade_side_id = interleave(0)
+        self.ledger_account_id = interleave(1)
+        self.ledger_asset_id = interleave(2)
+        self.ledger_amount = interleave(3)
+
+    def ledgers(self):
+        """Yield (asset_id, account_id, amount) per ledger leg."""
+        for asset_id, account_id, amount in zip(
+            self.ledger_asset_id.tolist(),
+            self.ledger_account_id.tolist(),
+            self.ledger_amount.tolist()):
+            yield asset_id, account_id, amount / SCALE
+
+    def balances(self):
+        """Net ledger amount per account and asset, ordered by account
+        then asset, as (account_ids, asset_ids, fixed point amounts)."""
+        keys = np.column_stack((self.ledger_account_id, self.ledger_asset_id))
+        pairs, inverse = np.unique(keys, axis=0, return_inverse=True)
+        amounts = np.zeros(len(pairs), dtype=np.int64)
+        np.add.at(amounts, inverse.ravel(), self.ledger_amount)
+        return pairs[:, 0], pairs[:, 1], amounts
+
+    def update_balances(self, cursor):
+        if not self.count:
+            return
+        account_ids, asset_ids, amounts = self.balances()
+        cursor.execute(SQL['update_balances'], {
+            'account_ids': account_ids.tolist(),
+            'asset_ids': asset_ids.tolist(),
+            'amounts': [decimal(a).decode() for a in amounts.tolist()],
+            'created': self.created_dt,
+        })
+        cursor.execute(SQL['update_price'], {
+            'market_id': self.market.id,
+            'price': int(self.price[-1]),
+            'created': self.created_dt,
+        })
+
+    def copy(self, cursor):
+        if not self.count:
+            return
+        market = self.market
+        copy_rows(cursor, 'trade',
+            ('uuid', 'market_id', 'price', 'amount', 'created'),
+            b'%%s\t%d\t%%d\t%%d\t%%s\n' % market.id,
+            [self.trade_uuid, self.price, self.amount, self.trade_created])
+
+        side_cols = ['uuid', 'type', 'trade_uuid', 'account_id', 'fee_rate',
+            'amount', 'created']
+        side_fmt = b'%%s\t%%s\t%%s\t%%d\t%%s\t0\t%s\n' % self.created
+        cols = [self.side_uuid, self.side_type, self.side_trade_uuid,
+            self.side_account_id, self.side_fee_rate]
+        if self.side_id is not None:
+            side_cols.insert(0, 'id')
+            side_fmt = b'%d\t' + side_fmt
+            cols.insert(0, self.side_id)
+        copy_rows(cursor, 'trade_side', side_cols, side_fmt, cols)
+
+        copy_rows(cursor, 'ledger',
+            ('uuid', 'type', 'account_id', 'asset_id', 'amount', 'balance',
+                'trade_side_id', 'created'),
+            b'%%s\ttrade\t%%d\t%%d\t%%s%%d.%%04d\t0\t%%s\t%s\n' % self.created,
+            [self.ledger_uuid, self.ledger_account_id, self.ledger_asset_id]
+                + decimal_cols(self.ledger_amount)
+                + [self.ledger_trade_side_id])
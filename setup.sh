@@ -14,7 +14,7 @@ dev() {
     rm -r ./venv
     virtualenv -p python3 ./venv
     . ./venv/bin/activate
-    pip install -r ./requirements.txt
+    pip install -r ./requirements-dev.txt
 }
 
 run() {
@@ -1,13 +1,14 @@
 WITH value AS (
     SELECT
-        m.id AS market_id,
         m.asset1,
-        m.asset2,
-        MAX(t.price) AS price
+        MAX(p.price) AS price
     FROM market AS m
-    JOIN trade AS t
-        ON m.id = t.market_id
-    GROUP BY m.id
+    JOIN market_price AS p
+        ON m.id = p.market_id
+    WHERE
+        m.asset2 = 1 -- USD Asset
+    GROUP BY
+        m.asset1
 ),
 reserve AS (
     SELECT
@@ -37,21 +38,19 @@ SELECT
     a.name,
     a.icon,
     a.scale,
-    COALESCE(SUM(l.amount),0)::text AS balance,
-    COALESCE(MAX(r.amount),0)::text AS reserve,
-    (COALESCE(SUM(l.amount),0) - COALESCE(MAX(r.amount),0))::text AS available,
-    COALESCE(MAX(value.price),0)::text AS last_price,
-    COALESCE(SUM(l.amount) * MAX(value.price),0)::text AS usd_value,
-    MIN(l.created) AS opening,
-    MAX(l.created) AS ending
+    COALESCE(b.balance,0)::text AS balance,
+    COALESCE(r.amount,0)::text AS reserve,
+    (COALESCE(b.balance,0) - COALESCE(r.amount,0))::text AS available,
+    COALESCE(value.price,0)::text AS last_price,
+    COALESCE(b.balance * value.price,0)::text AS usd_value,
+    b.opening,
+    b.ending
 FROM asset AS a
-LEFT JOIN ledger AS l
-    ON a.id = l.asset_id AND l.account_id = %(account_id)s
+LEFT JOIN account_asset AS b
+    ON a.id = b.asset_id AND b.account_id = %(account_id)s
 LEFT JOIN value
-    ON value.asset1 = a.id AND value.asset2 = 1 -- USD Asset
+    ON value.asset1 = a.id
 LEFT JOIN reserve AS r
-    ON r.account_id = l.account_id AND a.id = r.asset_id
-GROUP BY
-    a.id
+    ON a.id = r.asset_id
 ORDER BY
-    balance DESC
+    COALESCE(b.balance,0) DESC
@@ -0,0 +1,25 @@
+-- Materialized balances that differ from the ledger
+SELECT
+    COALESCE(l.account_id, aa.account_id) AS account_id,
+    COALESCE(l.asset_id, aa.asset_id) AS asset_id,
+    COALESCE(l.amount, 0)::text AS ledger,
+    aa.balance::text AS balance
+FROM (
+    SELECT
+        account_id,
+        asset_id,
+        SUM(amount) AS amount
+    FROM ledger
+    GROUP BY
+        account_id,
+        asset_id
+) AS l
+FULL JOIN account_asset AS aa
+    ON l.account_id = aa.account_id
+    AND l.asset_id = aa.asset_id
+WHERE
+    aa.id IS NULL
+    OR COALESCE(l.amount, 0) <> aa.balance
+ORDER BY
+    account_id,
+    asset_id
@@ -0,0 +1,26 @@
+-- Rewrite materialized balances from the ledger
+-- Run with account_asset locked against trades2db, see 'util reconcile'.
+INSERT INTO account_asset (account_id, asset_id, balance, opening, ending)
+SELECT
+    account_id,
+    asset_id,
+    SUM(amount),
+    MIN(created),
+    MAX(created)
+FROM ledger
+GROUP BY
+    account_id,
+    asset_id
+ON CONFLICT (account_id, asset_id) DO UPDATE SET
+    balance = EXCLUDED.balance,
+    opening = EXCLUDED.opening,
+    ending = EXCLUDED.ending
+;
+UPDATE account_asset AS aa SET
+    balance = 0
+WHERE
+    aa.balance <> 0
+    AND NOT EXISTS (
+        SELECT 1 FROM ledger AS l
+        WHERE l.account_id = aa.account_id AND l.asset_id = aa.asset_id
+    )
@@ -0,0 +1,22 @@
+-- Add net ledger amounts to materialized balances
+-- Rows are inserted in account, asset order so concurrent settlements
+-- lock them in the same order.
+INSERT INTO account_asset (account_id, asset_id, balance, opening, ending)
+SELECT
+    d.account_id,
+    d.asset_id,
+    d.amount,
+    %(created)s,
+    %(created)s
+FROM unnest(
+    %(account_ids)s::int[],
+    %(asset_ids)s::int[],
+    %(amounts)s::numeric[]
+) AS d (account_id, asset_id, amount)
+ORDER BY
+    d.account_id,
+    d.asset_id
+ON CONFLICT (account_id, asset_id) DO UPDATE SET
+    balance = account_asset.balance + EXCLUDED.balance,
+    opening = COALESCE(account_asset.opening, EXCLUDED.opening),
+    ending = EXCLUDED.ending
@@ -0,0 +1,6 @@
+-- Last trade price of a market
+INSERT INTO market_price (market_id, price, modified)
+VALUES (%(market_id)s, %(price)s, %(created)s)
+ON CONFLICT (market_id) DO UPDATE SET
+    price = EXCLUDED.price,
+    modified = EXCLUDED.modified
@@ -1,45 +1,128 @@
+import os
 import time
 import atexit
 import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUB_BITS = 5  # Histogram buckets per power of two are 2**(SUB_BITS - 1)
+HALF = 1 << (SUB_BITS - 1)
+BUCKETS = (64 - SUB_BITS + 2) * HALF
+PERCENTILES = (50, 90, 99, 99.9)
+
+EXPORT_INTERVAL = 10 # Seconds between stats file writes
+
+"""
+Timing stats
+
+Timings are kept in log bucketed histograms, as HdrHistogram does: values
+up to 2**SUB_BITS have a bucket each, above that every power of two is
+split in 2**(SUB_BITS - 1) buckets, so percentiles are within ~3% of the
+value recorded. Recording is a few integer ops and a list increment,
+cheap enough to leave on in the matching loop.
+
+Values are integers, nanoseconds from time.perf_counter_ns() for
+timings. Hot paths keep the Histogram from Stats.hist() and call
+record() on it directly.
+
+StatsExporter publishes snapshots in the Prometheus text format, served
+over http and/or written to a file (node_exporter textfile collector)
+from a background thread.
+"""
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        b = value.bit_length()
+        if b <= SUB_BITS:
+            self.counts[value] += 1
+        else:
+            e = b - SUB_BITS
+            self.counts[(e << (SUB_BITS - 1)) + (value >> e)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # Lowest value and width of a bucket
+    @staticmethod
+    def bucket_range(i):
+        if i < 2 * HALF:
+            return i, 1
+        e = i // HALF - 1
+        return (i - e * HALF) << e, 1 << e
+
+    def percentile(self, p):
+        """Value at percentile p (0-100), the middle of its bucket."""
+        if not self.count:
+            return 0
+        rank = max(int(self.count * p / 100 + 0.5), 1)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                low, width = self.bucket_range(i)
+                return min(low + (width - 1) / 2, self.max)
+        return self.max
+
+    def summary(self):
+        out = {'p%g' % p: self.percentile(p) for p in PERCENTILES}
+        out['max'] = self.max
+        return out
 
 class Stats:
     instances = []
-    def __init__(self, types=[]):
-        self.__class__.instances.append(self)
+    def __init__(self, types=[], labels=None, dump=True):
+        # Instances are printed at exit, unless dump is False
+        if dump:
+            self.__class__.instances.append(self)
         self.types = set(types)
-        self._stats = {}
+        self.labels = labels or {}  # Prometheus labels of every sample
+        self.hists = {}     # name -> Histogram of ns
+        self.ops = {}       # name -> ops timed, see set()
+        self.counters = {}  # name -> count
+
+    def hist(self, name):
+        h = self.hists.get(name)
+        if h is None:
+            h = self.hists[name] = Histogram()
+        return h
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
 
+    # One timing in seconds covering count ops
     def set(self, name, elapsed=0, count=1):
         self.types.add(name)
-        cnt = name+'_cnt'
-        avg = name+'_avg'
-        tot = name+'_tot'
-        for x in (cnt, tot):
-            if x not in self._stats:
-                self._stats[x] = 0
-        self._stats[cnt] += count
-        self._stats[tot] += elapsed
-
-        if avg in self._stats:
-            self._stats[avg] = (self._stats[avg] + elapsed) / 2
-        else:
-            self._stats[avg] = elapsed
+        self.hist(name).record(int(elapsed * 1e9))
+        self.ops[name] = self.ops.get(name, 0) + count
 
     def text(self):
         out = []
-        out.append("%-20s %10s %13s %13s %10s" % (
-            'Name','Count','Total','Avg','Ops/sec'))
-        for name in sorted(self.types):
-            cnt = self._stats[name+'_cnt']
-            avg = self._stats[name+'_avg']
-            tot = self._stats[name+'_tot']
+        out.append("%-20s %10s %13s %10s %10s %10s %10s %10s" % (
+            'Name','Count','Total','Avg','p50','p99','Max','Ops/sec'))
+        for name in sorted(self.hists):
+            h = self.hists[name]
+            cnt = self.ops.get(name, h.count)
+            tot = h.total / 1e9
+            avg = tot / h.count if h.count else 0
             ops = 0
             if tot > 0:
                 ops = cnt / tot
-            out.append("%-20.20s %10d %10.2f ms %10.2f ms %10d" % (
-                name, cnt, tot * 1000, avg * 1000, ops
+            out.append("%-20.20s %10d %10.2f ms %7.3f ms %7.3f ms %7.3f ms "
+                "%7.3f ms %10d" % (
+                name, cnt, tot * 1000, avg * 1000, h.percentile(50) / 1e6,
+                h.percentile(99) / 1e6, h.max / 1e6, ops
             ))
-
+        for name in sorted(self.counters):
+            out.append("%-20.20s %10d" % (name, self.counters[name]))
 
         return '\n'.join(out)
 
@@ -48,13 +131,119 @@ class Stats:
 
     def timeit(self, method):
         def timed(*args, **kw):
-            ts = time.time()
+            ts = time.perf_counter_ns()
             result = method(*args, **kw)
-            te = time.time()
-            self.set(method.__name__, (te - ts)) # * 1000
+            self.types.add(method.__name__)
+            self.hist(method.__name__).record(time.perf_counter_ns() - ts)
             return result
         return timed
 
+def prom_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+        for k, v in sorted(labels.items()))
+
+def prometheus(stats, prefix='lob'):
+    """Prometheus text format of some Stats. Histograms are summaries in
+    seconds, counters are totals."""
+    hists = {}
+    counters = {}
+    for st in stats:
+        # Copied, the matching thread adds names as they first occur
+        for name, h in list(st.hists.items()):
+            hists.setdefault(name, []).append((st.labels, h))
+        for name, count in list(st.counters.items()):
+            counters.setdefault(name, []).append((st.labels, count))
+
+    out = []
+    for name in sorted(hists):
+        metric = '%s_%s_seconds' % (prefix, name)
+        out.append('# TYPE %s summary' % metric)
+        for labels, h in hists[name]:
+            for p in PERCENTILES:
+                out.append('%s%s %.9g' % (metric,
+                    prom_labels(labels, quantile='%g' % (p / 100)),
+                    h.percentile(p) / 1e9))
+            out.append('%s_sum%s %.9g' % (metric, prom_labels(labels),
+                h.total / 1e9))
+            out.append('%s_count%s %d' % (metric, prom_labels(labels),
+                h.count))
+    for name in sorted(counters):
+        metric = '%s_%s_total' % (prefix, name)
+        out.append('# TYPE %s counter' % metric)
+        for labels, count in counters[name]:
+            out.append('%s%s %d' % (metric, prom_labels(labels), count))
+    return '\n'.join(out) + '\n'
+
+class StatsExporter:
+    """
+    Publish prometheus(collect()) from background threads: served at
+    http://host:port/metrics and/or written to path every interval
+    seconds. The matching thread only shares the GIL with them while a
+    snapshot is built.
+    """
+    def __init__(self, collect, port=None, path=None,
+        interval=EXPORT_INTERVAL, host='127.0.0.1'):
+        self.collect = collect
+        self.path = path
+        self.interval = interval
+        self.server = None
+        self.stopped = threading.Event()
+        self.threads = []
+
+        if port is not None:
+            exporter = self
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = exporter.text().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type',
+                        'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer((host, port), Handler)
+            self.start(self.server.serve_forever)
+
+        if path is not None:
+            self.start(self.run)
+
+    def start(self, target):
+        t = threading.Thread(target=target, daemon=True)
+        t.start()
+        self.threads.append(t)
+
+    def text(self):
+        return prometheus(self.collect())
+
+    def write(self):
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            f.write(self.text())
+        os.replace(tmp, self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def close(self):
+        self.stopped.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        for t in self.threads:
+            t.join()
+        if self.path is not None:
+            self.write()
 
 
 import sys
@@ -87,7 +276,8 @@ def getsize(obj):
 
 import sys
 from numbers import Number
-from collections import Set, Mapping, deque
+from collections import deque
+from collections.abc import Set, Mapping
 
 try: # Python 2
     zero_depth_bases = (basestring, Number, xrange, bytearray)
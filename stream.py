@@ -0,0 +1,141 @@
+import json
+import queue
+import asyncio
+import threading
+
+import msgpack
+
+"""
+Redis pub/sub fan-out for streaming endpoints
+
+Each api process holds one pattern subscription per stream, whatever the
+number of clients. A background thread hands every message to the
+queues of the clients subscribed to its channel. Queues are bounded: a
+client that falls MAX_PENDING messages behind is dropped (its queue is
+cleared and gets None) and has to reconnect and resync.
+"""
+
+MAX_PENDING = 256 # Messages per client
+KEEPALIVE = 15    # Seconds between SSE comments on an idle stream
+
+def sse_event(event, data):
+    """One server-sent event with a JSON payload."""
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+def unpack_snapshot(data, empty):
+    """A msgpack snapshot holding a seq, or empty at seq 0."""
+    return msgpack.unpackb(data) if data else dict(empty, seq=0)
+
+class SeqStream():
+    """
+    Seq bookkeeping of a snapshot then updates stream.
+
+    Updates the snapshot already covers are skipped. A skipped seq (engine
+    restart, redis hiccup) calls for a fresh snapshot.
+    """
+    def __init__(self, event, render):
+        self.event = event
+        self.render = render
+        self.seq = 0
+
+    def snapshot(self, msg):
+        self.seq = msg['seq']
+        return sse_event('snapshot', self.render(msg))
+
+    # The event for an update, None to skip it, False to resync
+    def update(self, msg):
+        if msg['seq'] <= self.seq:
+            return None
+        if msg['seq'] != self.seq + 1:
+            return False
+        self.seq = msg['seq']
+        return sse_event(self.event, self.render(msg))
+
+class Fanout():
+    Queue = queue.Queue
+    Full = queue.Full
+
+    def __init__(self, conn, pattern, size=MAX_PENDING):
+        self.size = size
+        self.clients = {}  # channel -> set of queues
+        self.lock = threading.Lock()
+
+        self.pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.psubscribe(pattern)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def subscribe(self, channel):
+        q = self.Queue(self.size)
+        with self.lock:
+            self.clients.setdefault(channel, set()).add(q)
+        return q
+
+    def unsubscribe(self, channel, q):
+        with self.lock:
+            clients = self.clients.get(channel)
+            if clients is not None:
+                clients.discard(q)
+                if not clients:
+                    del self.clients[channel]
+
+    def run(self):
+        while self.running:
+            msg = self.pubsub.get_message(timeout=1)
+            if msg and msg['type'] == 'pmessage':
+                self.publish(msg['channel'].decode(), msg['data'])
+
+    def publish(self, channel, data):
+        with self.lock:
+            clients = list(self.clients.get(channel, ()))
+        for q in clients:
+            try:
+                q.put_nowait(data)
+            except self.Full:
+                self.unsubscribe(channel, q)
+                while not q.empty():
+                    q.get_nowait()
+                q.put_nowait(None)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.pubsub.close()
+
+class AsyncFanout(Fanout):
+    """
+    Fanout for the asyncio app (aioapp.py). conn is a redis.asyncio client,
+    a task on the event loop reads the subscription and clients get
+    asyncio queues. Call start() from the loop before subscribing.
+    """
+    Queue = asyncio.Queue
+    Full = asyncio.QueueFull
+
+    def __init__(self, conn, pattern, size=MAX_PENDING):
+        self.conn = conn
+        self.pattern = pattern
+        self.size = size
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.pubsub = None
+        self.task = None
+
+    async def start(self):
+        self.pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.psubscribe(self.pattern)
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            msg = await self.pubsub.get_message(timeout=1)
+            if msg and msg['type'] == 'pmessage':
+                self.publish(msg['channel'].decode(), msg['data'])
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        await self.pubsub.aclose()
@@ -0,0 +1,148 @@
+import unittest
+import asyncio
+import json
+import shutil
+import tempfile
+from unittest import mock
+from pathlib import Path
+
+import fakeredis
+import msgpack
+
+import aioapp
+import marketdata
+from ohlc import OHLC, OHLCAggregator
+from tests.test_ohlc import MARKET, random_trades
+
+BOOK = {'seq': 1, 'bids': [[100, 5], [99, 2], [98, 7]],
+    'asks': [[101, 1], [103, 4]]}
+
+class TestAsyncApp(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.conn = fakeredis.FakeAsyncRedis()
+        patches = (
+            mock.patch('config.CACHE_DIR', self.tmp),
+            mock.patch('ohlc.CACHE_DIR', self.tmp),
+            mock.patch('aioapp.conn', self.conn),
+            mock.patch.dict('aioapp.MARKETS_CACHE', {MARKET.code: MARKET}),
+            mock.patch.dict('aioapp.FANOUTS', {}),
+            mock.patch('aioapp.RESPONSE_CACHE', aioapp.ResponseCache()),
+        )
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_async(self, coro):
+        async def run():
+            try:
+                return await coro
+            finally:
+                for fan in aioapp.FANOUTS.values():
+                    await fan.close()
+        return asyncio.run(run())
+
+    def scope(self, path, query=b'', headers=()):
+        return {'type': 'http', 'method': 'GET', 'path': path,
+            'query_string': query, 'headers': list(headers)}
+
+    async def get(self, path, query=b'', headers=()):
+        sent = []
+        async def receive():
+            await asyncio.Event().wait()
+        async def send(msg):
+            sent.append(msg)
+        await aioapp.app(self.scope(path, query, headers), receive, send)
+        start, body = sent
+        return start['status'], dict(start['headers']), body['body']
+
+    def test_book(self):
+        async def run():
+            await self.conn.set('xyz:book', msgpack.packb(BOOK))
+            status, headers, body = await self.get('/api/xyz/book',
+                b'depth=2')
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body),
+                marketdata.book_rows(BOOK['bids'][:2], BOOK['asks'][:2]))
+
+            etag = headers[b'etag']
+            status, headers, body = await self.get('/api/xyz/book',
+                b'depth=2', [(b'if-none-match', etag)])
+            self.assertEqual(status, 304)
+            self.assertEqual(body, b'')
+
+            status, _, _ = await self.get('/api/xyz/book', b'depth=0')
+            self.assertEqual(status, 400)
+            status, _, _ = await self.get('/api/abc/book')
+            self.assertEqual(status, 400)
+            status, _, _ = await self.get('/api/xyz/nope')
+            self.assertEqual(status, 404)
+        self.run_async(run())
+
+    def test_last_trades(self):
+        trades = [[1592956800000000 + i, 100 + i, 1, 0] for i in range(5)]
+        async def run():
+            status, _, body = await self.get('/api/xyz/last_trades')
+            self.assertEqual(json.loads(body), [])
+
+            await self.conn.set('xyz:last_trades',
+                msgpack.packb({'seq': 1, 'trades': trades}))
+            status, _, body = await self.get('/api/xyz/last_trades')
+            self.assertEqual(json.loads(body), marketdata.trade_rows(trades))
+        self.run_async(run())
+
+    def test_ohlc(self):
+        agg = OHLCAggregator(MARKET)
+        agg.add(*random_trades(500))
+        agg.flush()
+
+        async def run():
+            status, _, body = await self.get('/api/xyz/ohlc/1h')
+            self.assertEqual(status, 200)
+            return json.loads(body)
+        self.assertEqual(self.run_async(run()),
+            json.loads(json.dumps(OHLC(None).get_cached(MARKET, '1h'))))
+
+    def test_book_stream(self):
+        async def run():
+            await self.conn.set('xyz:book', msgpack.packb(BOOK))
+            chunks = asyncio.Queue()
+            disconnect = asyncio.Event()
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+            async def send(msg):
+                await chunks.put(msg)
+
+            task = asyncio.ensure_future(aioapp.app(
+                self.scope('/api/xyz/book/stream'), receive, send))
+            start = await chunks.get()
+            self.assertEqual(dict(start['headers'])[b'content-type'],
+                b'text/event-stream')
+
+            async def event():
+                text = (await chunks.get())['body'].decode()
+                name, data = text.strip().split('\n')
+                return name[len('event: '):], json.loads(data[len('data: '):])
+
+            self.assertEqual(await event(), ('snapshot', BOOK))
+
+            update = {'seq': 2, 'bids': [[100, 0]], 'asks': []}
+            await self.conn.publish('xyz:depth', msgpack.packb(update))
+            self.assertEqual(await event(), ('update', update))
+
+            # Covered updates are skipped, a gap resends the snapshot
+            book = dict(BOOK, seq=5)
+            await self.conn.set('xyz:book', msgpack.packb(book))
+            await self.conn.publish('xyz:depth', msgpack.packb(update))
+            await self.conn.publish('xyz:depth',
+                msgpack.packb(dict(update, seq=5)))
+            self.assertEqual(await event(), ('snapshot', book))
+
+            disconnect.set()
+            await task
+            self.assertEqual(aioapp.FANOUTS['*:depth'].clients, {})
+        self.run_async(run())
@@ -2,8 +2,13 @@ import unittest
 import requests
 import time
 import humanize
+from concurrent.futures import ThreadPoolExecutor
 
 BASE_URL = 'http://localhost:5000'
+ASYNC_URL = 'http://localhost:5001' # aioapp, see asgi-start.sh
+
+CLIENTS = 64    # Concurrent connections per benchmark
+REQUESTS = 2000 # Per url and server
 
 account_id = 103
 market = 'shtusd'
@@ -25,6 +30,9 @@ urls = (
     '/api/{market}/ohlc/6h',
     '/api/{market}/ohlc/1d',
     '/api/{market}/book',
+    '/api/{market}/book?depth=10',
+    '/api/{market}/book?source=sql',
+    '/api/{market}/book?depth=10&source=sql',
     '/api/{market}/last_trades',
     '/api/{market}/last24'
 )
@@ -63,3 +71,54 @@ class TestAPI(unittest.TestCase):
             ))
 
         self.assertTrue(True, True)
+
+# Read endpoints served by both app.py and aioapp.py
+bench_urls = (
+    '/api/{market}/ohlc/1h',
+    '/api/{market}/book',
+    '/api/{market}/last_trades',
+    '/api/{market}/last24',
+    '/api/balance?account_id={account_id}',
+)
+
+class TestAPIConcurrency(unittest.TestCase):
+
+    def bench(self, base, u):
+        session = requests.Session()
+        session.mount('http://', requests.adapters.HTTPAdapter(
+            pool_maxsize=CLIENTS))
+
+        def get(i):
+            begin = time.time()
+            r = session.get(base + u)
+            return r.status_code, time.time() - begin
+
+        begin = time.time()
+        with ThreadPoolExecutor(CLIENTS) as pool:
+            results = list(pool.map(get, range(REQUESTS)))
+        elapsed = time.time() - begin
+
+        latency = sorted(t for status, t in results)
+        errors = sum(1 for status, t in results if status != 200)
+        return (REQUESTS / elapsed, latency[len(latency) // 2],
+            latency[int(len(latency) * 0.99)], errors)
+
+    # Requests/sec and p50/p99 of the sync and async servers side by side
+    def test_sync_vs_async(self):
+        servers = []
+        for name, base in (('sync', BASE_URL), ('async', ASYNC_URL)):
+            try:
+                requests.get(base + '/api/wealth', timeout=5)
+                servers.append((name, base))
+            except requests.ConnectionError:
+                print('%s server at %s is not running' % (name, base))
+
+        for u in bench_urls:
+            u = u.format(**{'account_id': account_id, 'market': market})
+            for name, base in servers:
+                rps, p50, p99, errors = self.bench(base, u)
+                print("%-5s %-30.30s %7.0f req/s p50 %7.2f p99 %7.2f ms "
+                    "%d errors" % (name, u, rps, p50 * 1000, p99 * 1000,
+                    errors))
+
+        self.assertTrue(True, True)
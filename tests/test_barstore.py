@@ -0,0 +1,46 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from barstore import (BarStore, BAR_DTYPE, HEADER, bars_from_rows,
+    rows_from_bars)
+
+ROWS = [
+    {'dt': '2020-06-24T00:00:00Z', 'time': 1592956800, 'open': 10,
+        'high': 12, 'low': 9, 'close': 11, 'volume': 5, 'value': 5},
+    {'dt': '2020-06-24T00:01:00Z', 'time': 1592956860},
+    {'dt': '2020-06-24T00:02:00Z', 'time': 1592956920, 'open': 11.5,
+        'high': 11.5, 'low': 11.5, 'close': 11.5, 'volume': 2, 'value': 2},
+]
+
+class TestBarStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = BarStore(os.path.join(self.tmp, 'bars', '1m'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_rows(self):
+        self.assertEqual(rows_from_bars(bars_from_rows(ROWS)), ROWS)
+
+    def test_range(self):
+        self.assertEqual(len(self.store.range(0, 2 ** 40)), 0)
+        self.assertEqual(self.store.append(bars_from_rows(ROWS[:2])), 2)
+        # Bars not after the last one are skipped
+        self.assertEqual(self.store.append(bars_from_rows(ROWS[1:])), 1)
+
+        self.assertEqual(rows_from_bars(self.store.range(0, 2 ** 40)), ROWS)
+        self.assertEqual(rows_from_bars(
+            self.store.range(1592956860, 1592956919)), ROWS[1:2])
+
+    def test_torn_record(self):
+        self.store.append(bars_from_rows(ROWS[:2]))
+        with open(self.store.path, 'ab') as f:
+            f.write(b'\0' * 10)
+        self.assertEqual(len(self.store.read()), 2)
+        self.store.append(bars_from_rows(ROWS[2:]))
+        self.assertEqual(os.path.getsize(self.store.path),
+            HEADER.size + 3 * BAR_DTYPE.itemsize)
+        self.assertEqual(rows_from_bars(self.store.read()), ROWS)
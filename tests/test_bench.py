@@ -0,0 +1,49 @@
+import unittest
+
+from lob.bench import FLOWS, Flow, run, compare, construction
+from lob.orderbook import BOOK_TYPES
+
+class TestBench(unittest.TestCase):
+    def test_flows(self):
+        for flow in FLOWS:
+            setup, messages = FLOWS[flow](Flow(3), 1000)
+            self.assertEqual(len(messages), 1000)
+            # Deterministic for a seed
+            self.assertEqual(FLOWS[flow](Flow(3), 1000), (setup, messages))
+
+            ids = [p['id'] for m, p in setup + messages]
+            self.assertEqual(len(ids), len(set(ids)))
+
+    def test_run(self):
+        for book in BOOK_TYPES:
+            results = {}
+            for flow in FLOWS:
+                r = results[flow] = run(flow, 2000, book, allocs=True)
+                self.assertEqual(r['messages'], 2000)
+                self.assertTrue(r['trades'])
+                self.assertGreater(r['msgs_per_sec'], 0)
+                self.assertLessEqual(r['latency_us']['p50'],
+                    r['latency_us']['p99'])
+                self.assertTrue(r['flushes'])
+                self.assertTrue(r['tape_bytes'])
+                self.assertGreater(r['alloc_peak_bytes'], 0)
+
+            # Same flows, same trades
+            self.assertEqual(run('sweep', 2000, book)['trades'],
+                results['sweep']['trades'])
+
+    def test_construction(self):
+        costs = construction(100)
+        self.assertIn('Order.make', costs)
+        self.assertTrue(all(ns > 0 for ns in costs.values()))
+
+    def test_compare(self):
+        old = {'a': {'msgs_per_sec': 100, 'latency_us': {'p50': 10, 'p99': 20},
+            'lmdb_bytes': None}}
+        new = {'a': {'msgs_per_sec': 80, 'latency_us': {'p50': 5, 'p99': 20},
+            'lmdb_bytes': 100}, 'b': {}}
+        self.assertEqual(compare(old, new), [
+            ('a', 'msgs_per_sec', 100, 80, -20.0, 20.0),
+            ('a', 'latency_us p50', 10, 5, -50.0, -50.0),
+            ('a', 'latency_us p99', 20, 20, 0.0, 0.0),
+        ])
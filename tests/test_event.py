@@ -0,0 +1,204 @@
+import unittest
+from unittest import mock
+import shutil
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import fakeredis
+import msgpack
+
+import config as cfg
+from event import EventRunner, MarketSupervisor, depth_changes
+from redis_queue import SimpleQueue
+from tests.test_orderbook import random_quotes
+
+class TestMarketSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.server = fakeredis.FakeServer()
+        self.conn = fakeredis.FakeRedis(server=self.server)
+
+        patches = (
+            mock.patch('config.CACHE_DIR', self.tmp),
+            mock.patch('redis.from_url',
+                lambda url: fakeredis.FakeRedis(server=self.server)),
+        )
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        markets = [SimpleNamespace(code=c) for c in ('aaa', 'bbb', 'ccc')]
+        self.supervisor = MarketSupervisor(None, markets, dequeue=50)
+        self.supervisors = [self.supervisor]
+
+    def tearDown(self):
+        for supervisor in self.supervisors:
+            for runner in supervisor.runners.values():
+                runner.env.close()
+        shutil.rmtree(self.tmp)
+
+    def enqueue(self, code, quotes):
+        q = SimpleQueue(self.conn, code)
+        for data in quotes:
+            q.enqueue('add-order', data)
+
+    def test_run(self):
+        self.enqueue('aaa', random_quotes(500, seed=1))
+        self.enqueue('bbb', random_quotes(120, seed=2))
+        self.supervisor.run()
+
+        for code in ('aaa', 'bbb', 'ccc'):
+            self.assertEqual(self.conn.llen(code), 0)
+
+        a = self.supervisor.runners['aaa'].lob
+        c = self.supervisor.runners['ccc'].lob
+        self.assertIsNotNone(a.getBestBid())
+        self.assertIsNone(c.getBestBid())
+        self.assertEqual(a.stats.labels, {'market': 'aaa'})
+        self.assertEqual(a.stats.hists['process_order'].count, 500)
+        self.assertEqual(c.stats.hists['process_order'].count, 0)
+        self.assertEqual(self.supervisor.runners['bbb'].lob.stats.hists[
+            'process_order'].count, 120)
+
+    # Markets without messages still flush while another one drains
+    def test_run_flush_idle(self):
+        self.enqueue('aaa', random_quotes(500, seed=1))
+        runner = self.supervisor.runners['ccc']
+        with mock.patch.object(runner, 'check_flush',
+                wraps=runner.check_flush) as check_flush:
+            self.supervisor.run()
+        self.assertGreaterEqual(check_flush.call_count, 500 // 50)
+
+    def test_wait(self):
+        self.assertFalse(self.supervisor.wait(0.1))
+
+        self.enqueue('ccc', random_quotes(3))
+        self.assertTrue(self.supervisor.wait(0.1))
+        self.assertEqual(self.supervisor.runners['ccc'].order_cnt, 1)
+        self.assertEqual(self.conn.llen('ccc'), 2)
+
+    # Reliable messages only leave a queue for its processing list
+    def test_wait_reliable(self):
+        markets = [SimpleNamespace(code=c) for c in ('ddd', 'eee')]
+        supervisor = MarketSupervisor(None, markets, dequeue=50,
+            reliable=True)
+        single = MarketSupervisor(None, [SimpleNamespace(code='fff')],
+            reliable=True)
+        self.supervisors += [supervisor, single]
+
+        self.assertFalse(supervisor.wait(0.05))
+        self.enqueue('eee', random_quotes(3))
+        self.assertTrue(supervisor.wait(0.05))
+        self.assertEqual(self.conn.llen('eee'), 3)
+        supervisor.run()
+        self.assertEqual(self.conn.llen('eee'), 0)
+        self.assertEqual(self.conn.llen('eee:processing'), 3)
+        self.assertEqual(supervisor.runners['eee'].lob.stats.hists[
+            'process_order'].count, 3)
+
+        self.assertFalse(single.wait(0.05))
+        self.enqueue('fff', random_quotes(3))
+        self.assertTrue(single.wait(0.05))
+        self.assertEqual(self.conn.llen('fff'), 0)
+        self.assertEqual(self.conn.llen('fff:processing'), 3)
+
+    def test_notify(self):
+        pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe('aaa:trades')
+        pubsub.get_message(timeout=1) # subscribe confirmation
+
+        runner = self.supervisor.runners['aaa']
+        self.assertFalse(runner.wait(0.1))
+        self.enqueue('aaa', random_quotes(500, seed=1))
+        self.assertTrue(runner.wait(0.1))
+        trades = len(runner.lob.tape)
+        self.assertGreater(trades, 0)
+        runner.flush()
+
+        msg = pubsub.get_message(timeout=1)
+        self.assertEqual(int(msg['data']), trades)
+        self.assertEqual(len(runner.lob.tape), 0)
+
+    def test_trade_stream(self):
+        pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe('aaa:tape')
+        pubsub.get_message(timeout=1) # subscribe confirmation
+
+        runner = self.supervisor.runners['aaa']
+        quotes = random_quotes(600, seed=3)
+        batches = []
+        for i in range(3):
+            self.enqueue('aaa', quotes[i * 200:(i + 1) * 200])
+            runner.run()
+            tape = list(runner.lob.tape)
+            runner.flush()
+            batches.append([[t['time'], t['price'], t['qty'], t['taker_side']]
+                for t in tape])
+
+        for i, batch in enumerate(batches):
+            msg = msgpack.unpackb(pubsub.get_message(timeout=1)['data'])
+            self.assertEqual(msg, {'seq': i + 1, 'trades': batch})
+
+        last = msgpack.unpackb(self.conn.get('aaa:last_trades'))
+        self.assertEqual(last['seq'], 3)
+        self.assertEqual(last['trades'],
+            sum(batches, [])[-cfg.LAST_TRADES:])
+
+        # A restarted engine carries on from the stored buffer
+        runner.env.close()
+        runner = self.supervisor.runners['aaa'] = EventRunner(
+            None, runner.market)
+        self.assertEqual(runner.trades_seq, 3)
+        self.assertEqual(list(runner.last_trades), last['trades'])
+
+    def test_publish_depth(self):
+        pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe('aaa:depth')
+        pubsub.get_message(timeout=1) # subscribe confirmation
+
+        runner = self.supervisor.runners['aaa']
+        quotes = random_quotes(500, seed=1)
+        self.enqueue('aaa', quotes[:250])
+        runner.run()
+        runner.flush()
+
+        book = msgpack.unpackb(self.conn.get('aaa:book'))
+        self.assertEqual(book.pop('seq'), 1)
+        self.assertEqual(book, runner.lob.getDepth(cfg.BOOK_DEPTH))
+        self.assertTrue(book['bids'] and book['asks'])
+        self.assertLess(book['bids'][0][0], book['asks'][0][0])
+
+        # Unchanged books aren't written again
+        self.conn.delete('aaa:book')
+        runner.flush()
+        self.assertIsNone(self.conn.get('aaa:book'))
+
+        # Changes replayed onto the first snapshot give the second
+        self.enqueue('aaa', quotes[250:])
+        runner.run()
+        runner.flush()
+        after = msgpack.unpackb(self.conn.get('aaa:book'))
+        self.assertEqual(after.pop('seq'), 2)
+
+        updates = [msgpack.unpackb(pubsub.get_message(timeout=1)['data'])
+            for i in range(2)]
+        self.assertEqual([u['seq'] for u in updates], [1, 2])
+        for side in ('bids', 'asks'):
+            levels = dict(book[side])
+            for price, qty in updates[1][side]:
+                if qty:
+                    levels[price] = qty
+                else:
+                    del levels[price]
+            self.assertEqual(sorted(levels.items(),
+                reverse=(side == 'bids'))[:cfg.BOOK_DEPTH],
+                [tuple(x) for x in after[side]])
+
+    def test_depth_changes(self):
+        old = {'bids': [[10, 5], [9, 1]], 'asks': [[11, 2]]}
+        new = {'bids': [[10, 5], [8, 3]], 'asks': [[11, 4], [12, 1]]}
+        self.assertEqual(depth_changes(old, new),
+            {'bids': [[8, 3], [9, 0]], 'asks': [[11, 4], [12, 1]]})
+        self.assertEqual(depth_changes(None, old),
+            {'bids': [[10, 5], [9, 1]], 'asks': [[11, 2]]})
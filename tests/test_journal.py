@@ -0,0 +1,115 @@
+import os
+import multiprocessing
+
+import lmdb
+
+from lob.orderbook import OrderBook
+from lob.journal import Journal
+from tests.test_orderbook import OrderBookTestCase, random_messages
+
+FLUSH_EVERY = 300
+
+# Group runs of messages into batch events like the batch endpoint does
+def batched_messages(count, seed=1):
+    messages = []
+    batch = []
+    for i, (method, payload) in enumerate(random_messages(count, seed)):
+        if i % 100 < 50:
+            messages.append((method, payload))
+        else:
+            batch.append([method, payload])
+            if len(batch) == 25:
+                messages.append(('batch', batch))
+                batch = []
+    return messages
+
+def run_engine(path, messages, kill_at=None):
+    env = lmdb.open(str(path), max_dbs=4, map_size=1 << 28)
+    journal = Journal(path / 'journal', sync_ms=0)
+    lob = OrderBook(env, path / 'trades', journal=journal)
+    lob.recover()
+
+    if kill_at:
+        # Die halfway through matching the kill_at'th batch
+        processBatch = lob.processBatch
+        calls = [0]
+        def killer(quotes, flush=True):
+            calls[0] += 1
+            if calls[0] == kill_at:
+                processBatch(quotes[:len(quotes) // 2], flush)
+                os._exit(1)
+            return processBatch(quotes, flush)
+        lob.processBatch = killer
+
+    for i, (method, payload) in enumerate(messages[journal.seq:]):
+        lob.processEvent(method, payload, journal.seq + 1)
+        if lob.seq % FLUSH_EVERY == 0:
+            lob.flush()
+
+    lob.flush()
+    journal.close()
+    return env, lob
+
+class TestJournal(OrderBookTestCase):
+
+    def test_replay_after_kill(self):
+        messages = batched_messages(4000)
+
+        env, expected = run_engine(self.tmp / 'expected', messages)
+        self.envs.append(env)
+
+        ctx = multiprocessing.get_context('fork')
+        for kill_at in (20, 15):
+            p = ctx.Process(target=run_engine,
+                args=(self.tmp / 'crashed', messages, kill_at))
+            p.start()
+            p.join()
+            self.assertEqual(p.exitcode, 1)
+
+        env, recovered = run_engine(self.tmp / 'crashed', messages)
+        self.envs.append(env)
+
+        self.assertEqual(recovered.seq, len(messages))
+        self.assertEqual(self.dump(recovered), self.dump(expected))
+        self.assertEqual(os.listdir(self.tmp / 'crashed' / 'journal'), [])
+
+    # Crash after a clean restart, with no segments left to number from
+    def test_replay_after_restart_and_kill(self):
+        messages = batched_messages(4000)
+
+        env, expected = run_engine(self.tmp / 'expected', messages)
+        self.envs.append(env)
+
+        env, lob = run_engine(self.tmp / 'crashed', messages[:1000])
+        env.close()
+        self.assertEqual(os.listdir(self.tmp / 'crashed' / 'journal'), [])
+
+        ctx = multiprocessing.get_context('fork')
+        p = ctx.Process(target=run_engine,
+            args=(self.tmp / 'crashed', messages, 10))
+        p.start()
+        p.join()
+        self.assertEqual(p.exitcode, 1)
+
+        env, recovered = run_engine(self.tmp / 'crashed', messages)
+        self.envs.append(env)
+
+        self.assertEqual(recovered.seq, len(messages))
+        self.assertEqual(self.dump(recovered), self.dump(expected))
+
+    def test_torn_record(self):
+        journal = Journal(self.tmp / 'journal')
+        for i in range(10):
+            journal.append(str(i), 'cancel-order', {'order_id': i})
+        journal.close()
+
+        (start, fname), = journal.segments()
+        with open(fname, 'r+b') as f:
+            f.truncate(os.path.getsize(fname) - 3)
+
+        journal = Journal(self.tmp / 'journal')
+        self.assertEqual(journal.seq, 9)
+        journal.append('x', 'cancel-order', {'order_id': 99})
+        journal.close()
+        self.assertEqual([r[0] for r in journal.replay()], list(range(1, 11)))
+        self.assertEqual([r[0] for r in journal.replay(8)], [9, 10])
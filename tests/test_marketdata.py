@@ -0,0 +1,25 @@
+import unittest
+
+import msgpack
+
+import marketdata
+
+class TestMarketData(unittest.TestCase):
+    # The engine snapshot and book.sql give the same rows
+    def test_book_sources(self):
+        snapshot = msgpack.packb({
+            'bids': [[99, 5], [98, 7]],
+            'asks': [[101, 2], [103, 4]],
+        })
+        rows = [
+            {'side': 'buy', 'price': '98.0000000000', 'amount': '7'},
+            {'side': 'buy', 'price': '99.0000000000', 'amount': '5'},
+            {'side': 'sell', 'price': '101.0000000000', 'amount': '2'},
+            {'side': 'sell', 'price': '103.0000000000', 'amount': '4'},
+        ]
+        book = marketdata.snapshot_book(snapshot, 10)
+        self.assertEqual(book, marketdata.sql_book(rows, 10))
+        self.assertEqual(book[1], {'side': 'buy', 'price': '99.0000000000',
+            'amount': '5', 'total': '5'})
+        self.assertEqual(marketdata.snapshot_book(snapshot, 1),
+            marketdata.sql_book(rows, 1))
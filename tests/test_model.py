@@ -0,0 +1,32 @@
+import unittest
+
+from lob.model import Quote, Order, Trade, Account
+
+class TestModel(unittest.TestCase):
+    def test_make(self):
+        quote = {'id': 1, 'type': 'limit', 'side': 'bid', 'price': 100,
+            'qty': 10, 'account_id': 2}
+        self.assertEqual(Quote.make(**quote).to_dict(), Quote(quote).to_dict())
+        self.assertEqual(Quote.make(*quote.values()).to_dict(), quote)
+
+        # Trailing defaults as in __init__
+        order = Order.make(1, 100, 10, 2)
+        self.assertEqual(order.to_dict(),
+            Order(id=1, price=100, qty=10, account_id=2).to_dict())
+        self.assertIs(order.in_db, False)
+        self.assertIs(Order.make(1, 100, 10, 2, True).in_db, True)
+
+        self.assertEqual(Trade.make(1, 100, 10).to_dict(),
+            Trade(time=1, price=100, qty=10).to_dict())
+        self.assertEqual(Account.make(1, 2, 3, 4).vol30d, 4)
+
+    # make() trusts its caller, __init__ doesn't
+    def test_unchecked(self):
+        with self.assertRaises(TypeError):
+            Order(id=1, price='100', qty=10, account_id=2)
+        self.assertEqual(Order.make(1, '100', 10, 2).price, '100')
+
+        with self.assertRaises(Exception):
+            Quote(id=1, type='limit', side='bid', qty=10, account_id=2)
+        with self.assertRaises(TypeError):
+            Quote.make(1, 'limit', 'bid')
@@ -0,0 +1,216 @@
+import unittest
+import calendar
+from unittest import mock
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+from ohlc import (OHLC, OHLCAggregator, INTERVALS, INTERVAL_SECS, OPEN_FILE,
+    aggfmt, bar_row, bar_store, cache_version, rollup, write_file)
+from barstore import BAR_DTYPE
+
+MARKET = SimpleNamespace(id=1, code='xyz', name='XYZ')
+START = 1592956800 # 2020-06-24
+
+def random_trades(count, seed=1):
+    rng = np.random.default_rng(seed)
+    times = START * 1000000 + np.cumsum(rng.integers(0, 120000000, count))
+    prices = rng.integers(100, 200, count)
+    qtys = rng.integers(1, 10, count)
+    return times, prices, qtys
+
+# Every bar from the first trade's to now's, the slow way
+def expected_rows(trades, interval, now):
+    size = INTERVAL_SECS[interval]
+    bars = {}
+    for t, p, q in zip(*(x.tolist() for x in trades)):
+        s = t // 1000000
+        s -= s % size
+        if s not in bars:
+            bars[s] = [s, p, p, p, p, 0]
+        bar = bars[s]
+        bar[2] = max(bar[2], p)
+        bar[3] = min(bar[3], p)
+        bar[4] = p
+        bar[5] += q
+    first = min(bars)
+    rows = [bar_row(bars.get(s, [s, None, None, None, None, 0]))
+        for s in range(first, now - now % size + 1, size)]
+    return json.loads(json.dumps(rows))
+
+class TestOHLCAggregator(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        p = mock.patch('ohlc.CACHE_DIR', self.tmp)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def cached(self, interval, now):
+        return OHLC(None).get_cached(MARKET, interval,
+            datetime.utcfromtimestamp(START), datetime.utcfromtimestamp(now))
+
+    def feed(self, agg, trades, chunks):
+        times, prices, qtys = trades
+        for i, chunk in enumerate(np.array_split(np.arange(len(times)), chunks)):
+            agg.add(times[chunk], prices[chunk], qtys[chunk])
+            if i % 3 == 0:
+                agg.flush()
+
+    def test_stream(self):
+        trades = random_trades(3000)
+        now = int(trades[0][-1] // 1000000) + 3600
+
+        agg = OHLCAggregator(MARKET)
+        self.feed(agg, trades, 17)
+        agg.advance(now)
+        agg.flush()
+
+        for i in INTERVALS:
+            self.assertEqual(self.cached(i, now), expected_rows(trades, i, now))
+
+        # Open bars survive a restart
+        agg = OHLCAggregator(MARKET)
+        self.assertEqual(self.cached('1m', now),
+            expected_rows(trades, '1m', now))
+
+        with open(self.tmp / MARKET.code / 'last24.json') as f:
+            last24 = json.loads(f.read())
+        hours = [r for r in expected_rows(trades, '1h', now)[-24:]
+            if 'open' in r]
+        self.assertEqual(last24['high'], max(r['high'] for r in hours))
+        self.assertEqual(last24['close'], hours[-1]['close'])
+
+        version = cache_version(MARKET.code, '1m')
+        self.assertEqual(cache_version(MARKET.code, '1m'), version)
+        agg.advance(now + 60)
+        agg.flush()
+        self.assertNotEqual(cache_version(MARKET.code, '1m'), version)
+
+    def test_legacy_pages(self):
+        trades = random_trades(2000, seed=2)
+        half = [x[:1000] for x in trades]
+        now = int(half[0][-1] // 1000000)
+
+        # Pages as create_json leaves them, the open bar last
+        for i in INTERVALS:
+            pages = {}
+            for row in expected_rows(half, i, now):
+                dt = datetime.utcfromtimestamp(row['time'])
+                pages.setdefault(aggfmt(dt, i), []).append(json.dumps(row))
+            for rel_path, lines in pages.items():
+                write_file(self.tmp / MARKET.code / 'ohlc' / i / rel_path,
+                    '\n'.join(lines))
+
+        agg = OHLCAggregator(MARKET)
+        self.assertTrue(os.path.exists(
+            self.tmp / MARKET.code / 'ohlc' / OPEN_FILE))
+        self.assertEqual(self.cached('5m', now),
+            expected_rows(half, '5m', now))
+
+        self.feed(agg, [x[1000:] for x in trades], 5)
+        now = int(trades[0][-1] // 1000000)
+        agg.advance(now)
+        agg.flush()
+        for i in INTERVALS:
+            self.assertEqual(self.cached(i, now), expected_rows(trades, i, now))
+
+    def test_migrate(self):
+        trades = random_trades(2000, seed=3)
+        half = [x[:1000] for x in trades]
+        now = int(half[0][-1] // 1000000)
+
+        agg = OHLCAggregator(MARKET)
+        self.feed(agg, half, 4)
+        agg.advance(now)
+        agg.flush()
+        before = {i: self.cached(i, now) for i in INTERVALS}
+
+        OHLC(None).migrate([MARKET.code])
+        self.assertFalse(os.path.exists(self.tmp / MARKET.code / 'ohlc' / '1m'))
+        for i in INTERVALS:
+            self.assertEqual(self.cached(i, now), before[i])
+
+        # The aggregator appends to the stores from now on
+        agg = OHLCAggregator(MARKET)
+        self.feed(agg, [x[1000:] for x in trades], 3)
+        now = int(trades[0][-1] // 1000000)
+        agg.advance(now)
+        agg.flush()
+        for i in INTERVALS:
+            self.assertEqual(self.cached(i, now), expected_rows(trades, i, now))
+        # All but the open bar
+        self.assertEqual(len(bar_store(MARKET.code, '1d').read()),
+            len(expected_rows(trades, '1d', now)) - 1)
+
+    def init(self, trades, now, workers=1):
+        minutes = {r['time']: r for r in expected_rows(trades, '1m', now)}
+
+        # What the ohlc sql returns for 1m bars
+        def get(self, market_id, interval, start, end):
+            assert interval == '1m'
+            lo = calendar.timegm(start.utctimetuple())
+            hi = calendar.timegm(end.utctimetuple())
+            return [minutes.get(t, bar_row([t, None, None, None, None, 0]))
+                for t in range(lo, hi + 1, 60)]
+
+        m = SimpleNamespace(id=1, code=MARKET.code, name=MARKET.name,
+            first_trade=datetime.utcfromtimestamp(trades[0][0] // 1000000))
+        ohlc = OHLC(None)
+        ohlc.now = datetime.utcfromtimestamp(now)
+        with mock.patch('ohlc.OHLC.get', get), \
+            mock.patch('ohlc.create_engine', lambda url: None), \
+            mock.patch('ohlc.CHUNK_DAYS', 1):
+            if workers > 1:
+                ohlc.init_parallel([m], workers)
+            else:
+                ohlc.create_json(m)
+
+    def check_init(self, trades, now):
+        for i in INTERVALS:
+            expected = expected_rows(trades, i, now)
+            rows = self.cached(i, now)
+            # Pages start with empty bars up to the first trade
+            lead = len(rows) - len(expected)
+            self.assertTrue(all('open' not in r for r in rows[:lead]))
+            self.assertEqual(rows[lead:], expected)
+
+    def test_init_rollup(self):
+        trades = random_trades(3000, seed=4)
+        now = int(trades[0][-1] // 1000000) + 600
+        self.init(trades, now)
+        self.check_init(trades, now)
+
+    def test_init_parallel(self):
+        trades = random_trades(3000, seed=5)
+        now = int(trades[0][-1] // 1000000) + 600
+        self.init(trades, now, workers=3)
+        self.check_init(trades, now)
+
+    def test_rollup_calendar(self):
+        days = np.zeros(60, dtype=BAR_DTYPE)
+        days['time'] = START + np.arange(60) * 86400
+        days['open'] = days['high'] = days['low'] = days['close'] = \
+            np.arange(60) + 1
+        days['volume'] = 1
+
+        weeks = rollup(days, '1w')
+        for t in weeks['time'].tolist():
+            self.assertEqual(datetime.utcfromtimestamp(t).weekday(), 0)
+        self.assertEqual(weeks['volume'].sum(), 60)
+
+        months = rollup(days, '1M')
+        self.assertEqual(
+            [datetime.utcfromtimestamp(t).strftime('%Y-%m-%d')
+                for t in months['time'].tolist()],
+            ['2020-06-01', '2020-07-01', '2020-08-01'])
+        self.assertEqual(months['open'].tolist(), [1, 8, 39])
+        self.assertEqual(months['high'].tolist(), [7, 38, 60])
@@ -0,0 +1,410 @@
+import unittest
+from unittest import mock
+import random
+import shutil
+import tempfile
+from pathlib import Path
+
+import lmdb
+
+from lob.orderbook import OrderBook, BOOK_TYPES
+from lob.model import Quote, decode
+
+TRADE_KEYS = (
+    'price', 'qty', 'taker_side',
+    'maker_order_id', 'maker_account_id',
+    'taker_order_id', 'taker_account_id'
+)
+
+def random_quotes(count, seed=1):
+    rnd = random.Random(seed)
+    quotes = []
+    for i in range(1, count + 1):
+        side = rnd.choice(('bid', 'ask'))
+        data = {
+            'id': i,
+            'type': 'limit',
+            'side': side,
+            'qty': rnd.randint(1, 50),
+            'account_id': rnd.randint(1, 9)
+        }
+        if rnd.random() < 0.05:
+            data['type'] = 'market'
+        elif side == 'bid':
+            data['price'] = rnd.randint(90, 110)
+        else:
+            data['price'] = rnd.randint(92, 112)
+        quotes.append(data)
+    return quotes
+
+# Mixed add/cancel/amend messages as (method, payload)
+def random_messages(count, seed=1):
+    rnd = random.Random(seed)
+    messages = []
+    ids = []
+    accounts = {}  # id -> account_id
+    for data in random_quotes(count, seed):
+        r = rnd.random()
+        if ids and r < 0.3:
+            order_id = rnd.choice(ids)
+            messages.append(('cancel-order', {'id': data['id'],
+                'order_id': order_id, 'account_id': accounts[order_id]}))
+        elif ids and r < 0.4:
+            order_id = rnd.choice(ids)
+            update = {'id': data['id'], 'order_id': order_id,
+                'account_id': accounts[order_id]}
+            if rnd.random() < 0.5:
+                update['qty'] = rnd.randint(1, 30)
+            else:
+                update['price'] = rnd.randint(95, 107)
+            messages.append(('amend-order', update))
+            ids.append(data['id'])
+            accounts[data['id']] = accounts[order_id]
+        else:
+            messages.append(('add-order', data))
+            ids.append(data['id'])
+            accounts[data['id']] = data['account_id']
+    return messages
+
+def process_message(lob, method, payload):
+    if method == 'add-order':
+        return lob.processOrder(Quote(dict(payload)))[0]
+    elif method == 'cancel-order':
+        lob.cancelOrder(None, payload['order_id'], payload.get('account_id'),
+            payload['id'])
+        return []
+    elif method == 'amend-order':
+        return lob.modifyOrder(payload['order_id'], dict(payload),
+            payload.get('account_id'))[0]
+
+class OrderBookTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.envs = []
+
+    def tearDown(self):
+        for env in self.envs:
+            env.close()
+        shutil.rmtree(self.tmp)
+
+    def open_book(self, name, book='order'):
+        env = lmdb.open(str(self.tmp / name), max_dbs=4, map_size=1 << 28)
+        self.envs.append(env)
+        return OrderBook(env, self.tmp / (name + '-trades'), book=book)
+
+    def dump(self, lob):
+        out = []
+        for olist in (lob.bids, lob.asks):
+            with lob.env.begin(db=olist.db) as txn:
+                out.extend(txn.cursor().iternext())
+        return out
+
+class TestOrderBook(OrderBookTestCase):
+
+    def test_book_types_match(self):
+        self.check_book_types_match()
+
+    def test_book_types_match_small_window(self):
+        with mock.patch('lob.orderlist.ORDERS_SIZE', 20):
+            self.check_book_types_match()
+
+    def check_book_types_match(self):
+        quotes = random_quotes(5000)
+        books = {b: self.open_book(b, b) for b in BOOK_TYPES}
+        trades = {b: [] for b in BOOK_TYPES}
+
+        for i, data in enumerate(quotes):
+            for b, lob in books.items():
+                t, _ = lob.processOrder(Quote(dict(data)))
+                trades[b].extend(tuple(x[k] for k in TRADE_KEYS) for x in t)
+
+            if i % 500 == 0:
+                for lob in books.values():
+                    lob.flush()
+
+            if i % 100 == 0:
+                order, level = books['order'], books['level']
+                self.assertEqual(order.getBestBid(), level.getBestBid())
+                self.assertEqual(order.getBestAsk(), level.getBestAsk())
+                for price in range(90, 113):
+                    for side in ('bid', 'ask'):
+                        self.assertEqual(
+                            order.getVolumeAtPrice(side, price),
+                            level.getVolumeAtPrice(side, price))
+
+        for lob in books.values():
+            lob.flush()
+
+        self.assertEqual(books['order'].getDepth(5),
+            books['level'].getDepth(5))
+        self.check_depth(books['order'])
+
+        self.assertTrue(len(trades['order']) > 0)
+        self.assertEqual(trades['order'], trades['level'])
+        self.assertEqual(self.dump(books['order']), self.dump(books['level']))
+
+    # Depth against volumes summed from the dump
+    def check_depth(self, lob):
+        depth = lob.getDepth(1000)
+        for side, olist in (('bids', lob.bids), ('asks', lob.asks)):
+            volumes = {}
+            with lob.env.begin(db=olist.db) as txn:
+                for k, v in txn.cursor():
+                    price = abs(decode(k[:8]))
+                    volumes[price] = volumes.get(price, 0) + decode(v[:8])
+            levels = sorted(volumes.items(), reverse=(side == 'bids'))
+            self.assertEqual([tuple(x) for x in depth[side]], levels)
+            self.assertEqual(lob.getDepth(3)[side], depth[side][:3])
+
+    def test_level_hydrate(self):
+        lob = self.open_book('book', 'level')
+        for data in random_quotes(2000):
+            lob.processOrder(Quote(data))
+        lob.flush()
+
+        other = OrderBook(lob.env, self.tmp / 'trades', book='level')
+        for side in ('bids', 'asks'):
+            a, b = getattr(lob, side), getattr(other, side)
+            self.assertEqual(list(a.prices), list(b.prices))
+            self.assertEqual(len(a), len(b))
+            self.assertEqual(b.lazy_orders, len(b))
+            for sort_price in a.prices:
+                self.assertEqual(a.levels[sort_price].volume,
+                    b.levels[sort_price].volume)
+                self.assertEqual(len(a.levels[sort_price]),
+                    len(b.levels[sort_price]))
+                b.load(b.levels[sort_price])
+                self.assertEqual(
+                    [(o.id, o.price, o.qty, o.account_id)
+                        for o in a.levels[sort_price].orders.values()],
+                    [(o.id, o.price, o.qty, o.account_id)
+                        for o in b.levels[sort_price].orders.values()])
+            self.assertEqual(b.lazy_orders, 0)
+
+    # Cancels, amends and sweeps of orders in levels not built yet
+    def test_level_hydrate_match(self):
+        books = {}
+        for name in ('warm', 'cold'):
+            lob = self.open_book(name, 'level')
+            for data in random_quotes(2000):
+                lob.processOrder(Quote(data))
+            lob.flush()
+            books[name] = lob
+        cold = books['cold']
+        books['cold'] = OrderBook(cold.env, cold.trades_dir, book='level')
+        self.assertTrue(books['cold'].bids.lazy_orders)
+
+        trades = {name: [] for name in books}
+        # New ids past the resting ones, half the cancels and amends are
+        # of resting orders
+        for method, payload in random_messages(3000, seed=2):
+            payload = dict(payload, id=payload['id'] + 2000)
+            if payload.get('order_id', 0) % 2:
+                payload['order_id'] += 2000
+            elif method != 'add-order':
+                del payload['account_id']
+            for name, lob in books.items():
+                t = process_message(lob, method, dict(payload))
+                trades[name].extend(tuple(x[k] for k in TRADE_KEYS)
+                    for x in t)
+        for lob in books.values():
+            lob.flush()
+
+        self.assertTrue(trades['warm'])
+        self.assertEqual(trades['warm'], trades['cold'])
+        self.assertEqual(self.dump(books['warm']), self.dump(books['cold']))
+        self.assertEqual(books['warm'].getDepth(10),
+            books['cold'].getDepth(10))
+
+    def test_cancel_amend_match(self):
+        self.check_cancel_amend_match()
+
+    def test_cancel_amend_match_small_window(self):
+        with mock.patch('lob.orderlist.ORDERS_SIZE', 20):
+            self.check_cancel_amend_match()
+
+    def check_cancel_amend_match(self):
+        books = {b: self.open_book(b, b) for b in BOOK_TYPES}
+        trades = {b: [] for b in BOOK_TYPES}
+
+        for i, (method, payload) in enumerate(random_messages(5000)):
+            for b, lob in books.items():
+                t = process_message(lob, method, payload)
+                trades[b].extend(tuple(x[k] for k in TRADE_KEYS) for x in t)
+            if i % 500 == 0:
+                for lob in books.values():
+                    lob.flush()
+
+        for lob in books.values():
+            lob.flush()
+
+        self.assertEqual(trades['order'], trades['level'])
+        self.assertEqual(self.dump(books['order']), self.dump(books['level']))
+
+    def test_cancel_from_db(self):
+        with mock.patch('lob.orderlist.ORDERS_SIZE', 5):
+            lob = self.open_book('book')
+            for i in range(1, 51):
+                lob.processOrder(Quote(id=i, type='limit', side='ask',
+                    price=100 + i, qty=10, account_id=1))
+            lob.flush()
+
+            # Reopen so only the first few orders are in memory
+            lob = OrderBook(lob.env, self.tmp / 'trades')
+            self.assertNotIn(40, lob.asks.order_idx)
+            self.assertEqual(lob.cancelOrder(None, 40).id, 40)
+            self.assertIsNone(lob.cancelOrder(None, 40))
+            self.assertIsNone(lob.cancelOrder('ask', 999))
+            self.assertEqual(lob.getVolumeAtPrice('ask', 140), 0)
+
+            # Sweep the whole side, the cancelled order must not trade
+            trades, _ = lob.processOrder(Quote(id=100, type='market',
+                side='bid', qty=10000, account_id=2))
+            makers = [t['maker_order_id'] for t in trades]
+            self.assertEqual(len(makers), 49)
+            self.assertNotIn(40, makers)
+
+    # Cancelling more than the window between flushes must not hide the
+    # orders left in the db
+    def test_cancel_past_window_match(self):
+        window = 3
+        with mock.patch('lob.orderlist.ORDERS_SIZE', window), \
+            mock.patch('lob.orderlist.ORDERS_MAX', window):
+            books = {b: self.open_book(b, b) for b in BOOK_TYPES}
+            count = 2 * window + 5
+            trades = {}
+            for book, lob in books.items():
+                for i in range(1, count + 1):
+                    lob.processOrder(Quote(id=i, type='limit', side='bid',
+                        price=100 + i, qty=10, account_id=1))
+                lob.flush()
+                for i in range(count, count - window - 1, -1):
+                    self.assertEqual(lob.cancelOrder('bid', i).id, i)
+                    self.assertTrue(len(lob.bids))
+                self.assertEqual(lob.getBestBid(), 100 + count - window - 1)
+                t, _ = lob.processOrder(Quote(id=1000, type='limit',
+                    side='ask', price=1, qty=10000, account_id=2))
+                trades[book] = [tuple(x[k] for k in TRADE_KEYS) for x in t]
+                self.assertEqual(len(t), count - window - 1)
+                self.assertIsNone(lob.getBestBid())
+                self.assertEqual(lob.getBestAsk(), 1)
+            self.assertEqual(trades['order'], trades['level'])
+
+    # Cancels and amends of another account's order are rejected
+    def test_cancel_amend_owner(self):
+        for book in BOOK_TYPES:
+            lob = self.open_book(book, book)
+            lob.processOrder(Quote(id=1, type='limit', side='bid',
+                price=100, qty=10, account_id=1))
+
+            lob.applyEvent('cancel-order', {'id': 2, 'order_id': 1,
+                'account_id': 2})
+            lob.applyEvent('amend-order', {'id': 3, 'order_id': 1,
+                'account_id': 2, 'qty': 5})
+            lob.applyEvent('amend-order', {'id': 4, 'order_id': 1,
+                'account_id': 2, 'price': 101})
+            self.assertEqual(lob.rejected, [2, 3, 4])
+            self.assertEqual(lob.stats.counters['rejected'], 3)
+            self.assertEqual(lob.getVolumeAtPrice('bid', 100), 10)
+            self.assertEqual(lob.getBestBid(), 100)
+
+            lob.applyEvent('amend-order', {'id': 5, 'order_id': 1,
+                'account_id': 1, 'qty': 5})
+            self.assertEqual(lob.getVolumeAtPrice('bid', 100), 5)
+            lob.applyEvent('cancel-order', {'id': 6, 'order_id': 1,
+                'account_id': 1})
+            self.assertIsNone(lob.getBestBid())
+            self.assertEqual(lob.rejected, [2, 3, 4])
+
+    def test_cancel_amend_match_evicting(self):
+        with mock.patch('lob.orderlist.ORDERS_SIZE', 5), \
+            mock.patch('lob.orderlist.ORDERS_MAX', 10):
+            self.check_cancel_amend_match()
+
+    def test_book_types_match_evicting(self):
+        with mock.patch('lob.orderlist.ORDERS_SIZE', 5), \
+            mock.patch('lob.orderlist.ORDERS_MAX', 10):
+            self.check_book_types_match()
+
+    def test_adaptive_window(self):
+        lob = self.open_book('book')
+        for i in range(1, 20001):
+            lob.processOrder(Quote(id=i, type='limit', side='ask',
+                price=1000 + i // 10, qty=1, account_id=1))
+        lob.flush()
+
+        lob = OrderBook(lob.env, self.tmp / 'trades', window=(100, 50000))
+        asks = lob.asks
+        self.assertEqual(len(asks.orders), 101)
+
+        # Each refill of a sweep reads at least what it walked so far
+        trades, _ = lob.processOrder(Quote(id=30000, type='market',
+            side='bid', qty=10000, account_id=2))
+        self.assertEqual(len(trades), 10000)
+        self.assertLessEqual(lob.stats.counters['refills'], 9)
+        self.assertLess(lob.stats.counters['refill_rows'], 30000)
+
+        lob.flush()
+        self.assertEqual(asks.window, 20002)
+        resting = len(asks.orders)
+        self.assertEqual(resting,
+            lob.stats.counters['refill_rows'] - 10000)
+
+        # Quiet, the window shrinks back and the tail is evicted
+        for i in range(100):
+            lob.flush()
+        self.assertEqual(asks.window, 100)
+        self.assertEqual(len(asks.orders), 100)
+        self.assertEqual(len(asks.order_idx), 100)
+        self.assertEqual(lob.stats.counters['evicted'], resting - 100)
+
+        # The book carries on from the db past the window
+        trades, _ = lob.processOrder(Quote(id=30001, type='market',
+            side='bid', qty=10000, account_id=2))
+        self.assertEqual([t['maker_order_id'] for t in trades],
+            list(range(10001, 20001)))
+
+    def test_amend_priority(self):
+        lob = self.open_book('book')
+        for i in (1, 2, 3):
+            lob.processOrder(Quote(id=i, type='limit', side='bid',
+                price=100, qty=10, account_id=i))
+        lob.flush()
+
+        # Qty down keeps priority, qty up loses it under the amend id
+        lob.modifyOrder(1, {'id': 4, 'qty': 5})
+        lob.modifyOrder(2, {'id': 5, 'qty': 20})
+        self.assertEqual(lob.getVolumeAtPrice('bid', 100), 35)
+
+        trades, _ = lob.processOrder(Quote(id=6, type='market',
+            side='ask', qty=35, account_id=9))
+        self.assertEqual([t['maker_order_id'] for t in trades], [1, 3, 5])
+        self.assertEqual([t['qty'] for t in trades], [5, 10, 20])
+
+        # Price change that crosses trades immediately
+        lob.processOrder(Quote(id=7, type='limit', side='ask',
+            price=110, qty=10, account_id=9))
+        lob.processOrder(Quote(id=8, type='limit', side='bid',
+            price=100, qty=10, account_id=1))
+        trades, _ = lob.modifyOrder(8, {'id': 9, 'price': 110})
+        self.assertEqual(len(trades), 1)
+        self.assertEqual(trades[0]['taker_order_id'], 9)
+
+    def test_process_batch(self):
+        quotes = random_quotes(3000)
+        one, batch = self.open_book('one'), self.open_book('batch')
+
+        trades = []
+        for data in quotes:
+            trades += one.processOrder(Quote(dict(data)))[0]
+
+        batch_trades = []
+        for i in range(0, len(quotes), 250):
+            t, _ = batch.processBatch([Quote(dict(d)) for d in quotes[i:i+250]])
+            batch_trades += t
+        one.flush()
+        batch.flush()
+
+        key = lambda t: tuple(t[k] for k in TRADE_KEYS)
+        self.assertEqual(list(map(key, trades)), list(map(key, batch_trades)))
+        self.assertEqual(self.dump(one), self.dump(batch))
@@ -0,0 +1,52 @@
+import unittest
+
+import fakeredis
+
+from redis_queue import SimpleQueue
+
+class TestSimpleQueue(unittest.TestCase):
+    def setUp(self):
+        self.conn = fakeredis.FakeRedis()
+        self.q = SimpleQueue(self.conn, 'test')
+
+    def fill(self, count):
+        for i in range(count):
+            self.q.enqueue('add-order', {'id': i})
+
+    def ids(self, tasks):
+        return [t[2]['id'] for t in tasks]
+
+    def test_dequeue_many(self):
+        self.fill(25)
+        self.assertEqual(self.ids(self.q.dequeue_many(10)), list(range(10)))
+        self.assertEqual(self.ids(self.q.dequeue_many(10)), list(range(10, 20)))
+        self.assertEqual(self.ids(self.q.dequeue_many(10)), list(range(20, 25)))
+        self.assertEqual(self.q.dequeue_many(10), [])
+        self.assertEqual(self.q.get_length(), 0)
+
+    def test_dequeue_many_timeout(self):
+        self.assertEqual(self.q.dequeue_many(10, timeout=0.1), [])
+        self.fill(3)
+        self.assertEqual(self.ids(self.q.dequeue_many(10, timeout=0.1)),
+            [0, 1, 2])
+
+    def test_processing_recover(self):
+        self.fill(30)
+        self.assertEqual(self.ids(self.q.dequeue_many(10, processing=True)),
+            list(range(10)))
+        self.q.ack()
+
+        # Crash after dequeue, before the flush and ack
+        self.q.dequeue_many(10, processing=True)
+        self.q.dequeue_many(5, timeout=0.1, processing=True)
+        self.assertEqual(self.conn.llen(self.q.processing), 15)
+
+        self.assertEqual(self.q.recover(), 15)
+        self.assertEqual(self.conn.llen(self.q.processing), 0)
+        self.assertEqual(self.ids(self.q.dequeue_many(100)), list(range(10, 30)))
+
+    def test_enqueue_batch(self):
+        self.q.enqueue_batch([('add-order', {'id': 1}), ('cancel-order', {'id': 2})])
+        (idnum, method, payload), = self.q.dequeue_many(10)
+        self.assertEqual(method, 'batch')
+        self.assertEqual(payload, [['add-order', {'id': 1}], ['cancel-order', {'id': 2}]])
@@ -0,0 +1,54 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from respcache import ResponseCache, file_version, etag_matches
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_version(self):
+        cache = ResponseCache()
+        builds = []
+        def build(body):
+            def f():
+                builds.append(body)
+                return body
+            return f
+
+        body, etag = cache.get('a', 1, build(b'[1]'))
+        self.assertEqual(body, b'[1]')
+        self.assertEqual(cache.get('a', 1, build(b'[2]')), (b'[1]', etag))
+        body, etag2 = cache.get('a', 2, build(b'[2]'))
+        self.assertEqual(body, b'[2]')
+        self.assertNotEqual(etag, etag2)
+        self.assertEqual(builds, [b'[1]', b'[2]'])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_lru(self):
+        cache = ResponseCache(size=2)
+        cache.get('a', 1, lambda: b'a')
+        cache.get('b', 1, lambda: b'b')
+        cache.get('a', 1, lambda: b'x')
+        cache.get('c', 1, lambda: b'c')
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+
+    def test_etag_matches(self):
+        etag = '"abc"'
+        self.assertTrue(etag_matches('"abc"', etag))
+        self.assertTrue(etag_matches('"x", W/"abc"', etag))
+        self.assertTrue(etag_matches('*', etag))
+        self.assertFalse(etag_matches('"abd"', etag))
+        self.assertFalse(etag_matches(None, etag))
+
+    def test_file_version(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'last24.json')
+        self.assertEqual(file_version(path), (None,))
+        with open(path, 'w') as f:
+            f.write('{}')
+        v1 = file_version(path)
+        with open(path, 'a') as f:
+            f.write(' ')
+        self.assertNotEqual(file_version(path), v1)
@@ -0,0 +1,160 @@
+import unittest
+import shutil
+import tempfile
+from pathlib import Path
+
+import lmdb
+
+from lob.orderbook import OrderBook, BOOK_TYPES
+from lob.model import Quote
+from lob.risk import Balances, MarketRisk, SCALE
+from tests.test_orderbook import random_messages, process_message
+
+ASSET, UOA = 1, 2
+
+def quote(id, side, price, qty, account_id, type='limit'):
+    return Quote(id=id, type=type, side=side, price=price, qty=qty,
+        account_id=account_id)
+
+class RiskTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.envs = []
+
+    def tearDown(self):
+        for env in self.envs:
+            env.close()
+        shutil.rmtree(self.tmp)
+
+    def open_book(self, balances, name='lob', book='order', bps=(0, 0)):
+        env = lmdb.open(str(self.tmp / name), max_dbs=4)
+        self.envs.append(env)
+        risk = MarketRisk(balances, ASSET, UOA, *bps)
+        return OrderBook(env, self.tmp / (name + '-trades'), book=book,
+            risk=risk)
+
+    def funded(self, accounts, asset=1000, uoa=100000):
+        balances = Balances()
+        balances.load([(a, ASSET, asset) for a in accounts]
+            + [(a, UOA, uoa) for a in accounts])
+        return balances
+
+    # Reservations of the orders resting in lob, as hydrate() counts them
+    def reserved(self, lob):
+        expected = {}
+        for olist in (lob.bids, lob.asks):
+            for price, qty, account_id in olist.resting():
+                asset, amount = lob.risk.cost(olist.side, price, qty)
+                key = (account_id, asset)
+                expected[key] = expected.get(key, 0) + amount
+        return expected
+
+    def check_reserved(self, lob):
+        lob.flush()
+        expected = self.reserved(lob)
+        for key, (balance, reserved) in lob.risk.balances.accounts.items():
+            self.assertEqual(reserved, expected.get(key, 0), key)
+            self.assertGreaterEqual(balance - reserved, 0, key)
+
+    def test_reject(self):
+        balances = self.funded([1], asset=10, uoa=1000)
+        lob = self.open_book(balances)
+
+        _, order = lob.processOrder(quote(1, 'bid', 100, 10, 1))
+        self.assertTrue(order)
+        self.assertEqual(balances.get(1, UOA), (1000 * SCALE, 1000 * SCALE))
+
+        # Nothing left for another bid, the asset is still free
+        lob.processOrder(quote(2, 'bid', 1, 1, 1))
+        lob.processOrder(quote(3, 'ask', 200, 11, 1))
+        _, order = lob.processOrder(quote(4, 'ask', 200, 10, 1))
+        self.assertTrue(order)
+        self.assertEqual(lob.rejected, [2, 3])
+        self.assertEqual(lob.getBestBid(), 100)
+
+        # A cancel frees the reservation
+        lob.cancelOrder(None, 1)
+        self.assertEqual(balances.available(1, UOA), 1000 * SCALE)
+
+    def test_trade(self):
+        balances = self.funded([1, 2])
+        lob = self.open_book(balances, bps=(10, 20))
+
+        lob.processOrder(quote(1, 'ask', 100, 10, 1))
+        trades, _ = lob.processOrder(quote(2, 'bid', 105, 4, 2))
+        self.assertEqual([t['qty'] for t in trades], [4])
+
+        # The bid reserved at 105 and paid 100, fees are in bps
+        self.assertEqual(balances.get(2, UOA), (
+            (100000 - 400) * SCALE, 0))
+        self.assertEqual(balances.get(2, ASSET), (
+            1004 * SCALE - 4 * 20, 0))
+        self.assertEqual(balances.get(1, ASSET), (996 * SCALE, 6 * SCALE))
+        self.assertEqual(balances.get(1, UOA), (
+            100400 * SCALE - 400 * 10, 0))
+
+    def test_market_orders(self):
+        balances = self.funded([1, 2], asset=100, uoa=1100)
+        lob = self.open_book(balances)
+        lob.processOrder(quote(1, 'ask', 100, 5, 1))
+        lob.processOrder(quote(2, 'ask', 150, 5, 1))
+
+        # 1100 buys 5 at 100 and 4 at 150
+        trades, _ = lob.processOrder(quote(3, 'bid', None, 20, 2, 'market'))
+        self.assertEqual([t['qty'] for t in trades], [5, 4])
+        self.assertEqual(balances.get(2, UOA), (0, 0))
+        self.assertEqual(lob.getVolumeAtPrice('ask', 150), 1)
+
+        # Nothing left to buy with
+        lob.processOrder(quote(4, 'bid', None, 20, 2, 'market'))
+        self.assertEqual(lob.rejected, [4])
+
+        # An unfilled market ask doesn't keep its reservation
+        lob.processOrder(quote(5, 'bid', 90, 1, 1))
+        trades, _ = lob.processOrder(quote(6, 'ask', None, 10, 2, 'market'))
+        self.assertEqual([t['qty'] for t in trades], [1])
+        self.assertEqual(balances.get(2, ASSET), (108 * SCALE, 0))
+
+    def test_amend(self):
+        balances = self.funded([1], uoa=1000)
+        lob = self.open_book(balances)
+        lob.processOrder(quote(1, 'bid', 100, 8, 1))
+
+        # Reducing releases the difference
+        lob.modifyOrder(1, {'id': 2, 'qty': 5})
+        self.assertEqual(balances.available(1, UOA), 500 * SCALE)
+
+        # A replacement is checked with the old reservation freed
+        lob.modifyOrder(1, {'id': 3, 'price': 200})
+        self.assertEqual(balances.available(1, UOA), 0)
+        lob.modifyOrder(3, {'id': 4, 'price': 201})
+        self.assertEqual(lob.rejected, [4])
+        self.assertEqual(lob.getBestBid(), 200)
+        self.assertEqual(balances.available(1, UOA), 0)
+
+    def test_random(self):
+        for book in BOOK_TYPES:
+            balances = self.funded(range(1, 10), asset=300, uoa=30000)
+            lob = self.open_book(balances, book, book, bps=(10, 20))
+            for method, payload in random_messages(3000):
+                process_message(lob, method, payload)
+            self.assertTrue(lob.rejected)
+            self.check_reserved(lob)
+
+            # Orders trade no more than was there
+            total = sum(balances.get(a, ASSET)[0] for a in range(1, 10))
+            self.assertLessEqual(total, 9 * 300 * SCALE)
+
+    def test_hydrate(self):
+        balances = self.funded(range(1, 10), asset=300, uoa=30000)
+        lob = self.open_book(balances, bps=(10, 20))
+        for method, payload in random_messages(1000):
+            process_message(lob, method, payload)
+        lob.flush()
+
+        # The same balances, back from account_asset as trades2db left
+        # them before settling the tapes
+        restarted = self.funded(range(1, 10), asset=300, uoa=30000)
+        self.envs.pop().close()
+        self.open_book(restarted, bps=(10, 20))
+        self.assertEqual(restarted.accounts, balances.accounts)
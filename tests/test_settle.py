@@ -0,0 +1,140 @@
+import unittest
+from decimal import Decimal
+from types import SimpleNamespace
+
+import numpy as np
+
+from lob.tape import TAPE_DTYPE, SIDES
+from settle import Settlement, copy_text, decimal_cols
+
+MARKET = SimpleNamespace(id=3, asset=SimpleNamespace(id=1),
+    uoa=SimpleNamespace(id=2))
+FEE_ACCOUNT_ID = 1
+MAKER_BPS = 10
+TAKER_BPS = 25
+
+def random_tape(count, seed=1):
+    rng = np.random.default_rng(seed)
+    tape = np.zeros(count, dtype=TAPE_DTYPE)
+    tape['time'] = 1593000000000000 + np.arange(count) * 1000
+    tape['price'] = rng.integers(1, 100000, count)
+    tape['qty'] = rng.integers(1, 1000, count)
+    tape['taker_side'] = rng.integers(0, 2, count)
+    tape['maker_account_id'] = rng.integers(2, 50, count)
+    tape['taker_account_id'] = rng.integers(2, 50, count)
+    return tape
+
+# The per trade ledgers trades2db used to build
+def expected_ledgers(tape):
+    maker_rate = Decimal(MAKER_BPS) / 10000
+    taker_rate = Decimal(TAKER_BPS) / 10000
+    out = []
+    for row in tape.tolist():
+        (time, price, qty, taker_side, maker_order_id, maker_account_id,
+            taker_order_id, taker_account_id) = row
+        total = price * qty
+        if SIDES[taker_side] == 'bid':
+            buyer_id, seller_id = taker_account_id, maker_account_id
+            amt_fee = qty * taker_rate
+            total_fee = total * maker_rate
+        else:
+            buyer_id, seller_id = maker_account_id, taker_account_id
+            amt_fee = qty * maker_rate
+            total_fee = total * taker_rate
+        a, u = MARKET.asset.id, MARKET.uoa.id
+        out += [
+            (a, seller_id,      -qty),
+            (a, buyer_id,       qty - amt_fee),
+            (a, FEE_ACCOUNT_ID, amt_fee),
+            (u, buyer_id,       -total),
+            (u, seller_id,      total - total_fee),
+            (u, FEE_ACCOUNT_ID, total_fee),
+        ]
+    return out
+
+class FakeCursor():
+    def __init__(self):
+        self.copied = {}
+        self.executed = []
+
+    def execute(self, sql, params):
+        self.executed.append((sql, params))
+
+    def copy_expert(self, sql, buf):
+        table = sql.split()[1]
+        self.copied[table] = [l.split('\t') for l in
+            buf.getvalue().decode().splitlines()]
+
+class TestSettle(unittest.TestCase):
+
+    def settle(self, tape, **kwargs):
+        return Settlement(tape, MARKET, FEE_ACCOUNT_ID, MAKER_BPS, TAKER_BPS,
+            **kwargs)
+
+    def test_ledgers(self):
+        tape = random_tape(500)
+        s = self.settle(tape)
+        got = [(a, acct, Decimal(amt) / 10000) for a, acct, amt in zip(
+            s.ledger_asset_id.tolist(), s.ledger_account_id.tolist(),
+            s.ledger_amount.tolist())]
+        self.assertEqual(got, expected_ledgers(tape))
+        # Every leg nets out per asset
+        for asset in (MARKET.asset.id, MARKET.uoa.id):
+            self.assertEqual(s.ledger_amount[s.ledger_asset_id == asset].sum(), 0)
+
+    def test_copy(self):
+        tape = random_tape(100)
+        ids = np.arange(1000, 1200)
+        s = self.settle(tape, trade_side_ids=ids)
+        cursor = FakeCursor()
+        s.copy(cursor)
+
+        trades = cursor.copied['trade']
+        sides = cursor.copied['trade_side']
+        ledgers = cursor.copied['ledger']
+        self.assertEqual((len(trades), len(sides), len(ledgers)),
+            (100, 200, 600))
+        self.assertEqual(len(set(r[0] for r in trades + ledgers)), 700)
+        self.assertEqual(trades[0][1:4], ['3', str(tape['price'][0]),
+            str(tape['qty'][0])])
+        self.assertEqual(trades[0][4], '2020-06-24T12:00:00')
+
+        self.assertEqual([r[0] for r in sides], [str(i) for i in ids])
+        self.assertEqual(sides[0][2], 'maker')
+        self.assertEqual(sides[0][3], trades[0][0])
+        self.assertEqual(sides[1][5], '0.0025')
+
+        # Fee legs have no trade side, the rest reference one of theirs
+        self.assertEqual(ledgers[2][6], '\\N')
+        self.assertIn(int(ledgers[0][6]), (1000, 1001))
+        total = sum(Decimal(r[4]) for r in ledgers if r[3] == '2')
+        self.assertEqual(total, 0)
+
+    def test_update_balances(self):
+        tape = random_tape(300, seed=2)
+        s = self.settle(tape)
+        cursor = FakeCursor()
+        s.update_balances(cursor)
+
+        expected = {}
+        for asset, account, amount in expected_ledgers(tape):
+            key = (account, asset)
+            expected[key] = expected.get(key, 0) + amount
+
+        (sql, balances), (sql, price) = cursor.executed
+        keys = list(zip(balances['account_ids'], balances['asset_ids']))
+        self.assertEqual(keys, sorted(expected))
+        self.assertEqual(
+            dict(zip(keys, (Decimal(a) for a in balances['amounts']))),
+            expected)
+        self.assertEqual(price, {'market_id': MARKET.id,
+            'price': int(tape['price'][-1]), 'created': s.created_dt})
+
+        cursor = FakeCursor()
+        self.settle(tape[:0]).update_balances(cursor)
+        self.assertEqual(cursor.executed, [])
+
+    def test_decimal_cols(self):
+        n = np.array([-12345, 5, 0, 10000])
+        self.assertEqual(copy_text(b'%s%d.%04d\n', decimal_cols(n)),
+            b'-1.2345\n0.0005\n0.0000\n1.0000\n')
@@ -0,0 +1,122 @@
+import unittest
+import random
+import sys
+import threading
+import shutil
+import tempfile
+import urllib.request
+from pathlib import Path
+
+import numpy as np
+
+from stats import Histogram, Stats, StatsExporter, prometheus, PERCENTILES
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets(self):
+        def bucket(value):
+            h = Histogram()
+            h.record(value)
+            return h.counts.index(1)
+
+        end = 0
+        for i in range(len(Histogram().counts)):
+            low, width = Histogram.bucket_range(i)
+            self.assertEqual(low, end)
+            end = low + width
+            if low < 10 ** 12:
+                self.assertEqual(bucket(low), i)
+                self.assertEqual(bucket(end - 1), i)
+
+    def test_percentiles(self):
+        rnd = random.Random(1)
+        values = [int(rnd.lognormvariate(10, 2)) for i in range(20000)]
+        h = Histogram()
+        for v in values:
+            h.record(v)
+        self.assertEqual(h.count, len(values))
+        self.assertEqual(h.total, sum(values))
+        self.assertEqual(h.max, max(values))
+        for p in PERCENTILES:
+            exact = np.percentile(values, p)
+            self.assertLess(abs(h.percentile(p) - exact) / exact, 0.04)
+        self.assertEqual(h.percentile(100), max(values))
+        self.assertEqual(Histogram().percentile(50), 0)
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def stats(self):
+        st = Stats(labels={'market': 'xyz'}, dump=False)
+        for ms in (1, 2, 3, 4):
+            st.set('flush', ms / 1000, count=10)
+        st.incr('trades', 5)
+        st.incr('trades')
+        return st
+
+    def test_stats(self):
+        st = self.stats()
+        self.assertNotIn(st, Stats.instances)
+        self.assertEqual(st.ops['flush'], 40)
+        self.assertEqual(st.hists['flush'].total, 10 * 10 ** 6)
+
+        lines = st.text().split('\n')
+        self.assertEqual(lines[1].split()[:3], ['flush', '40', '10.00'])
+        self.assertEqual(lines[1].split()[4], '2.500')
+        self.assertEqual(lines[2].split(), ['trades', '6'])
+
+        @st.timeit
+        def work(x):
+            return x * 2
+        self.assertEqual(work(2), 4)
+        self.assertEqual(st.hists['work'].count, 1)
+
+    def test_prometheus(self):
+        text = prometheus([self.stats(), Stats(dump=False)])
+        lines = text.splitlines()
+        self.assertIn('# TYPE lob_flush_seconds summary', lines)
+        self.assertIn('lob_flush_seconds_count{market="xyz"} 4', lines)
+        self.assertIn('lob_flush_seconds_sum{market="xyz"} 0.01', lines)
+        self.assertIn('# TYPE lob_trades_total counter', lines)
+        self.assertIn('lob_trades_total{market="xyz"} 6', lines)
+        p50 = [l for l in lines if 'quantile="0.5"' in l][0]
+        self.assertAlmostEqual(float(p50.split()[1]), 0.002, delta=0.0001)
+
+    # Scrapes while another thread creates counters and histograms
+    def test_prometheus_concurrent(self):
+        st = Stats(dump=False)
+        def record():
+            for i in range(20000):
+                st.incr('c%d' % i)
+                if i % 100 == 0:
+                    st.hist('h%d' % i).record(i)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        t = threading.Thread(target=record)
+        t.start()
+        try:
+            while t.is_alive():
+                prometheus([st])
+        finally:
+            t.join()
+            sys.setswitchinterval(interval)
+        self.assertEqual(len(st.counters), 20000)
+
+    def test_exporter(self):
+        st = self.stats()
+        path = self.tmp / 'lob.prom'
+        exporter = StatsExporter(lambda: [st], port=0, path=str(path),
+            interval=0.01)
+        port = exporter.server.server_address[1]
+        url = 'http://127.0.0.1:%d/metrics' % port
+        with urllib.request.urlopen(url) as r:
+            self.assertEqual(r.read().decode(), prometheus([st]))
+
+        st.incr('trades')
+        exporter.close()
+        self.assertIn('lob_trades_total{market="xyz"} 7',
+            path.read_text().splitlines())
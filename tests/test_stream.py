@@ -0,0 +1,67 @@
+import unittest
+from time import time
+
+import fakeredis
+
+from stream import Fanout
+
+SUBSCRIBERS = 5000
+MARKETS = 5
+MESSAGES = 50
+
+class TestFanout(unittest.TestCase):
+    def setUp(self):
+        self.conn = fakeredis.FakeRedis()
+        self.fanout = Fanout(self.conn, '*:depth', size=MESSAGES)
+
+    def tearDown(self):
+        self.fanout.close()
+
+    def drain(self, q, count):
+        return [q.get(timeout=5) for i in range(count)]
+
+    def test_channels(self):
+        a = self.fanout.subscribe('aaa:depth')
+        b = self.fanout.subscribe('bbb:depth')
+        self.conn.publish('aaa:depth', b'1')
+        self.conn.publish('aaa:trades', b'x')
+        self.conn.publish('bbb:depth', b'2')
+        self.assertEqual(self.drain(a, 1), [b'1'])
+        self.assertEqual(self.drain(b, 1), [b'2'])
+
+        self.fanout.unsubscribe('aaa:depth', a)
+        self.conn.publish('aaa:depth', b'3')
+        self.conn.publish('bbb:depth', b'4')
+        self.assertEqual(self.drain(b, 1), [b'4'])
+        self.assertTrue(a.empty())
+        self.assertNotIn('aaa:depth', self.fanout.clients)
+
+    def test_slow_client(self):
+        slow = self.fanout.subscribe('aaa:depth')
+        fast = self.fanout.subscribe('aaa:depth')
+        for i in range(MESSAGES + 1):
+            self.conn.publish('aaa:depth', b'%d' % i)
+            if i < MESSAGES:
+                self.assertEqual(fast.get(timeout=5), b'%d' % i)
+
+        self.assertEqual(fast.get(timeout=5), b'%d' % MESSAGES)
+        self.assertIsNone(slow.get(timeout=5))
+        self.assertEqual(self.fanout.clients['aaa:depth'], {fast})
+
+    # Thousands of subscribers each getting every message in order
+    def test_load(self):
+        channels = ['m%d:depth' % i for i in range(MARKETS)]
+        clients = [self.fanout.subscribe(c)
+            for c in channels * (SUBSCRIBERS // MARKETS)]
+
+        start = time()
+        for i in range(MESSAGES):
+            for c in channels:
+                self.conn.publish(c, b'%d' % i)
+        received = [self.drain(q, MESSAGES) for q in clients]
+        elapsed = time() - start
+
+        expected = [b'%d' % i for i in range(MESSAGES)]
+        self.assertTrue(all(r == expected for r in received))
+        print('%d subscribers, %d messages delivered in %.2f s' % (
+            SUBSCRIBERS, SUBSCRIBERS * MESSAGES, elapsed))
@@ -0,0 +1,40 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from lob.tape import write_tape, read_tape, tape_csv, TAPE_KEYS, SIDES
+
+TRADES = [
+    {
+        'time': 1593000000000000 + i, 'price': 100 + i, 'qty': i + 1,
+        'taker_side': SIDES[i % 2],
+        'maker_order_id': 10 + i, 'maker_account_id': 20 + i,
+        'taker_order_id': 30 + i, 'taker_account_id': 40 + i
+    } for i in range(100)
+]
+
+CSV = [','.join(str(t[k]) for k in TAPE_KEYS) for t in TRADES]
+
+class TestTape(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'tape')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        with open(self.path, 'wb') as f:
+            self.assertEqual(write_tape(f, TRADES), 100)
+
+        data = read_tape(self.path)
+        self.assertEqual(len(data), 100)
+        self.assertEqual(data['price'].sum(), sum(t['price'] for t in TRADES))
+        self.assertEqual(list(tape_csv(self.path)), CSV)
+
+    def test_read_csv(self):
+        with open(self.path, 'w') as f:
+            f.write("\n".join(CSV) + "\n")
+
+        self.assertEqual(list(tape_csv(self.path)), CSV)